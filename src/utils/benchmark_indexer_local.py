@@ -0,0 +1,390 @@
+"""
+Local benchmark for the transaction-level indexer
+Generates synthetic statement files and runs claude_Transaction_Level_Indexing_v3 against
+in-process stand-ins for S3, Bedrock and Pinecone (configurable latency and throttling).
+Nothing touches AWS. Reports transactions/second, peak RSS and busy time per stage.
+
+Examples:
+    python benchmark_indexer_local.py --users 200 --files-per-user 2 --rows-per-file 500
+    python benchmark_indexer_local.py --users 5000 --bedrock-latency-ms 40 --bedrock-throttle-rate 0.02
+    python benchmark_indexer_local.py --users 50 --passes 2 --vector-store local --json results.json
+    python benchmark_indexer_local.py --users 500 --embedding-backend local
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+from botocore.exceptions import ClientError
+
+import claude_Transaction_Level_Indexing_v3 as indexer
+
+# ==================== SYNTHETIC DATA ====================
+
+MERCHANTS = [
+    # (merchant, category, typical amount, recurring period in days or None)
+    ("Netflix", "entertainment", 15.99, 30),
+    ("Spotify", "entertainment", 10.99, 30),
+    ("Planet Fitness", "health", 24.99, 30),
+    ("Comcast Internet", "utilities", 79.99, 30),
+    ("PG&E Electric", "utilities", 120.00, 30),
+    ("State Farm Insurance", "insurance", 142.50, 30),
+    ("Whole Foods", "groceries", 85.00, None),
+    ("Trader Joe's", "groceries", 55.00, None),
+    ("Safeway", "groceries", 70.00, None),
+    ("Shell", "gas", 48.00, None),
+    ("Chevron", "gas", 52.00, None),
+    ("Starbucks", "dining", 7.50, None),
+    ("Chipotle", "dining", 14.00, None),
+    ("Amazon", "shopping", 45.00, None),
+    ("Target", "shopping", 60.00, None),
+    ("Uber", "transportation", 22.00, None),
+    ("Delta Air Lines", "travel", 420.00, None),
+    ("CVS Pharmacy", "healthcare", 28.00, None),
+]
+
+STATEMENT_FILES = ["bank_account.json", "credit_card.json", "investment.json", "savings_account.json"]
+
+def generate_statement(user_id, file_index, rows, seed):
+    """Deterministic synthetic statement: payroll, recurring bills and everyday spending"""
+    rng = random.Random(f"{seed}:{user_id}:{file_index}")
+    start = date(2023, 1, 1)
+    span_days = max(30, rows // 3)
+    transactions = []
+
+    # Payroll every two weeks
+    for day in range(rng.randint(0, 13), span_days, 14):
+        if len(transactions) >= rows // 10:
+            break
+        transactions.append({
+            "transaction_id": f"{user_id}-{file_index}-{len(transactions)}",
+            "transaction_date": (start + timedelta(days=day)).isoformat(),
+            "amount": round(rng.uniform(2400, 2600), 2),
+            "description": "PAYROLL DIRECT DEPOSIT ACME CORP",
+            "merchant": "",
+            "category": "income",
+            "type": "credit",
+        })
+
+    while len(transactions) < rows:
+        merchant, category, typical, period = rng.choice(MERCHANTS)
+        day = rng.randrange(span_days)
+        if period:
+            amount = typical
+            day = day - day % period + 3
+        else:
+            amount = round(rng.lognormvariate(0, 0.5) * typical, 2)
+        transactions.append({
+            "transaction_id": f"{user_id}-{file_index}-{len(transactions)}",
+            "transaction_date": (start + timedelta(days=day)).isoformat(),
+            "amount": -amount,
+            "description": f"POS DEBIT {merchant.upper()} #{rng.randint(1000, 9999)}",
+            "merchant": merchant,
+            "category": category,
+            "type": "debit",
+        })
+
+    rng.shuffle(transactions)
+    return json.dumps({"transactions": transactions}).encode('utf-8')
+
+# ==================== SERVICE STAND-INS ====================
+
+class ServiceProfile:
+    """Latency and throttling behaviour of one stand-in service"""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, throttle_rate=0.0, max_rps=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_rate = throttle_rate
+        self.max_rps = max_rps
+        self.lock = threading.Lock()
+        self.window_start = time.time()
+        self.window_calls = 0
+        self.calls = 0
+        self.throttled = 0
+
+    def call(self):
+        """Sleep for the simulated latency; return False if this call is throttled"""
+        with self.lock:
+            self.calls += 1
+            now = time.time()
+            if now - self.window_start >= 1.0:
+                self.window_start = now
+                self.window_calls = 0
+            self.window_calls += 1
+            over_limit = self.max_rps and self.window_calls > self.max_rps
+
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000.0)
+
+        if over_limit or random.random() < self.throttle_rate:
+            with self.lock:
+                self.throttled += 1
+            return False
+        return True
+
+class LocalS3:
+    """Synthetic bucket: object bodies are generated on demand, so memory stays flat"""
+
+    def __init__(self, users, files_per_user, rows_per_file, seed, profile):
+        self.rows_per_file = rows_per_file
+        self.seed = seed
+        self.profile = profile
+        self.keys = []
+        self.file_indexes = {}
+        for user in range(users):
+            user_id = f"bench-user-{user:07d}"
+            for file_index in range(files_per_user):
+                name = STATEMENT_FILES[file_index % len(STATEMENT_FILES)]
+                if file_index >= len(STATEMENT_FILES):
+                    name = f"{file_index}_{name}"
+                key = f"{user_id}/finance/{name}"
+                self.keys.append(key)
+                self.file_indexes[key] = file_index
+
+    def _body(self, key):
+        user_id = key.split('/')[0]
+        return generate_statement(user_id, self.file_indexes[key], self.rows_per_file, self.seed)
+
+    def _etag(self, key):
+        return hashlib.md5(f"{self.seed}:{self.rows_per_file}:{key}".encode()).hexdigest()
+
+    def get_paginator(self, name):
+        s3 = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix='', Delimiter=None):
+                keys = [key for key in s3.keys if key.startswith(Prefix)]
+                if Delimiter:
+                    prefixes = sorted({key.split(Delimiter)[0] + Delimiter for key in keys})
+                    for i in range(0, len(prefixes), 1000):
+                        s3.profile.call()
+                        yield {"CommonPrefixes": [{"Prefix": p} for p in prefixes[i:i + 1000]]}
+                    return
+                for i in range(0, len(keys), 1000):
+                    s3.profile.call()
+                    yield {"Contents": [
+                        {"Key": key, "ETag": f'"{s3._etag(key)}"', "Size": s3.rows_per_file * 200}
+                        for key in keys[i:i + 1000]
+                    ]}
+
+        return Paginator()
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.profile.call()
+        body = self._body(Key)
+        return {"Body": io.BytesIO(body), "ContentLength": len(body), "ETag": f'"{self._etag(Key)}"'}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.profile.call()
+        return {"ContentLength": self.rows_per_file * 200, "ETag": f'"{self._etag(Key)}"'}
+
+class LocalBedrock:
+    """invoke_model returning deterministic pseudo-embeddings"""
+
+    def __init__(self, profile, dimensions=indexer.EMBEDDING_DIMENSIONS):
+        self.profile = profile
+        self.dimensions = dimensions
+
+    def invoke_model(self, modelId, body, **kwargs):
+        if not self.profile.call():
+            raise ClientError(
+                {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "InvokeModel"
+            )
+        text = json.loads(body)["inputText"]
+        digest = hashlib.sha256(text.encode('utf-8')).digest()
+        embedding = [(digest[i % 32] - 127.5) / 127.5 for i in range(self.dimensions)]
+        return {"body": io.BytesIO(json.dumps({"embedding": embedding}).encode('utf-8'))}
+
+class RateLimitedError(Exception):
+    """Stand-in for a Pinecone 429"""
+    status = 429
+
+class LocalPineconeIndex:
+    """Index stand-in that keeps only ids and user ids (no vector payloads)"""
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.lock = threading.Lock()
+        self.vectors = {}  # id -> user_id
+
+    def _call(self):
+        if not self.profile.call():
+            raise RateLimitedError("429 Too Many Requests")
+
+    def upsert(self, vectors, namespace=None, **kwargs):
+        self._call()
+        with self.lock:
+            for vector in vectors:
+                self.vectors[vector["id"]] = vector["metadata"].get("user_id")
+        return {"upserted_count": len(vectors)}
+
+    def fetch(self, ids, namespace=None, **kwargs):
+        self._call()
+        with self.lock:
+            return {"vectors": {vector_id: {"id": vector_id} for vector_id in ids if vector_id in self.vectors}}
+
+    def delete(self, ids=None, filter=None, delete_all=False, namespace=None, **kwargs):
+        self._call()
+        with self.lock:
+            if delete_all:
+                self.vectors.clear()
+            elif ids:
+                for vector_id in ids:
+                    self.vectors.pop(vector_id, None)
+            elif filter:
+                user_id = filter["user_id"]["$eq"]
+                for vector_id in [v for v, owner in self.vectors.items() if owner == user_id]:
+                    del self.vectors[vector_id]
+        return {}
+
+    def describe_index_stats(self, **kwargs):
+        with self.lock:
+            return {"total_vector_count": len(self.vectors), "namespaces": {}}
+
+# ==================== BENCHMARK ====================
+
+def peak_rss_bytes():
+    """Peak resident set size of this process"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='sagaa-bench-')
+    profiles = {
+        "s3": ServiceProfile(args.s3_latency_ms, args.s3_latency_ms / 2),
+        "bedrock": ServiceProfile(args.bedrock_latency_ms, args.bedrock_latency_ms / 2,
+                                  args.bedrock_throttle_rate, args.bedrock_max_rps),
+        "pinecone": ServiceProfile(args.pinecone_latency_ms, args.pinecone_latency_ms / 2,
+                                   args.pinecone_throttle_rate),
+    }
+    clients = {
+        "s3": LocalS3(args.users, args.files_per_user, args.rows_per_file, args.seed, profiles["s3"]),
+        "bedrock": LocalBedrock(profiles["bedrock"]),
+    }
+    if args.embedding_backend == 'local':
+        clients["bedrock"] = indexer.LocalEmbeddingBackend()
+    if args.vector_store == 'local':
+        from local_vector_store import LocalVectorIndex
+        index = LocalVectorIndex(os.path.join(workdir, 'vectors'), indexer.EMBEDDING_DIMENSIONS)
+    else:
+        index = LocalPineconeIndex(profiles["pinecone"])
+
+    embedding_cache = indexer.EmbeddingCache(
+        path=os.path.join(workdir, 'embeddings.sqlite3'),
+        model_id=indexer.get_embedding_backend(clients["bedrock"], args.embedding_backend).model_id
+    )
+    category_stats = indexer.CategoryStatsStore(path=os.path.join(workdir, 'category_stats.sqlite3'))
+    manifest = {"objects": {}}
+    total_rows = args.users * args.files_per_user * args.rows_per_file
+
+    print(f"🏁 Benchmark: {args.users} users x {args.files_per_user} files x "
+          f"{args.rows_per_file} rows = {total_rows:,} transactions")
+
+    results = []
+    try:
+        for run in range(1, args.passes + 1):
+            if run > 1:
+                # Forget ETags so every file is re-read and diffed against the index
+                manifest = {"objects": {}}
+            started = time.time()
+            output = open(os.devnull, 'w') if args.quiet else sys.stdout
+            with contextlib.redirect_stdout(output):
+                stats = indexer.sync_prefix(
+                    clients, index, embedding_cache, manifest, '', category_stats=category_stats
+                )
+            if args.quiet:
+                output.close()
+            elapsed = time.time() - started
+
+            processed = stats["indexed"] + stats["unchanged"]
+            result = {
+                "pass": run,
+                "seconds": round(elapsed, 3),
+                "transactions": processed,
+                "upserted": stats["indexed"],
+                "unchanged": stats["unchanged"],
+                "transactions_per_second": round(processed / elapsed, 1) if elapsed else 0.0,
+                "failed_files": stats["failed_files"],
+                "stage_seconds": {stage: round(seconds, 3) for stage, seconds in stats["stage_seconds"].items()},
+                "blocked_seconds": {stage: round(seconds, 3) for stage, seconds in stats["blocked_seconds"].items()},
+                "peak_rss_mb": round(peak_rss_bytes() / 1024 ** 2, 1),
+                "cache_hits": embedding_cache.hits,
+                "cache_misses": embedding_cache.misses,
+                "calls": {name: profile.calls for name, profile in profiles.items()},
+                "throttled": {name: profile.throttled for name, profile in profiles.items()},
+            }
+            results.append(result)
+            print_result(result)
+    finally:
+        embedding_cache.close()
+        category_stats.close()
+        if hasattr(index, 'close'):
+            index.close()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+def print_result(result):
+    print("\n" + "="*60)
+    print(f"📊 PASS {result['pass']}")
+    print("="*60)
+    print(f"⏱️  Wall time: {result['seconds']:.2f}s")
+    print(f"🚀 Throughput: {result['transactions_per_second']:,.0f} transactions/s "
+          f"({result['upserted']:,} upserted, {result['unchanged']:,} unchanged)")
+    stages = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in result["stage_seconds"].items())
+    print(f"🧵 Stage busy time (summed over workers): {stages}")
+    blocked = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in result["blocked_seconds"].items())
+    print(f"⏳ Stage blocked time (full queue / limiter): {blocked}")
+    print(f"💾 Peak RSS: {result['peak_rss_mb']:.1f} MB")
+    print(f"🧠 Embedding cache: {result['cache_hits']} hits, {result['cache_misses']} misses")
+    calls = ", ".join(f"{name} {count}" for name, count in result["calls"].items())
+    throttled = ", ".join(f"{name} {count}" for name, count in result["throttled"].items())
+    print(f"📞 Calls: {calls} (throttled: {throttled})")
+    if result["failed_files"]:
+        print(f"❌ Failed files: {result['failed_files']}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the transaction indexer against local stand-ins")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--files-per-user', type=int, default=2)
+    parser.add_argument('--rows-per-file', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--passes', type=int, default=1,
+                        help="repeat the sync without the manifest; later passes measure the "
+                             "content-diff path (every row unchanged)")
+    parser.add_argument('--s3-latency-ms', type=float, default=15.0)
+    parser.add_argument('--bedrock-latency-ms', type=float, default=25.0)
+    parser.add_argument('--bedrock-throttle-rate', type=float, default=0.0)
+    parser.add_argument('--bedrock-max-rps', type=int, default=0, help="0 = unlimited")
+    parser.add_argument('--pinecone-latency-ms', type=float, default=30.0)
+    parser.add_argument('--pinecone-throttle-rate', type=float, default=0.0)
+    parser.add_argument('--embedding-backend', choices=['bedrock', 'local'], default='bedrock',
+                        help="bedrock: latency-simulating Bedrock stand-in; local: CPU hashed n-gram model")
+    parser.add_argument('--vector-store', choices=['stub', 'local'], default='stub',
+                        help="stub: latency-simulating Pinecone stand-in; local: LocalVectorIndex")
+    parser.add_argument('--quiet', action='store_true', help="silence per-file indexer output")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary work directory")
+    parser.add_argument('--json', help="write results to this file")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run_benchmark(args)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+        print(f"\n📝 Results written to {args.json}")
@@ -4,21 +4,181 @@ Indexes INDIVIDUAL transactions instead of document chunks
 Enables precise filtering by transaction type, category, date, etc.
 """
 
+import io
+import gzip
 import json
+import os
+import sqlite3
+import hashlib
+import codecs
+import re
+import bisect
+from array import array
 import boto3
+from botocore.exceptions import ConnectionError as BotoConnectionError, HTTPClientError
 from pinecone import Pinecone
 import time
-from datetime import datetime
+import random
+import math
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from datetime import datetime, date as date_cls
+from collections import Counter
 from decimal import Decimal
 
+try:
+    import zstandard
+except ImportError:  # optional dependency, only needed for zstd-compressed statements
+    zstandard = None
+
+from transaction_metadata_schema import encode_compact_metadata, COMPACT_METADATA_VERSION
+from statement_parsers import iter_transactions_from_csv_stream, iter_transactions_from_ofx_stream
+
 # ==================== CONFIGURATION ====================
 
 AWS_REGION = 'us-west-2'
 S3_BUCKET = 'sagaa-user-datalake'
 SECRET_NAME = 'sagga/pinecone/credentials'  # Fixed typo
 
-EMBEDDING_MODEL = 'amazon.titan-embed-text-v1'
-EMBEDDING_DIMENSIONS = 1536
+# One value for the whole stack (indexer, insight Lambdas, local store); the index must match.
+# Titan V1 is fixed at 1536; other sizes use Titan V2 (256, 512 or 1024) or the local backend.
+# Settings stored with the index pointer win (see use_index_embedding_settings)
+EMBEDDING_DIMENSIONS = int(os.environ.get('EMBEDDING_DIMENSIONS', 1536))
+EMBEDDING_MODEL = os.environ.get(
+    'EMBEDDING_MODEL',
+    'amazon.titan-embed-text-v1' if EMBEDDING_DIMENSIONS == 1536 else 'amazon.titan-embed-text-v2:0'
+)
+TITAN_V2_DIMENSIONS = (256, 512, 1024)
+
+# Embedding backend: 'bedrock' (Titan, one invoke_model per text) or 'local' (CPU hashed n-grams
+# in large batches, see local_embedding_model; for dev, CI and cost-sensitive backfills)
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'bedrock')
+
+# Concurrent embedding settings (Bedrock invoke_model)
+EMBEDDING_MAX_WORKERS = 16
+EMBEDDING_MIN_WORKERS = 1
+EMBEDDING_MAX_RETRIES = 5
+EMBEDDING_RETRY_BASE_DELAY = 0.5  # seconds, doubled on every retry
+EMBEDDING_RETRY_MAX_DELAY = 20.0
+
+# Content-addressed embedding cache (local SQLite LRU + optional S3 tier)
+EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', '.sagaa_embedding_cache.sqlite3')
+# Budget for the local database's live pages, shared by every process using the file
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get('EMBEDDING_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+EMBEDDING_CACHE_S3_BUCKET = os.environ.get('EMBEDDING_CACHE_S3_BUCKET', '')
+EMBEDDING_CACHE_S3_PREFIX = os.environ.get('EMBEDDING_CACHE_S3_PREFIX', 'embedding-cache/')
+
+# Offline bulk embedding (JSONL request/response shards + pluggable batch executor)
+BATCH_EMBEDDING_DIR = os.environ.get('BATCH_EMBEDDING_DIR', '.sagaa_batch_embeddings')
+BATCH_EMBEDDING_SHARD_SIZE = 50_000  # records per JSONL shard (Bedrock batch file limit)
+BATCH_EMBEDDING_EXECUTOR = os.environ.get('BATCH_EMBEDDING_EXECUTOR', 'local')  # 'local' or 'bedrock'
+BATCH_EMBEDDING_S3_BUCKET = os.environ.get('BATCH_EMBEDDING_S3_BUCKET', '')
+BATCH_EMBEDDING_S3_PREFIX = os.environ.get('BATCH_EMBEDDING_S3_PREFIX', 'batch-embeddings/')
+BATCH_EMBEDDING_ROLE_ARN = os.environ.get('BATCH_EMBEDDING_ROLE_ARN', '')
+BATCH_EMBEDDING_POLL_INTERVAL = 60  # seconds between batch job status checks
+
+# Calendar (date dimension) used for temporal metadata: years in this range are computed on
+# first use and cached; dates outside it are computed on every call
+DATE_DIMENSION_START_YEAR = 1990
+DATE_DIMENSION_END_YEAR = 2060
+
+# Transaction classifier rule table (JSON file overrides the built-in table)
+TRANSACTION_RULES_PATH = os.environ.get('TRANSACTION_RULES_PATH', '')
+
+# Vector store backend: 'pinecone' or 'local' (embedded store, see local_vector_store)
+VECTOR_STORE_BACKEND = os.environ.get('VECTOR_STORE_BACKEND', 'pinecone')
+
+# Recurring transaction detection (per source file, before indexing; series spread over
+# several files, e.g. one charge per monthly statement, are not detected)
+RECURRING_MIN_OCCURRENCES = 3  # distinct charge dates needed before a series counts
+RECURRING_AMOUNT_TOLERANCE = 0.15  # relative spread allowed within one amount band
+RECURRING_MIN_REGULARITY = 0.75  # share of gaps that must match the period
+RECURRING_FREQUENCIES = [  # (name, period in days, allowed deviation in days)
+    ("weekly", 7, 1),
+    ("biweekly", 14, 2),
+    ("monthly", 30.4, 4),
+    ("quarterly", 91, 10),
+    ("annual", 365, 20),
+]
+MERCHANT_NOISE_TOKENS = {
+    'pos', 'debit', 'credit', 'purchase', 'payment', 'card', 'recurring', 'ach',
+    'online', 'www', 'com', 'inc', 'llc', 'ltd', 'co', 'the',
+}
+
+# Per-user, per-category spending statistics (persisted between runs)
+CATEGORY_STATS_PATH = os.environ.get('CATEGORY_STATS_PATH', '.sagaa_category_stats.sqlite3')
+CATEGORY_STATS_MIN_SAMPLES = 10  # no large/unusual flags until a category has this history
+LARGE_PURCHASE_QUANTILE = 0.9  # at or above this quantile of the category -> large purchase
+LARGE_PURCHASE_MIN_AMOUNT = 50.0  # never call anything below this "large"
+UNUSUAL_ZSCORE = 3.0  # log-amount z-score above which a transaction is unusual
+
+# Cross-source duplicate detection (per-user fingerprints, persisted between runs)
+DEDUPE_PATH = os.environ.get('DEDUPE_PATH', '.sagaa_transaction_fingerprints.sqlite3')
+DEDUPE_DATE_WINDOW_DAYS = 3  # posting dates of one purchase differ this much between sources
+DEDUPE_AMOUNT_TOLERANCE_CENTS = 1  # rounding differences between exports
+
+# Columnar transaction lake (Parquet, see transaction_lake): local path or s3://bucket/prefix, '' = off
+TRANSACTION_LAKE_URI = os.environ.get('TRANSACTION_LAKE_URI', '')
+
+# Blue/green re-embedding migration: a shadow index is built next to the live one, then the
+# index pointer (PINECONE_INDEX_NAME in the Pinecone secret) is switched in one write
+MIGRATION_STATE_DIR = os.environ.get('MIGRATION_STATE_DIR', '.sagaa_migration')  # one subdirectory per migration
+MIGRATION_MAX_CATCH_UP_PASSES = 5  # passes until no object changed in S3 during the previous one
+MIGRATION_MAX_COUNT_DRIFT = float(os.environ.get('MIGRATION_MAX_COUNT_DRIFT', 0.02))  # vs the live index
+INDEX_POINTER_TTL = int(os.environ.get('INDEX_POINTER_TTL', 300))  # seconds readers cache the pointer
+
+# Pinecone metadata layout: 'full' (every field) or 'compact' (see transaction_metadata_schema)
+METADATA_LAYOUT = os.environ.get('METADATA_LAYOUT', 'full')
+
+# Bump when the derived metadata changes so existing vectors get rewritten
+VECTOR_ID_VERSION = 4
+PINECONE_FETCH_BATCH_SIZE = 1000
+
+# Streaming parse / chunked indexing
+S3_READ_CHUNK_SIZE = 256 * 1024  # bytes per StreamingBody read
+INDEX_CHUNK_SIZE = 1000  # transactions embedded and upserted together
+TRANSACTION_ARRAY_KEYS = ['transactions', 'data', 'records', 'items']
+STATEMENT_SUFFIXES = ('.json', '.csv', '.ofx', '.qfx')  # statement formats the indexer reads
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.gzip': 'gzip', '.zst': 'zstd', '.zstd': 'zstd'}
+CONTENT_ENCODINGS = {'gzip': 'gzip', 'x-gzip': 'gzip', 'zstd': 'zstd'}  # S3 Content-Encoding
+
+# Staged pipeline (list -> fetch/parse -> embed -> upsert)
+PIPELINE_FETCH_WORKERS = 4
+PIPELINE_EMBED_WORKERS = 4
+PIPELINE_UPSERT_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 8  # chunks buffered between stages
+
+# Incremental indexing manifest (key -> ETag, size, last indexed, vector ids)
+INDEX_MANIFEST_PATH = os.environ.get('INDEX_MANIFEST_PATH', '.sagaa_index_manifest.json')
+INDEX_MANIFEST_SAVE_EVERY = 25  # files
+
+# Sharded all-users mode: one process per shard, resumable via a SQLite journal
+INDEX_PROCESSES = int(os.environ.get('INDEX_PROCESSES', os.cpu_count() or 1))
+INDEX_JOURNAL_PATH = os.environ.get('INDEX_JOURNAL_PATH', '.sagaa_index_journal.sqlite3')
+PINECONE_DELETE_BATCH_SIZE = 1000
+
+# Pinecone upsert engine
+UPSERT_MAX_BATCH_BYTES = 1_800_000  # stay under Pinecone's 2 MB request limit
+UPSERT_MAX_BATCH_VECTORS = 1000
+UPSERT_MAX_WORKERS = 4
+UPSERT_MAX_RETRIES = 6
+UPSERT_RETRY_BASE_DELAY = 0.5  # seconds, doubled on every rate-limited retry
+INDEX_STATS_POLL_INTERVAL = 0.5  # seconds between describe_index_stats polls
+INDEX_STATS_TIMEOUT = 30.0
+
+THROTTLING_ERROR_CODES = {
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'ServiceUnavailableException',
+    'ModelNotReadyException',
+}
+
+# Transient failures worth retrying; anything else (validation, access, bad input) fails at once
+RETRYABLE_EMBEDDING_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    'InternalServerException',
+    'ModelTimeoutException',
+}
 
 # ==================== AWS CLIENTS ====================
 
@@ -35,31 +195,502 @@ def get_pinecone_credentials(secrets_client):
     response = secrets_client.get_secret_value(SecretId=SECRET_NAME)
     return json.loads(response['SecretString'])
 
+def put_pinecone_credentials(secrets_client, credentials):
+    """
+    Replace the Pinecone secret, which doubles as the index pointer
+    One put_secret_value call: readers see either the old or the new version, never a mix
+    """
+    secrets_client.put_secret_value(SecretId=SECRET_NAME, SecretString=json.dumps(credentials))
+
 # ==================== EMBEDDING GENERATION ====================
 
+def is_titan_v2(model_id=None):
+    return 'titan-embed-text-v2' in (model_id or EMBEDDING_MODEL)
+
+def embedding_model_input(text, model_id=None, dimensions=None):
+    """Bedrock request body for one text (Titan V2 is told the output size)"""
+    if is_titan_v2(model_id):
+        return {"inputText": text, "dimensions": dimensions or EMBEDDING_DIMENSIONS, "normalize": True}
+    return {"inputText": text}
+
+def validate_embedding_dimensions(model_id=None, dimensions=None):
+    """Raise ValueError if the Bedrock model cannot produce `dimensions`-long embeddings"""
+    model_id = model_id or EMBEDDING_MODEL
+    dimensions = dimensions or EMBEDDING_DIMENSIONS
+    if is_titan_v2(model_id):
+        if dimensions not in TITAN_V2_DIMENSIONS:
+            raise ValueError(f"{model_id} supports {TITAN_V2_DIMENSIONS} dimensions, not {dimensions}")
+    elif dimensions != 1536:
+        raise ValueError(f"{model_id} only produces 1536 dimensions; use Titan V2 for {dimensions}")
+
+def index_embedding_settings():
+    """This process's embedding model and dimensions, as stored with the index pointer"""
+    return {"EMBEDDING_MODEL": EMBEDDING_MODEL, "EMBEDDING_DIMENSIONS": EMBEDDING_DIMENSIONS}
+
+def use_index_embedding_settings(pointer):
+    """
+    Adopt the embedding model/dimensions stored with the index pointer
+    Every writer must embed the way the live index was built: after a blue/green switch this
+    moves warm writers (the S3-event Lambda) to the new settings without a redeploy.
+    Pointers without stored settings leave the configured ones in place.
+    """
+    global EMBEDDING_MODEL, EMBEDDING_DIMENSIONS
+    
+    model_id = pointer.get('EMBEDDING_MODEL')
+    dimensions = pointer.get('EMBEDDING_DIMENSIONS')
+    if not model_id or not dimensions:
+        return
+    dimensions = int(dimensions)
+    if (model_id, dimensions) != (EMBEDDING_MODEL, EMBEDDING_DIMENSIONS):
+        validate_embedding_dimensions(model_id, dimensions)
+        print(f"🔧 Using the index's embedding settings: {model_id} ({dimensions} dims) "
+              f"instead of {EMBEDDING_MODEL} ({EMBEDDING_DIMENSIONS} dims)")
+        EMBEDDING_MODEL, EMBEDDING_DIMENSIONS = model_id, dimensions
+
+def invoke_embedding_model(text, bedrock_client):
+    """
+    Call Bedrock once for a single text and return the validated embedding
+    Embeddings are float32 arrays (~6 KB each instead of ~50 KB as a list of Python floats);
+    they stay that way through the cache and the pipeline until upsert serializes them.
+    """
+    request_body = json.dumps(embedding_model_input(text))
+    
+    response = bedrock_client.invoke_model(
+        modelId=EMBEDDING_MODEL,
+        body=request_body,
+        contentType='application/json',
+        accept='application/json'
+    )
+    
+    response_body = json.loads(response['body'].read())
+    embedding = response_body.get('embedding')
+    
+    if not embedding or len(embedding) != EMBEDDING_DIMENSIONS:
+        raise ValueError(f"Invalid embedding dimensions: {len(embedding or [])}")
+    
+    return array('f', embedding)
+
 def generate_embedding(text, bedrock_client):
     """Generate embedding using Amazon Titan V1"""
     try:
-        request_body = json.dumps({"inputText": text})
+        return invoke_embedding_model(text, bedrock_client)
+    except Exception as e:
+        print(f"❌ Error generating embedding: {e}")
+        raise
+
+def is_throttling_error(error):
+    """True if a boto3 ClientError means Bedrock is asking us to slow down"""
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code', '')
+    return code in THROTTLING_ERROR_CODES
+
+def is_retryable_embedding_error(error):
+    """True if a Bedrock call may succeed when retried (throttling, 5xx, dropped connection)"""
+    if isinstance(error, (BotoConnectionError, HTTPClientError)):
+        return True
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code', '')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    return code in RETRYABLE_EMBEDDING_ERROR_CODES or status >= 500
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limit on in-flight calls to a rate-limited service (Bedrock, Pinecone)
+    Halves the limit on throttling, grows it by one after a full window of successes
+    """
+    
+    def __init__(self, max_limit, min_limit=EMBEDDING_MIN_WORKERS, name='Bedrock'):
+        self.name = name
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = self.max_limit
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+    
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+    
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+    
+    def on_success(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+    
+    def on_throttle(self):
+        with self.condition:
+            new_limit = max(self.min_limit, self.limit // 2)
+            if new_limit < self.limit:
+                print(f"⚠️  {self.name} throttling - reducing concurrency to {new_limit}")
+            self.limit = new_limit
+            self.successes = 0
+
+class LimiterStallClock:
+    """
+    One caller's view of a shared AdaptiveConcurrencyLimiter that clocks its stalls: wall
+    time with calls queued for a slot and none of its own in flight
+    """
+    
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.in_flight = 0
+        self.stalled_since = None
+        self.blocked_seconds = 0.0
+    
+    def __getattr__(self, name):
+        return getattr(self.limiter, name)
+    
+    def _tick(self):
+        now = time.time()
+        if self.stalled_since is not None:
+            self.blocked_seconds += now - self.stalled_since
+        self.stalled_since = now if self.waiting and not self.in_flight else None
+    
+    def acquire(self):
+        with self.lock:
+            self.waiting += 1
+            self._tick()
+        self.limiter.acquire()
+        with self.lock:
+            self.waiting -= 1
+            self.in_flight += 1
+            self._tick()
+    
+    def release(self):
+        self.limiter.release()
+        with self.lock:
+            self.in_flight -= 1
+            self._tick()
+
+def _embed_with_retry(text, bedrock_client, limiter, max_retries):
+    """Embed one text, retrying this item only (with backoff) on transient failures"""
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            embedding = invoke_embedding_model(text, bedrock_client)
+        except Exception as e:
+            if is_throttling_error(e):
+                limiter.on_throttle()
+            if attempt >= max_retries or not is_retryable_embedding_error(e):
+                raise
+        else:
+            limiter.on_success()
+            return embedding
+        finally:
+            limiter.release()
         
-        response = bedrock_client.invoke_model(
-            modelId=EMBEDDING_MODEL,
-            body=request_body,
-            contentType='application/json',
-            accept='application/json'
-        )
+        # Back off without holding a slot, then queue for one again
+        attempt += 1
+        delay = min(EMBEDDING_RETRY_MAX_DELAY, EMBEDDING_RETRY_BASE_DELAY * (2 ** (attempt - 1)))
+        time.sleep(random.uniform(delay / 2, delay))
+
+def generate_embeddings_concurrently(texts, bedrock_client, max_workers=EMBEDDING_MAX_WORKERS,
+                                     max_retries=EMBEDDING_MAX_RETRIES, limiter=None):
+    """
+    Generate embeddings for many texts with a bounded, throttle-aware worker pool
+    Pass a shared `limiter` to cap in-flight calls across concurrent callers
+    Returns a list aligned with `texts`; items that still fail after retries are None
+    """
+    results = [None] * len(texts)
+    if not texts:
+        return results
+    
+    if limiter is None:
+        limiter = AdaptiveConcurrencyLimiter(min(max_workers, len(texts)))
+    completed = 0
+    failed = 0
+    
+    with ThreadPoolExecutor(max_workers=limiter.max_limit) as executor:
+        futures = {
+            executor.submit(_embed_with_retry, text, bedrock_client, limiter, max_retries): position
+            for position, text in enumerate(texts)
+        }
+        
+        for future in as_completed(futures):
+            position = futures[future]
+            try:
+                results[position] = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"❌ Error generating embedding for item {position}: {e}")
+            
+            completed += 1
+            if completed % 100 == 0:
+                print(f"✅ Embedded {completed}/{len(texts)} transactions "
+                      f"(concurrency {limiter.limit})")
+    
+    if failed:
+        print(f"⚠️  {failed}/{len(texts)} embeddings failed after {max_retries} retries")
+    
+    return results
+
+class BedrockEmbeddingBackend:
+    """Titan embeddings over Bedrock: one text per call, many calls in flight"""
+    
+    def __init__(self, bedrock_client):
+        validate_embedding_dimensions()
+        self.bedrock_client = bedrock_client
+        # Titan V2 output size is part of the cache namespace
+        self.model_id = f"{EMBEDDING_MODEL}-{EMBEDDING_DIMENSIONS}" if is_titan_v2() else EMBEDDING_MODEL
+    
+    def embed_many(self, texts, limiter=None):
+        return generate_embeddings_concurrently(texts, self.bedrock_client, limiter=limiter)
+
+class LocalEmbeddingBackend:
+    """CPU embeddings from local_embedding_model, hundreds of texts per call, no network"""
+    
+    def __init__(self, dimensions=None):
+        from local_embedding_model import HashedNgramEmbedder, LOCAL_EMBEDDING_BATCH_SIZE
+        self.model = HashedNgramEmbedder(dimensions or EMBEDDING_DIMENSIONS)
+        self.model_id = self.model.model_id
+        self.batch_size = LOCAL_EMBEDDING_BATCH_SIZE
+    
+    def embed_many(self, texts, limiter=None):
+        results = []
+        for start in range(0, len(texts), self.batch_size):
+            results.extend(self.model.embed_batch(texts[start:start + self.batch_size]))
+        return results
+
+def get_embedding_backend(bedrock_client, name=EMBEDDING_BACKEND):
+    """
+    Backend selected by EMBEDDING_BACKEND
+    Callers pass clients['bedrock'] around; a backend passed in its place is used as is.
+    Each backend has a model_id (embedding cache namespace) and embed_many(texts, limiter),
+    which returns a list aligned with `texts` (None for items that failed)
+    """
+    if isinstance(bedrock_client, (BedrockEmbeddingBackend, LocalEmbeddingBackend)):
+        return bedrock_client
+    if name == 'local':
+        return LocalEmbeddingBackend()
+    return BedrockEmbeddingBackend(bedrock_client)
+
+# ==================== EMBEDDING CACHE ====================
+
+def embedding_cache_key(text, model_id=None):
+    """Content address for an embedding: sha256 of model id + embedding text"""
+    return hashlib.sha256(f"{model_id or EMBEDDING_MODEL}\n{text}".encode('utf-8')).hexdigest()
+
+def pack_embedding(embedding):
+    """Serialize an embedding as raw float32 bytes"""
+    if isinstance(embedding, array) and embedding.typecode == 'f':
+        return embedding.tobytes()
+    return array('f', embedding).tobytes()
+
+def unpack_embedding(blob):
+    """Deserialize raw float32 bytes back into a float32 array (no per-element copy)"""
+    values = array('f')
+    values.frombytes(blob)
+    return values
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache keyed by embedding_cache_key()
+    Local tier is a size-bounded LRU in SQLite; optional S3 tier is shared across machines
+    """
+    
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_BYTES,
+                 s3_client=None, s3_bucket=EMBEDDING_CACHE_S3_BUCKET,
+                 s3_prefix=EMBEDDING_CACHE_S3_PREFIX, model_id=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.s3_client = s3_client if s3_bucket else None
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+        # Vectors of different models never share cache entries
+        self.model_id = model_id or get_embedding_backend(None).model_id
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
         
-        response_body = json.loads(response['body'].read())
-        embedding = response_body.get('embedding')
+        # WAL + busy timeout: several indexer processes may share one cache file
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings (last_used)")
+        self.conn.commit()
+    
+    def key_for(self, text):
+        return embedding_cache_key(text, self.model_id)
+    
+    def _s3_key(self, key):
+        return f"{self.s3_prefix}{self.model_id}/{key[:2]}/{key}.f32"
+    
+    def _get_local(self, keys):
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update(rows)
+            
+            if found:
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self.conn.commit()
         
-        if not embedding or len(embedding) != EMBEDDING_DIMENSIONS:
-            raise ValueError(f"Invalid embedding dimensions: {len(embedding)}")
+        return {key: unpack_embedding(blob) for key, blob in found.items()}
+    
+    def _get_s3(self, key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self._s3_key(key))
+            return unpack_embedding(response['Body'].read())
+        except Exception:
+            return None
+    
+    def _put_local(self, items):
+        now = time.time()
+        with self.lock:
+            for key, embedding in items.items():
+                blob = pack_embedding(embedding)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)",
+                    (key, blob, len(blob), now)
+                )
+            self._evict()
+            self.conn.commit()
+    
+    def _local_bytes(self):
+        """Bytes of the database in use (pages not on the freelist), every writer's rows included"""
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - free_pages) * page_size
+    
+    def _evict(self):
+        """
+        Drop least recently used entries until the local tier fits max_bytes
+        The size is read from the database inside the write transaction, not counted by this
+        process, so processes sharing the file stay within one budget between them
+        """
+        while self._local_bytes() > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key FROM embeddings ORDER BY last_used ASC LIMIT 500"
+            ).fetchall()
+            if not rows:
+                break
+            self.conn.executemany("DELETE FROM embeddings WHERE key = ?", rows)
+    
+    def has_many(self, keys):
+        """Subset of `keys` present in the local tier (no LRU update, no S3 lookups)"""
+        keys = list(keys)
+        present = set()
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                present.update(row[0] for row in rows)
+        return present
+    
+    def get_many(self, keys):
+        """Look up keys in the local tier, then S3; returns {key: embedding} for hits"""
+        keys = list(keys)
+        found = self._get_local(keys)
         
-        return embedding
+        missing = [key for key in keys if key not in found]
+        if missing and self.s3_client:
+            with ThreadPoolExecutor(max_workers=EMBEDDING_MAX_WORKERS) as executor:
+                for key, embedding in zip(missing, executor.map(self._get_s3, missing)):
+                    if embedding is not None:
+                        found[key] = embedding
+            promoted = {key: found[key] for key in missing if key in found}
+            if promoted:
+                self._put_local(promoted)
         
-    except Exception as e:
-        print(f"❌ Error generating embedding: {e}")
-        raise
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+    
+    def put_many(self, items):
+        """Store {key: embedding} in the local tier and, if configured, S3"""
+        if not items:
+            return
+        self._put_local(items)
+        
+        if self.s3_client:
+            def upload(entry):
+                key, embedding = entry
+                try:
+                    self.s3_client.put_object(
+                        Bucket=self.s3_bucket, Key=self._s3_key(key), Body=pack_embedding(embedding)
+                    )
+                except Exception as e:
+                    print(f"⚠️  Warning: Could not write embedding to S3 cache: {e}")
+            
+            with ThreadPoolExecutor(max_workers=EMBEDDING_MAX_WORKERS) as executor:
+                list(executor.map(upload, items.items()))
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def generate_embeddings_cached(texts, bedrock_client, cache=None, limiter=None):
+    """
+    Embed texts with in-batch de-duplication and an optional EmbeddingCache
+    Only texts never seen before reach the embedding backend; returns a list aligned with `texts`
+    """
+    if not texts:
+        return []
+    
+    # Collapse identical texts first
+    unique_texts = list(dict.fromkeys(texts))
+    
+    embeddings_by_text = {}
+    keys_by_text = {}
+    if cache is not None:
+        keys_by_text = {text: cache.key_for(text) for text in unique_texts}
+        cached = cache.get_many(keys_by_text.values())
+        for text, key in keys_by_text.items():
+            if key in cached:
+                embeddings_by_text[text] = cached[key]
+    
+    pending = [text for text in unique_texts if text not in embeddings_by_text]
+    print(f"🧠 Embeddings: {len(texts)} texts, {len(unique_texts)} unique, "
+          f"{len(unique_texts) - len(pending)} cached, {len(pending)} to generate")
+    
+    backend = get_embedding_backend(bedrock_client)
+    fresh = backend.embed_many(pending, limiter=limiter) if pending else []
+    
+    new_entries = {}
+    for text, embedding in zip(pending, fresh):
+        if embedding is None:
+            continue
+        embeddings_by_text[text] = embedding
+        if cache is not None:
+            new_entries[keys_by_text[text]] = embedding
+    
+    if cache is not None:
+        cache.put_many(new_entries)
+    
+    return [embeddings_by_text.get(text) for text in texts]
 
 # ==================== TRANSACTION PARSING ====================
 
@@ -77,7 +708,7 @@ def parse_transactions_from_json(content, file_key):
             transactions = data
         elif isinstance(data, dict):
             # Look for common transaction array keys
-            for key in ['transactions', 'data', 'records', 'items']:
+            for key in TRANSACTION_ARRAY_KEYS:
                 if key in data and isinstance(data[key], list):
                     transactions = data[key]
                     break
@@ -92,6 +723,182 @@ def parse_transactions_from_json(content, file_key):
         print(f"❌ Error parsing transactions: {e}")
         return []
 
+class _JsonStreamReader:
+    """Incrementally decoded text buffer over a file-like byte stream"""
+    
+    def __init__(self, body, chunk_size=S3_READ_CHUNK_SIZE):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+    
+    def _fill(self):
+        """Read one more chunk; returns False at end of stream"""
+        if self.eof:
+            return False
+        chunk = self.body.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.buf += self.decoder.decode(b'', final=True)
+            return False
+        # Drop consumed text so the buffer never holds more than the current value
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        self.buf += self.decoder.decode(chunk)
+        return True
+    
+    def peek(self):
+        """Next non-whitespace character (without consuming it), '' at end"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+    
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expected '{char}'", self.buf, self.pos)
+        self.pos += 1
+    
+    def value(self):
+        """Decode one complete JSON value, reading more input until it is whole"""
+        if self.peek() not in '{["':
+            # A bare number/literal is only complete once its delimiter is buffered
+            while not any(c in ',]} \t\r\n' for c in self.buf[self.pos:]) and self._fill():
+                pass
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            self.pos = end
+            return value
+    
+    def array_items(self):
+        """Yield elements of the array starting at the current position"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise json.JSONDecodeError("Expected ',' or ']'", self.buf, self.pos - 1)
+
+def iter_transactions_from_json_stream(body, file_key, chunk_size=S3_READ_CHUNK_SIZE):
+    """
+    Streaming counterpart of parse_transactions_from_json
+    Reads a file-like body (e.g. S3 StreamingBody) incrementally and yields one transaction
+    at a time, so memory stays bounded by the largest single transaction.
+    Accepts a bare list or an object holding the list under one of TRANSACTION_ARRAY_KEYS;
+    if an object holds several candidate lists, the first one in the document is used.
+    """
+    reader = _JsonStreamReader(body, chunk_size)
+    count = 0
+    
+    try:
+        first = reader.peek()
+        
+        if first == '[':
+            for txn in reader.array_items():
+                count += 1
+                yield txn
+        
+        elif first == '{':
+            reader.expect('{')
+            found = False
+            while reader.peek() != '}':
+                key = reader.value()
+                reader.expect(':')
+                if not found and key in TRANSACTION_ARRAY_KEYS and reader.peek() == '[':
+                    found = True
+                    for txn in reader.array_items():
+                        count += 1
+                        yield txn
+                else:
+                    reader.value()  # skip non-transaction value
+                if reader.peek() == ',':
+                    reader.pos += 1
+        
+        print(f"📊 Streamed {count} transactions from {file_key}")
+    
+    except json.JSONDecodeError as e:
+        print(f"❌ JSON parse error in {file_key} after {count} transactions: {e}")
+        raise
+
+def split_compression_suffix(file_key):
+    """(key without its compression suffix, 'gzip' | 'zstd' | None)"""
+    base, suffix = os.path.splitext(file_key)
+    compression = COMPRESSION_SUFFIXES.get(suffix.lower())
+    return (base, compression) if compression else (file_key, None)
+
+def is_statement_key(file_key):
+    """True for statement files the indexer can read, compressed or not"""
+    return split_compression_suffix(file_key)[0].lower().endswith(STATEMENT_SUFFIXES)
+
+def open_decompressed_body(body, file_key, content_encoding=None):
+    """
+    Wrap an S3 body so reads return decompressed bytes
+    The codec comes from the key suffix (.gz, .zst) or the object's Content-Encoding;
+    decompression streams in step with the parser, so nothing is buffered whole.
+    """
+    compression = split_compression_suffix(file_key)[1]
+    if compression is None:
+        encoding = (content_encoding or '').split(',')[0].strip().lower()
+        compression = CONTENT_ENCODINGS.get(encoding)
+    
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=body, mode='rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError(f"zstandard is required to read zstd-compressed {file_key}")
+        return zstandard.ZstdDecompressor().stream_reader(body, read_across_frames=True)
+    return body
+
+def statement_format(file_key):
+    """'json', 'csv' or 'ofx' (OFX and QFX) from an object key (compression suffix ignored)"""
+    suffix = os.path.splitext(split_compression_suffix(file_key)[0])[1].lower()
+    if suffix == '.csv':
+        return 'csv'
+    if suffix in ('.ofx', '.qfx'):
+        return 'ofx'
+    return 'json'
+
+def iter_transactions_from_stream(body, file_key, chunk_size=S3_READ_CHUNK_SIZE):
+    """Stream transactions out of any supported statement format (chosen by the key suffix)"""
+    statement = statement_format(file_key)
+    if statement == 'csv':
+        return iter_transactions_from_csv_stream(body, file_key, chunk_size)
+    if statement == 'ofx':
+        return iter_transactions_from_ofx_stream(body, file_key, chunk_size)
+    return iter_transactions_from_json_stream(body, file_key, chunk_size)
+
+def iter_transactions_from_s3(s3_client, bucket, key, chunk_size=S3_READ_CHUNK_SIZE):
+    """
+    Open an S3 object and stream its transactions without reading the whole body
+    gzip/zstd objects are decompressed on the fly (see open_decompressed_body)
+    """
+    print(f"📖 Streaming s3://{bucket}/{key}")
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    body = response['Body']
+    try:
+        stream = open_decompressed_body(body, key, response.get('ContentEncoding'))
+        yield from iter_transactions_from_stream(stream, key, chunk_size)
+    finally:
+        body.close()
+
 def create_transaction_text(transaction, source_type):
     """
     Create searchable text representation of a transaction
@@ -138,187 +945,1185 @@ def normalize_amount(amount):
             return 0.0
     return 0.0
 
+def _compute_date_metadata(date_obj):
+    """All temporal fields for one calendar day"""
+    return {
+        "timestamp": int(date_obj.timestamp()),
+        "year": date_obj.year,
+        "month": date_obj.month,
+        "day": date_obj.day,
+        
+        # New temporal fields
+        "day_of_week": date_obj.strftime('%A'),
+        "day_of_week_num": date_obj.weekday(),  # 0=Monday
+        "week_of_month": (date_obj.day - 1) // 7 + 1,
+        "week_of_year": date_obj.isocalendar()[1],
+        "quarter": f"Q{(date_obj.month - 1) // 3 + 1}",
+        "is_weekend": date_obj.weekday() >= 5,
+        "is_month_start": date_obj.day <= 7,
+        "is_month_end": date_obj.day > 23,  # Last week of month
+    }
+
+UNKNOWN_DATE_METADATA = {
+    "timestamp": 0,
+    "year": 0,
+    "month": 0,
+    "day": 0,
+    "day_of_week": "unknown",
+    "day_of_week_num": -1,
+    "week_of_month": 0,
+    "week_of_year": 0,
+    "quarter": "unknown",
+    "is_weekend": False,
+    "is_month_start": False,
+    "is_month_end": False,
+}
+
+_date_dimension = {}  # year -> {'YYYY-MM-DD': row}
+_date_dimension_lock = threading.Lock()
+
+def date_dimension_year(year):
+    """Temporal rows of one calendar year keyed by 'YYYY-MM-DD', built on first use (~365 rows)"""
+    rows = _date_dimension.get(year)
+    if rows is not None:
+        return rows
+    
+    with _date_dimension_lock:
+        rows = _date_dimension.get(year)
+        if rows is None:
+            rows = {}
+            first = date_cls(year, 1, 1).toordinal()
+            for ordinal in range(first, date_cls(year, 12, 31).toordinal() + 1):
+                day = date_cls.fromordinal(ordinal)
+                rows[day.isoformat()] = _compute_date_metadata(datetime(day.year, day.month, day.day))
+            _date_dimension[year] = rows
+    return rows
+
+def _lookup_date_metadata(date_str):
+    """Shared (read-only) temporal row for a date string, or None if it cannot be parsed"""
+    year = date_str[:4]
+    if year.isdigit() and DATE_DIMENSION_START_YEAR <= int(year) <= DATE_DIMENSION_END_YEAR:
+        row = date_dimension_year(int(year)).get(date_str)
+        if row is not None:
+            return row
+    
+    # Outside the cached range (or unusual formatting): compute directly
+    try:
+        return _compute_date_metadata(datetime.strptime(date_str, '%Y-%m-%d'))
+    except Exception as e:
+        # Graceful degradation - return minimal metadata
+        print(f"⚠️ Warning: Could not parse date {date_str}: {e}")
+        return None
+
 def parse_date_metadata(date_str):
     """
     Extract rich temporal metadata from transaction date
     Returns dict with all temporal fields, gracefully handles errors
+    Served from the date dimension in O(1) for dates in cached years
     """
-    try:
-        date_obj = datetime.strptime(date_str, '%Y-%m-%d')
+    row = _lookup_date_metadata(date_str)
+    if row is None:
+        return dict(UNKNOWN_DATE_METADATA)
+    return dict(row)
+
+def parse_date_metadata_batch(date_strings):
+    """
+    Temporal metadata for a whole file at once: one lookup per distinct date
+    Returns a list aligned with `date_strings`; rows are shared and must not be mutated
+    """
+    rows_by_date = {}
+    for date_str in set(date_strings):
+        rows_by_date[date_str] = _lookup_date_metadata(date_str) or UNKNOWN_DATE_METADATA
+    return [rows_by_date[date_str] for date_str in date_strings]
+
+# Versioned rule table for detect_transaction_type / TransactionClassifier.
+# keyword_rules: substring matches on the lowercased fields listed in "fields".
+# category_rules: exact matches on the lowercased category.
+TRANSACTION_RULES = {
+    "version": 1,
+    "keyword_rules": [
+        {"signal": "income_keyword", "fields": ["description"],
+         "keywords": ['payroll', 'direct deposit']},
+        # Subscription detection (common patterns)
+        {"signal": "subscription_keyword", "fields": ["description", "merchant"],
+         "keywords": ['netflix', 'spotify', 'hulu', 'disney', 'amazon prime',
+                      'apple music', 'youtube premium', 'gym', 'membership',
+                      'subscription', 'monthly fee', 'annual fee']},
+        # Bill detection
+        {"signal": "bill_keyword", "fields": ["description", "merchant"],
+         "keywords": ['electric', 'gas', 'water', 'internet', 'phone', 'insurance',
+                      'rent', 'mortgage', 'utilities', 'bill payment']},
+        {"signal": "transfer_keyword", "fields": ["description"],
+         "keywords": ['transfer', 'xfer']},
+        {"signal": "refund_keyword", "fields": ["description"],
+         "keywords": ['refund', 'return']},
+    ],
+    "category_rules": {
+        "income_categories": ['salary', 'paycheck', 'income', 'deposit', 'refund'],
+        "transfer_categories": ['transfer', 'internal transfer', 'credit_card_payment', 'investment'],
+        "refund_categories": ['refund'],
+        "essential_categories": ['groceries', 'utilities', 'rent', 'mortgage', 'insurance',
+                                 'healthcare', 'gas', 'transportation'],
+    },
+}
+
+class TransactionClassifier:
+    """
+    All keyword rules compiled once into a single multi-pattern matcher
+    One regex scan finds every keyword occurrence (overlapping ones included: each
+    keyword also implies the rules of any keyword it contains), so the cost no longer
+    grows with the number of keywords. classify_batch scans a whole chunk in one pass.
+    """
+    
+    FIELDS = ("description", "merchant")
+    
+    def __init__(self, rules=TRANSACTION_RULES):
+        self.version = rules.get("version", 0)
+        
+        # keyword -> {(signal, field), ...}
+        tags = {}
+        for rule in rules["keyword_rules"]:
+            for keyword in rule["keywords"]:
+                keyword = keyword.lower()
+                for field in rule["fields"]:
+                    tags.setdefault(keyword, set()).add((rule["signal"], field))
+        
+        # A match of a long keyword implies every keyword inside it matched too.
+        # Stored per field: field -> keyword -> signals
+        self.keyword_signals = {field: {} for field in self.FIELDS}
+        for keyword in tags:
+            implied = set()
+            for other, other_tags in tags.items():
+                if other in keyword:
+                    implied |= other_tags
+            for field in self.FIELDS:
+                self.keyword_signals[field][keyword] = frozenset(
+                    signal for signal, signal_field in implied if signal_field == field
+                )
+        
+        # Keywords merged into a prefix trie, compiled as one regex: at each position the
+        # automaton follows a single branch and reports the longest keyword found there
+        trie = {}
+        for keyword in tags:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[""] = True
+        self.pattern = re.compile("(?=(" + self._trie_pattern(trie) + "))") if tags else None
+        
+        category_rules = rules["category_rules"]
+        self.income_categories = frozenset(category_rules.get("income_categories", []))
+        self.transfer_categories = frozenset(category_rules.get("transfer_categories", []))
+        self.refund_categories = frozenset(category_rules.get("refund_categories", []))
+        self.essential_categories = frozenset(category_rules.get("essential_categories", []))
+    
+    @classmethod
+    def _trie_pattern(cls, node):
+        """Regex for a trie node; optional (greedy) suffixes prefer the longest keyword"""
+        branches = [
+            re.escape(char) + cls._trie_pattern(child)
+            for char, child in sorted(node.items()) if char
+        ]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            return "(?:" + pattern + ")?"
+        return pattern
+    
+    def _signals(self, description_lower, merchant_lower):
+        signals = set()
+        if self.pattern is None:
+            return signals
+        for field, text in (("description", description_lower), ("merchant", merchant_lower)):
+            field_signals = self.keyword_signals[field]
+            for keyword in self.pattern.findall(text):
+                signals |= field_signals[keyword]
+        return signals
+    
+    def _batch_signals(self, descriptions, merchants):
+        """Keyword signals for many transactions from one scan over a joined text"""
+        parts = []
+        starts = []
+        fields = []
+        position = 0
+        for description, merchant in zip(descriptions, merchants):
+            for field, text in (("description", description), ("merchant", merchant)):
+                # Lowercase before measuring: lower() can change a string's length (e.g. "İ")
+                text = text.lower()
+                starts.append(position)
+                fields.append(field)
+                parts.append(text)
+                position += len(text) + 1
+        # NUL separators keep keywords from matching across transactions
+        joined = "\0".join(parts)
+        
+        signals = [set() for _ in descriptions]
+        if self.pattern is None:
+            return signals
+        
+        for match in self.pattern.finditer(joined):
+            segment = bisect.bisect_right(starts, match.start()) - 1
+            signals[segment // 2] |= self.keyword_signals[fields[segment]][match.group(1)]
+        return signals
+    
+    def _flags(self, signals, category_lower, amount):
+        # Income detection
+        is_income = (
+            amount > 0 or
+            category_lower in self.income_categories or
+            "income_keyword" in signals
+        )
+        
+        is_subscription = "subscription_keyword" in signals
+        is_bill = "bill_keyword" in signals
+        
+        # Transfer detection
+        is_transfer = (
+            "transfer_keyword" in signals or
+            category_lower in self.transfer_categories
+        )
+        
+        # Refund detection
+        is_refund = (
+            amount > 0 and (
+                "refund_keyword" in signals or
+                category_lower in self.refund_categories
+            )
+        )
+        
+        # Discretionary vs Essential
+        is_discretionary = category_lower not in self.essential_categories
+        
+        # Should affect budget (exclude transfers, some refunds)
+        affects_budget = not (is_transfer or (is_refund and amount > 100))
         
         return {
-            "timestamp": int(date_obj.timestamp()),
-            "year": date_obj.year,
-            "month": date_obj.month,
-            "day": date_obj.day,
+            "is_income": is_income,
+            "is_subscription": is_subscription,
+            "is_bill": is_bill,
+            "is_transfer": is_transfer,
+            "is_refund": is_refund,
+            "is_discretionary": is_discretionary,
+            "affects_budget": affects_budget,
             
-            # New temporal fields
-            "day_of_week": date_obj.strftime('%A'),
-            "day_of_week_num": date_obj.weekday(),  # 0=Monday
-            "week_of_month": (date_obj.day - 1) // 7 + 1,
-            "week_of_year": date_obj.isocalendar()[1],
-            "quarter": f"Q{(date_obj.month - 1) // 3 + 1}",
-            "is_weekend": date_obj.weekday() >= 5,
-            "is_month_start": date_obj.day <= 7,
-            "is_month_end": date_obj.day > 23,  # Last week of month
-        }
-    except Exception as e:
-        # Graceful degradation - return minimal metadata
-        print(f"⚠️ Warning: Could not parse date {date_str}: {e}")
-        return {
-            "timestamp": 0,
-            "year": 0,
-            "month": 0,
-            "day": 0,
-            "day_of_week": "unknown",
-            "day_of_week_num": -1,
-            "week_of_month": 0,
-            "week_of_year": 0,
-            "quarter": "unknown",
-            "is_weekend": False,
-            "is_month_start": False,
-            "is_month_end": False,
+            # Placeholders for future analysis
+            "is_recurring": False,  # Will be detected via pattern analysis
+            "recurring_frequency": None,
+            "is_large_purchase": False,  # Will be set based on category average
+            "is_unusual": False,  # Will be set via anomaly detection
         }
+    
+    def classify(self, category, merchant, description, amount):
+        """Behavioral flags for one transaction"""
+        signals = self._signals(description.lower(), merchant.lower())
+        return self._flags(signals, category.lower(), amount)
+    
+    def classify_batch(self, records):
+        """
+        Behavioral flags for many transactions in one pass
+        `records` are dicts with category, merchant, description and amount
+        """
+        signals = self._batch_signals(
+            [record["description"] for record in records],
+            [record["merchant"] for record in records]
+        )
+        return [
+            self._flags(record_signals, record["category"].lower(), record["amount"])
+            for record, record_signals in zip(records, signals)
+        ]
+
+def load_transaction_rules(path=TRANSACTION_RULES_PATH):
+    """Rule table from a JSON file if one is configured, else the built-in table"""
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            rules = json.load(f)
+        print(f"📐 Loaded transaction rules v{rules.get('version')} from {path}")
+        return rules
+    return TRANSACTION_RULES
+
+_transaction_classifier = None
+
+def get_transaction_classifier():
+    """Get the compiled transaction classifier (cached)"""
+    global _transaction_classifier
+    
+    if _transaction_classifier is None:
+        _transaction_classifier = TransactionClassifier(load_transaction_rules())
+    return _transaction_classifier
 
 def detect_transaction_type(txn, category, merchant, description, amount):
     """
     Intelligent detection of transaction characteristics
     Returns dict with behavioral flags
     """
-    description_lower = description.lower()
-    merchant_lower = merchant.lower()
-    category_lower = category.lower()
+    return get_transaction_classifier().classify(category, merchant, description, amount)
+
+def detect_transaction_types_batch(records):
+    """detect_transaction_type for a whole chunk of prepared records in one pass"""
+    return get_transaction_classifier().classify_batch(records)
+
+# ==================== RECURRING DETECTION ====================
+
+_MERCHANT_TOKEN = re.compile(r'[a-z]+')
+
+def normalize_merchant_key(merchant, description):
+    """Grouping key for a payee: lowercase words, no digits/punctuation/noise, first 3 tokens"""
+    tokens = [
+        token for token in _MERCHANT_TOKEN.findall((merchant or description or '').lower())
+        if len(token) > 1 and token not in MERCHANT_NOISE_TOKENS
+    ]
+    return " ".join(tokens[:3])
+
+def split_amount_bands(amounts, tolerance=RECURRING_AMOUNT_TOLERANCE):
+    """
+    Group absolute amounts into bands whose spread is within `tolerance` of the smallest
+    Returns (low, high) per band, in ascending order
+    """
+    bands = []
+    for amount in sorted(amounts):
+        if bands and amount <= bands[-1][0] * (1 + tolerance):
+            bands[-1][1] = amount
+        else:
+            bands.append([amount, amount])
+    return [(low, high) for low, high in bands]
+
+def detect_frequency(days):
+    """
+    Name of the period matching a series of day numbers (e.g. 'monthly'), or None
+    A gap counts if it is within the allowed deviation of the period or of a whole
+    multiple of it (a skipped charge), and RECURRING_MIN_REGULARITY of gaps must count.
+    """
+    days = sorted(set(days))
+    if len(days) < RECURRING_MIN_OCCURRENCES:
+        return None
     
-    # Income detection
-    is_income = (
-        amount > 0 or 
-        category_lower in ['salary', 'paycheck', 'income', 'deposit', 'refund'] or
-        'payroll' in description_lower or
-        'direct deposit' in description_lower
-    )
+    gaps = [later - earlier for earlier, later in zip(days, days[1:])]
+    median_gap = sorted(gaps)[len(gaps) // 2]
     
-    # Subscription detection (common patterns)
-    subscription_keywords = [
-        'netflix', 'spotify', 'hulu', 'disney', 'amazon prime',
-        'apple music', 'youtube premium', 'gym', 'membership',
-        'subscription', 'monthly fee', 'annual fee'
-    ]
-    is_subscription = any(kw in description_lower or kw in merchant_lower 
-                          for kw in subscription_keywords)
+    for name, period, deviation in RECURRING_FREQUENCIES:
+        if abs(median_gap - period) > deviation:
+            continue
+        regular = 0
+        for gap in gaps:
+            cycles = max(1, round(gap / period))
+            if abs(gap - cycles * period) <= deviation * cycles:
+                regular += 1
+        if regular >= RECURRING_MIN_REGULARITY * len(gaps):
+            return name
+    return None
+
+class RecurringProfile:
+    """
+    Recurring series found in one source's transactions
+    observe() every transaction first, then finalize(); frequency_for() then answers in O(bands)
+    for each transaction. Series are keyed by (normalized merchant, sign) and split into
+    amount bands, so a $15.99 streaming plan and a one-off $80 order at the same merchant
+    are judged separately.
+    Only one file is seen at a time: a series needs RECURRING_MIN_OCCURRENCES charges inside
+    that file, so monthly bills split across monthly statement files are not flagged. This
+    keeps each file's vectors a function of that file alone (re-indexing one file never
+    changes another file's flags).
+    """
     
-    # Bill detection
-    bill_keywords = [
-        'electric', 'gas', 'water', 'internet', 'phone', 'insurance',
-        'rent', 'mortgage', 'utilities', 'bill payment'
-    ]
-    is_bill = any(kw in description_lower or kw in merchant_lower 
-                  for kw in bill_keywords)
-    
-    # Transfer detection
-    is_transfer = (
-        'transfer' in description_lower or
-        'xfer' in description_lower or
-        category_lower in ['transfer', 'internal transfer', 'credit_card_payment', 'investment']
-    )
+    def __init__(self):
+        self.series = {}  # (merchant_key, sign) -> [(abs amount, day), ...]
+        self.bands = {}  # (merchant_key, sign) -> [(low, high, frequency), ...]
     
-    # Refund detection
-    is_refund = (
-        amount > 0 and (
-            'refund' in description_lower or
-            'return' in description_lower or
-            category_lower == 'refund'
-        )
-    )
+    def observe(self, merchant, description, amount, date):
+        key = normalize_merchant_key(merchant, description)
+        row = _lookup_date_metadata(date) if date else None
+        if not key or not amount or row is None:
+            return
+        day = round(row["timestamp"] / 86400)
+        self.series.setdefault((key, amount > 0), []).append((abs(amount), day))
     
-    # Discretionary vs Essential
-    essential_categories = [
-        'groceries', 'utilities', 'rent', 'mortgage', 'insurance',
-        'healthcare', 'gas', 'transportation'
-    ]
-    is_discretionary = category_lower not in essential_categories
+    def finalize(self):
+        for series_key, points in self.series.items():
+            if len(points) < RECURRING_MIN_OCCURRENCES:
+                continue
+            bands = []
+            for low, high in split_amount_bands([amount for amount, _ in points]):
+                frequency = detect_frequency([day for amount, day in points if low <= amount <= high])
+                if frequency:
+                    bands.append((low, high, frequency))
+            if bands:
+                self.bands[series_key] = bands
+        self.series = {}
+        return self
     
-    # Should affect budget (exclude transfers, some refunds)
-    affects_budget = not (is_transfer or (is_refund and amount > 100))
+    def frequency_for(self, merchant, description, amount):
+        bands = self.bands.get((normalize_merchant_key(merchant, description), amount > 0))
+        if not bands:
+            return None
+        for low, high, frequency in bands:
+            if low <= abs(amount) <= high:
+                return frequency
+        return None
     
-    return {
-        "is_income": is_income,
-        "is_subscription": is_subscription,
-        "is_bill": is_bill,
-        "is_transfer": is_transfer,
-        "is_refund": is_refund,
-        "is_discretionary": is_discretionary,
-        "affects_budget": affects_budget,
-        
-        # Placeholders for future analysis
-        "is_recurring": False,  # Will be detected via pattern analysis
-        "recurring_frequency": None,
-        "is_large_purchase": False,  # Will be set based on category average
-        "is_unusual": False,  # Will be set via anomaly detection
-    }
+    def __len__(self):
+        return sum(len(bands) for bands in self.bands.values())
 
-# ==================== TRANSACTION-LEVEL INDEXING ====================
+def build_recurring_profile(transactions):
+    """
+    Scan raw transactions (any iterable, consumed once) into a finalized RecurringProfile
+    Pass one file's transactions; series are not detected across a user's files
+    """
+    profile = RecurringProfile()
+    for txn in transactions:
+        date, amount, _, _, description, merchant, _ = extract_transaction_fields(txn)
+        profile.observe(merchant, description, amount, date)
+    return profile.finalize()
 
-def index_transactions(s3_key, content, bedrock_client, index, user_id):
+# ==================== CATEGORY STATISTICS ====================
+
+class P2Quantile:
     """
-    ENHANCED: Index individual transactions with rich metadata
-    Maintains backward compatibility while adding new fields
+    Streaming estimate of one quantile in O(1) time and memory (the P-square algorithm)
+    Five markers track the min, p/2, p, (1+p)/2 and max; heights are adjusted with a
+    piecewise-parabolic fit as observations arrive.
     """
-    print(f"\n{'='*60}")
-    print(f"Processing: {s3_key}")
-    print(f"{'='*60}")
     
-    # Parse metadata from S3 key
-    parts = s3_key.split('/')
-    vertical = parts[1] if len(parts) >= 3 else 'finance'
-    filename = parts[-1]
+    def __init__(self, p, state=None):
+        self.p = p
+        if state:
+            self.heights = state["heights"]
+            self.positions = state["positions"]
+            self.desired = state["desired"]
+        else:
+            self.heights = []  # sorted raw observations until there are five
+            self.positions = [1, 2, 3, 4, 5]
+            self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
     
-    # Determine source type
-    source_type = 'bank_account'
-    if 'credit' in filename.lower() or 'card' in filename.lower():
-        source_type = 'credit_card'
-    elif 'investment' in filename.lower():
+    def add(self, x):
+        heights, positions = self.heights, self.positions
+        if len(heights) < 5:
+            bisect.insort(heights, x)
+            return
+        
+        if x < heights[0]:
+            heights[0] = x
+            cell = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            cell = 3
+        else:
+            cell = bisect.bisect_right(heights, x) - 1
+        
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        
+        for i in (1, 2, 3):
+            offset = self.desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or \
+               (offset <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+    
+    def _parabolic(self, i, step):
+        h, n = self.heights, self.positions
+        return h[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (h[i + 1] - h[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - step) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+        )
+    
+    def value(self):
+        """Current estimate (None before any observation)"""
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            return self.heights[min(len(self.heights) - 1, int(round(self.p * (len(self.heights) - 1))))]
+        return self.heights[2]
+    
+    def state(self):
+        return {"heights": self.heights, "positions": self.positions, "desired": self.desired}
+
+class CategorySpendStats:
+    """Running moments of log(amount) (Welford) plus a quantile sketch of the amount"""
+    
+    def __init__(self, state=None):
+        state = state or {}
+        self.count = state.get("count", 0)
+        self.mean = state.get("mean", 0.0)
+        self.m2 = state.get("m2", 0.0)
+        self.quantile = P2Quantile(LARGE_PURCHASE_QUANTILE, state.get("quantile"))
+    
+    def add(self, amount):
+        value = math.log1p(amount)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.quantile.add(amount)
+    
+    def zscore(self, amount):
+        if self.count < 2:
+            return 0.0
+        std = math.sqrt(self.m2 / (self.count - 1))
+        if std == 0:
+            return 0.0
+        return (math.log1p(amount) - self.mean) / std
+    
+    def state(self):
+        return {"count": self.count, "mean": self.mean, "m2": self.m2, "quantile": self.quantile.state()}
+
+class CategoryStatsStore:
+    """
+    Per-user, per-category spending statistics in SQLite (safe across processes)
+    annotate() scores each new spending transaction against its category's history, sets
+    is_large_purchase / is_unusual, then folds it into a per-source staging copy: O(1) per
+    transaction. The staged rows reach the stats (and save()) only through commit(), once the
+    source's vectors are upserted and recorded; discard() drops them when the source fails, so
+    a retried file is not counted twice. Callers save() right before each manifest/journal save.
+    Only records outside the source's manifest entry should be annotated;
+    stats written under a different VECTOR_ID_VERSION/layout (every vector rewritten) are ignored.
+    """
+    
+    def __init__(self, path=CATEGORY_STATS_PATH):
+        self.path = path
+        self.version = f"{VECTOR_ID_VERSION}:{metadata_layout_tag()}"
+        self.lock = threading.Lock()
+        self.users = {}  # user_id -> {category: CategorySpendStats}
+        self.staged = {}  # (user_id, source_key) -> ({category: working copy}, [(category, amount)])
+        self.dirty = set()
+        
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS category_stats (
+                user_id TEXT NOT NULL,
+                category TEXT NOT NULL,
+                version TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (user_id, category)
+            )
+        """)
+        self.conn.commit()
+    
+    def _user(self, user_id):
+        categories = self.users.get(user_id)
+        if categories is None:
+            rows = self.conn.execute(
+                "SELECT category, state FROM category_stats WHERE user_id = ? AND version = ?",
+                (user_id, self.version)
+            ).fetchall()
+            categories = {category: CategorySpendStats(json.loads(state)) for category, state in rows}
+            self.users[user_id] = categories
+        return categories
+    
+    def annotate(self, user_id, records, source_key=None):
+        """
+        Set is_large_purchase / is_unusual on prepared records of `source_key` and stage them
+        Rows are scored against the saved stats plus the source's own earlier rows
+        """
+        with self.lock:
+            categories = self._user(user_id)
+            working, amounts = self.staged.setdefault((user_id, source_key), ({}, []))
+            for record in records:
+                flags = record["type_flags"]
+                if flags["is_income"] or flags["is_transfer"] or not record["amount"]:
+                    continue
+                amount = abs(record["amount"])
+                category = record["category"]
+                stats = working.get(category)
+                if stats is None:
+                    committed = categories.get(category)
+                    stats = working[category] = CategorySpendStats(
+                        json.loads(json.dumps(committed.state())) if committed else None
+                    )
+                
+                if stats.count >= CATEGORY_STATS_MIN_SAMPLES:
+                    threshold = stats.quantile.value()
+                    flags["is_large_purchase"] = amount >= max(threshold, LARGE_PURCHASE_MIN_AMOUNT)
+                    flags["is_unusual"] = stats.zscore(amount) > UNUSUAL_ZSCORE
+                stats.add(amount)
+                amounts.append((category, amount))
+    
+    def commit(self, user_id, source_key=None):
+        """Fold the rows staged for `source_key` into the stats (its vectors are stored)"""
+        with self.lock:
+            staged = self.staged.pop((user_id, source_key), None)
+            if not staged or not staged[1]:
+                return
+            categories = self._user(user_id)
+            for category, amount in staged[1]:
+                stats = categories.get(category)
+                if stats is None:
+                    stats = categories[category] = CategorySpendStats()
+                stats.add(amount)
+            self.dirty.add(user_id)
+    
+    def discard(self, user_id, source_key=None):
+        """Drop the rows staged for `source_key` (it failed and will be indexed again)"""
+        with self.lock:
+            self.staged.pop((user_id, source_key), None)
+    
+    def score(self, user_id, records):
+        """Set is_large_purchase / is_unusual without learning (rows counted on an earlier run)"""
+        with self.lock:
+            categories = self._user(user_id)
+            for record in records:
+                flags = record["type_flags"]
+                stats = categories.get(record["category"])
+                if (stats is None or stats.count < CATEGORY_STATS_MIN_SAMPLES or flags["is_income"]
+                        or flags["is_transfer"] or not record["amount"]):
+                    continue
+                amount = abs(record["amount"])
+                flags["is_large_purchase"] = amount >= max(stats.quantile.value(), LARGE_PURCHASE_MIN_AMOUNT)
+                flags["is_unusual"] = stats.zscore(amount) > UNUSUAL_ZSCORE
+    
+    def reset_user(self, user_id):
+        """Forget a user's history (full rebuild)"""
+        with self.lock:
+            self.users[user_id] = {}
+            self.staged = {key: value for key, value in self.staged.items() if key[0] != user_id}
+            self.dirty.discard(user_id)
+            self.conn.execute("DELETE FROM category_stats WHERE user_id = ?", (user_id,))
+            self.conn.commit()
+    
+    def save(self):
+        with self.lock:
+            now = datetime.now().isoformat()
+            rows = [
+                (user_id, category, self.version, json.dumps(stats.state()), now)
+                for user_id in self.dirty
+                for category, stats in self.users[user_id].items()
+            ]
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO category_stats (user_id, category, version, state, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.conn.commit()
+            self.dirty.clear()
+    
+    def close(self):
+        self.save()
+        self.conn.close()
+
+# ==================== DUPLICATE DETECTION ====================
+
+def dedupe_fingerprint(record):
+    """(merchant, cents, day) used to match one posting across sources, or None if too vague"""
+    merchant = normalize_merchant_key(record["merchant"], record["description"]).split(' ')[0]
+    timestamp = record["temporal"]["timestamp"]
+    if not merchant or not timestamp or not record["amount"]:
+        return None
+    return merchant, int(round(record["amount"] * 100)), int(round(timestamp / 86400))
+
+class TransactionFingerprintStore:
+    """
+    Per-user fingerprints of indexed transactions for cross-source duplicate detection
+    A transaction duplicates one from another source object of the same user when the
+    first merchant token and the sign match, the amounts are within
+    DEDUPE_AMOUNT_TOLERANCE_CENTS and the dates within DEDUPE_DATE_WINDOW_DAYS: the same
+    posting exported twice (overlapping date ranges, a re-export under a new name, the same
+    account as CSV and OFX). Rows that describe one purchase differently are not matched:
+    a card purchase and the bank's card payment covering it have opposite signs and other
+    descriptors, so both are indexed (the payment stays out of spending only when it is
+    categorized as a transfer, e.g. credit_card_payment). Matching is
+    one-to-one per pair of sources, so two identical coffees still need two matches.
+    Duplicates are dropped before embedding and linked to the transaction they duplicate.
+    
+    Per source object: begin_source(), drop_duplicates() for every chunk, then end_source()
+    (or abort_source() if the file failed). Entries are keyed by vector id, so decisions are
+    stable across runs. When a transaction that others duplicate disappears, end_source()
+    returns the sources holding those duplicates: re-process them to index the rows again.
+    """
+    
+    def __init__(self, path=DEDUPE_PATH, date_window=DEDUPE_DATE_WINDOW_DAYS,
+                 amount_tolerance=DEDUPE_AMOUNT_TOLERANCE_CENTS):
+        self.path = path
+        self.version = f"{VECTOR_ID_VERSION}:{metadata_layout_tag()}"
+        self.date_window = date_window
+        self.amount_tolerance = amount_tolerance
+        self.lock = threading.Lock()
+        self.users = {}  # user_id -> {"entries", "candidates", "claims", "sources"}
+        self.passes = {}  # (user_id, source_key) -> {"seen": ids, "added": ids}
+        self.duplicates = 0
+        
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS transaction_fingerprints (
+                user_id TEXT NOT NULL,
+                vector_id TEXT NOT NULL,
+                source_key TEXT NOT NULL,
+                version TEXT NOT NULL,
+                merchant TEXT,
+                cents INTEGER,
+                day INTEGER,
+                duplicate_of TEXT,
+                PRIMARY KEY (user_id, vector_id)
+            )
+        """)
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_fingerprint_source ON transaction_fingerprints (user_id, source_key)"
+        )
+        self.conn.commit()
+    
+    # ----- in-memory state -----
+    
+    def _user(self, user_id):
+        state = self.users.get(user_id)
+        if state is None:
+            state = {"entries": {}, "candidates": {}, "claims": set(), "sources": {}}
+            rows = self.conn.execute(
+                "SELECT vector_id, source_key, merchant, cents, day, duplicate_of "
+                "FROM transaction_fingerprints WHERE user_id = ? AND version = ?",
+                (user_id, self.version)
+            ).fetchall()
+            for vector_id, source_key, merchant, cents, day, duplicate_of in rows:
+                fingerprint = (merchant, cents, day) if merchant is not None else None
+                self._add(state, vector_id, source_key, fingerprint, duplicate_of)
+            self.users[user_id] = state
+        return state
+    
+    def _add(self, state, vector_id, source_key, fingerprint, duplicate_of=None):
+        state["entries"][vector_id] = {
+            "source_key": source_key, "fingerprint": fingerprint, "duplicate_of": duplicate_of,
+        }
+        state["sources"].setdefault(source_key, set()).add(vector_id)
+        if duplicate_of is not None:
+            state["claims"].add((duplicate_of, source_key))
+        elif fingerprint is not None:
+            merchant, cents, _ = fingerprint
+            state["candidates"].setdefault((merchant, cents), set()).add(vector_id)
+    
+    def _remove(self, state, vector_id):
+        entry = state["entries"].pop(vector_id)
+        state["sources"][entry["source_key"]].discard(vector_id)
+        if entry["duplicate_of"] is not None:
+            state["claims"].discard((entry["duplicate_of"], entry["source_key"]))
+        elif entry["fingerprint"] is not None:
+            merchant, cents, _ = entry["fingerprint"]
+            state["candidates"].get((merchant, cents), set()).discard(vector_id)
+        return entry
+    
+    def _match(self, state, source_key, fingerprint):
+        """Closest-dated unclaimed transaction from another source matching `fingerprint`"""
+        merchant, cents, day = fingerprint
+        best = None
+        for candidate_cents in range(cents - self.amount_tolerance, cents + self.amount_tolerance + 1):
+            if (candidate_cents > 0) != (cents > 0):
+                continue
+            for vector_id in state["candidates"].get((merchant, candidate_cents), ()):
+                entry = state["entries"][vector_id]
+                distance = abs(entry["fingerprint"][2] - day)
+                if (entry["source_key"] == source_key or distance > self.date_window
+                        or (vector_id, source_key) in state["claims"]):
+                    continue
+                if best is None or (distance, vector_id) < best:
+                    best = (distance, vector_id)
+        return best[1] if best else None
+    
+    # ----- per-source passes -----
+    
+    def begin_source(self, user_id, source_key):
+        with self.lock:
+            self._user(user_id)
+            self.passes[(user_id, source_key)] = {"seen": set(), "added": set()}
+    
+    def drop_duplicates(self, user_id, source_key, records):
+        """Records (with ids assigned) that are not duplicates; duplicates get "duplicate_of" set"""
+        kept = []
+        with self.lock:
+            state = self._user(user_id)
+            current = self.passes.get((user_id, source_key))
+            if current is None:
+                return list(records)  # no pass open (never begun, or already aborted)
+            for record in records:
+                vector_id = record["id"]
+                current["seen"].add(vector_id)
+                entry = state["entries"].get(vector_id)
+                
+                if entry is not None and entry["duplicate_of"] is None:
+                    kept.append(record)
+                    continue
+                if entry is not None and entry["duplicate_of"] in state["entries"]:
+                    record["duplicate_of"] = entry["duplicate_of"]
+                    continue
+                if entry is not None:
+                    self._remove(state, vector_id)  # what it duplicated is gone: match again
+                
+                fingerprint = dedupe_fingerprint(record)
+                duplicate_of = self._match(state, source_key, fingerprint) if fingerprint else None
+                self._add(state, vector_id, source_key, fingerprint, duplicate_of)
+                current["added"].add(vector_id)
+                if duplicate_of is None:
+                    kept.append(record)
+                else:
+                    record["duplicate_of"] = duplicate_of
+            self.duplicates += len(records) - len(kept)
+        return kept
+    
+    def _drop(self, state, vector_ids):
+        """Remove entries; returns the other sources holding duplicates of removed ones"""
+        removed = set(vector_ids)
+        if not removed:
+            return set()
+        for vector_id in removed:
+            self._remove(state, vector_id)
+        return {
+            entry["source_key"] for entry in state["entries"].values()
+            if entry["duplicate_of"] in removed
+        }
+    
+    def _persist(self, user_id, source_key, state):
+        rows = []
+        for vector_id in state["sources"].get(source_key, ()):
+            entry = state["entries"][vector_id]
+            merchant, cents, day = entry["fingerprint"] or (None, None, None)
+            rows.append((user_id, vector_id, source_key, self.version, merchant, cents, day, entry["duplicate_of"]))
+        
+        self.conn.execute(
+            "DELETE FROM transaction_fingerprints WHERE user_id = ? AND source_key = ?",
+            (user_id, source_key)
+        )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO transaction_fingerprints "
+            "(user_id, vector_id, source_key, version, merchant, cents, day, duplicate_of) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        self.conn.commit()
+    
+    def end_source(self, user_id, source_key):
+        """Forget rows the source no longer has and persist it; returns affected source keys"""
+        with self.lock:
+            state = self._user(user_id)
+            current = self.passes.pop((user_id, source_key), {"seen": set()})
+            stale = state["sources"].get(source_key, set()) - current["seen"]
+            affected = self._drop(state, stale)
+            self._persist(user_id, source_key, state)
+            return affected - {source_key}
+    
+    def abort_source(self, user_id, source_key):
+        """Undo the entries a failed pass added; returns affected source keys"""
+        with self.lock:
+            state = self._user(user_id)
+            current = self.passes.pop((user_id, source_key), {"added": set()})
+            return self._drop(state, current["added"]) - {source_key}
+    
+    def remove_source(self, user_id, source_key):
+        """A source object was deleted; returns affected source keys"""
+        self.begin_source(user_id, source_key)
+        return self.end_source(user_id, source_key)
+    
+    def reset_user(self, user_id):
+        """Forget a user's fingerprints (full rebuild)"""
+        with self.lock:
+            self.users[user_id] = {"entries": {}, "candidates": {}, "claims": set(), "sources": {}}
+            self.conn.execute("DELETE FROM transaction_fingerprints WHERE user_id = ?", (user_id,))
+            self.conn.commit()
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# ==================== TRANSACTION-LEVEL INDEXING ====================
+
+def describe_s3_key(s3_key):
+    """Derive (vertical, source_type) from an object key like user/finance/credit_card.json"""
+    # Parse metadata from S3 key
+    parts = s3_key.split('/')
+    vertical = parts[1] if len(parts) >= 3 else 'finance'
+    filename = parts[-1]
+    
+    # Determine source type
+    source_type = 'bank_account'
+    if 'credit' in filename.lower() or 'card' in filename.lower():
+        source_type = 'credit_card'
+    elif 'investment' in filename.lower():
         source_type = 'investment'
     
-    # Parse transactions
-    transactions = parse_transactions_from_json(content, s3_key)
+    return vertical, source_type
+
+def index_transactions(s3_key, content, bedrock_client, index, user_id, embedding_cache=None,
+                       vector_ids=None, chunk_size=INDEX_CHUNK_SIZE, existing_ids=None,
+                       recurring=None, category_stats=None, lake_rows=None, dedupe=None,
+                       affected_sources=None):
+    """
+    ENHANCED: Index individual transactions with rich metadata
+    Maintains backward compatibility while adding new fields
+    `content` is either the raw file text (JSON, CSV or OFX by the key suffix) or an iterable of transactions
+    (e.g. iter_transactions_from_s3); work is done in chunks of `chunk_size`.
+    Vector ids are content-derived, so only transactions whose id is not already in
+    the index are embedded and upserted. `existing_ids` (e.g. from the manifest) avoids
+    asking Pinecone which ids exist.
+    If `vector_ids` is a list, the ids of all of this file's vectors are appended to it
+    (unchanged and newly upserted), so callers can delete whatever is missing.
+    Recurring series need the whole file up front: pass `recurring` (build_recurring_profile
+    over the same transactions) when `content` is a one-shot stream; for text or a list it
+    is built here. `category_stats` (CategoryStatsStore) sets the large-purchase/unusual flags;
+    the rows it learns stay staged under `s3_key` until the caller commits them once the file
+    is recorded (they are discarded if indexing fails).
+    If `lake_rows` is a list, every transaction of the file is appended to it as a transaction
+    lake row (see transaction_lake_row) for the caller to write with TransactionLake.write_object.
+    With `dedupe` (TransactionFingerprintStore), duplicates of transactions from the user's other
+    sources are dropped before embedding; sources that must be re-processed because rows they
+    duplicated are gone are added to the `affected_sources` set.
+    Without `existing_ids` the file may predate the manifest, so once its vectors are upserted
+    its legacy_vector_ids are deleted (the old ids would otherwise show every row twice).
+    Returns the number of transactions from this file now in the index.
+    """
+    print(f"\n{'='*60}")
+    print(f"Processing: {s3_key}")
+    print(f"{'='*60}")
+    
+    vertical, source_type = describe_s3_key(s3_key)
+    
+    # Parse transactions (raw file text) or consume a transaction stream
+    if isinstance(content, bytes) and split_compression_suffix(s3_key)[1]:
+        content = open_decompressed_body(io.BytesIO(content), s3_key).read()
+    if isinstance(content, (str, bytes)) and statement_format(s3_key) == 'json':
+        transactions = parse_transactions_from_json(content, s3_key)
+    elif isinstance(content, (str, bytes)):
+        raw = content.encode('utf-8') if isinstance(content, str) else content
+        transactions = list(iter_transactions_from_stream(io.BytesIO(raw), s3_key))
+    else:
+        transactions = content
+    
+    if recurring is None and isinstance(transactions, (list, tuple)):
+        recurring = build_recurring_profile(transactions)
+    
+    total_seen = 0
+    totals = {"upserted": 0, "unchanged": 0}
+    occurrences = Counter()
+    legacy_ids = set()
+    chunk = []
+    
+    def flush(chunk):
+        if existing_ids is None:
+            legacy_ids.update(legacy_vector_ids(chunk, user_id, source_type))
+        upserted, unchanged = _index_transaction_chunk(
+            chunk, s3_key, vertical, source_type, user_id, bedrock_client, index,
+            embedding_cache, vector_ids, occurrences, existing_ids, recurring, category_stats,
+            lake_rows, dedupe
+        )
+        totals["upserted"] += upserted
+        totals["unchanged"] += unchanged
+    
+    if dedupe is not None:
+        dedupe.begin_source(user_id, s3_key)
+    if category_stats is not None:
+        category_stats.discard(user_id, s3_key)
+    try:
+        for idx, txn in enumerate(transactions):
+            chunk.append((idx, txn))
+            if len(chunk) >= chunk_size:
+                total_seen += len(chunk)
+                flush(chunk)
+                chunk = []
+        
+        if chunk:
+            total_seen += len(chunk)
+            flush(chunk)
+        
+        if legacy_ids:
+            delete_vectors_by_id(index, legacy_ids)
+    except Exception:
+        if dedupe is not None:
+            dedupe.abort_source(user_id, s3_key)
+        if category_stats is not None:
+            category_stats.discard(user_id, s3_key)
+        raise
+    
+    if dedupe is not None:
+        affected = dedupe.end_source(user_id, s3_key)
+        if affected_sources is not None:
+            affected_sources.update(affected)
     
-    if not transactions:
+    if not total_seen:
         print(f"⚠️ No transactions found in {s3_key}")
         return 0
     
-    vectors = []
+    print(f"✅ Indexed {totals['upserted']} new/changed transactions from {s3_key} "
+          f"({totals['unchanged']} unchanged)")
+    return totals["upserted"] + totals["unchanged"]
+
+def build_transaction_vectors(prepared, s3_key, vertical, source_type, user_id,
+                              bedrock_client, embedding_cache=None, limiter=None):
+    """
+    Turn prepared records into Pinecone vectors with enhanced metadata
+    Raises if any transaction fails to embed, so the file is retried rather than recorded
+    with rows missing (embeddings that succeeded are cached for the retry)
+    """
+    # Generate embeddings (de-duplicated, cached, concurrent, order preserved)
+    embeddings = generate_embeddings_cached(
+        [record["text"] for record in prepared], bedrock_client, embedding_cache, limiter
+    )
+    
+    return assemble_transaction_vectors(prepared, embeddings, s3_key, vertical, source_type, user_id)
+
+def extract_transaction_fields(txn):
+    """Normalized (date, amount, type, category, description, merchant, goal_contribution)"""
+    date = txn.get('transaction_date') or txn.get('date') or txn.get('posted_date') or ''
+    amount = normalize_amount(txn.get('amount', 0))
+    txn_type = (txn.get('type') or txn.get('transaction_type') or 'unknown').lower()
+    category = (txn.get('category') or txn.get('merchant_category') or 'uncategorized').lower()
+    description = txn.get('description') or txn.get('name') or ''
+    merchant = txn.get('merchant') or txn.get('merchant_name') or ''
+    goal_contribution = txn.get('goal_contribution') or ''
+    return date, amount, txn_type, category, description, merchant, goal_contribution
+
+def prepare_transaction_records(indexed_transactions, source_type, recurring=None):
+    """
+    Extract normalized fields and the embedding text for (idx, transaction) pairs
+    `recurring` is the file's RecurringProfile; it fills is_recurring/recurring_frequency
+    """
+    prepared = []
     
-    for idx, txn in enumerate(transactions):
+    for idx, txn in indexed_transactions:
         try:
             # Extract EXISTING fields (unchanged)
-            date = txn.get('transaction_date') or txn.get('date') or txn.get('posted_date') or ''
-            amount = normalize_amount(txn.get('amount', 0))
-            txn_type = (txn.get('type') or txn.get('transaction_type') or 'unknown').lower()
-            category = (txn.get('category') or txn.get('merchant_category') or 'uncategorized').lower()
-            description = txn.get('description') or txn.get('name') or ''
-            merchant = txn.get('merchant') or txn.get('merchant_name') or ''
-            goal_contribution = txn.get('goal_contribution') or ''
+            (date, amount, txn_type, category, description,
+             merchant, goal_contribution) = extract_transaction_fields(txn)
 
             # Create searchable text (unchanged)
             txn_text = create_transaction_text(txn, source_type)
             
-            # Generate embedding (unchanged)
-            embedding = generate_embedding(txn_text, bedrock_client)
-            
-            # NEW: Extract enhanced temporal metadata
-            temporal_metadata = parse_date_metadata(date)
+            prepared.append({
+                "idx": idx,
+                "txn": txn,
+                "date": date,
+                "amount": amount,
+                "txn_type": txn_type,
+                "category": category,
+                "description": description,
+                "merchant": merchant,
+                "goal_contribution": goal_contribution,
+                "text": txn_text,
+            })
+                
+        except Exception as e:
+            print(f"❌ Error processing transaction {idx}: {e}")
+            continue
+    
+    # Temporal metadata for the whole chunk (one date-dimension lookup per distinct date)
+    for record, temporal in zip(prepared, parse_date_metadata_batch([r["date"] for r in prepared])):
+        record["temporal"] = temporal
+    
+    # Behavioral flags for the whole chunk (one classifier pass)
+    for record, type_flags in zip(prepared, detect_transaction_types_batch(prepared)):
+        record["type_flags"] = type_flags
+    
+    # Recurring series detected over the whole file
+    if recurring is not None:
+        for record in prepared:
+            frequency = recurring.frequency_for(record["merchant"], record["description"], record["amount"])
+            if frequency:
+                record["type_flags"]["is_recurring"] = True
+                record["type_flags"]["recurring_frequency"] = frequency
+    
+    return prepared
+
+def metadata_layout_tag():
+    """Layout name + version; part of the id so switching layouts rewrites vectors"""
+    if METADATA_LAYOUT == 'compact':
+        return f"compact{COMPACT_METADATA_VERSION}"
+    return "full"
+
+def transaction_fingerprint(record, s3_key):
+    """
+    Stable content hash of a transaction (independent of its position in the file)
+    Covers the exact embedded text and the metadata values stored with the vector, so any
+    change to either (including a transaction joining or leaving a recurring series) gets the
+    vector rewritten. The large-purchase/unusual flags depend on the user's history, not the
+    row, and are left out. Uses the source's own transaction id when it has one.
+    """
+    txn = record["txn"]
+    source_id = txn.get('transaction_id') or txn.get('id') or ''
+    flags = record["type_flags"]
+    basis = "|".join(str(part) for part in (
+        VECTOR_ID_VERSION, metadata_layout_tag(), s3_key, source_id, record["text"],
+        record["date"], repr(record["amount"]), record["txn_type"], record["category"],
+        record["description"], record["merchant"], record["goal_contribution"],
+        *(f"{name}={flags[name]}" for name in sorted(flags)
+          if name not in ("is_large_purchase", "is_unusual")),
+    ))
+    return hashlib.sha1(basis.encode('utf-8')).hexdigest()[:20]
+
+def assign_vector_ids(prepared, user_id, source_type, s3_key, occurrences):
+    """
+    Give each prepared record a deterministic id: {user}_{source}_{date}_{fingerprint}
+    Identical rows in one file get an occurrence suffix; `occurrences` is a Counter
+    shared by all chunks of the file
+    """
+    for record in prepared:
+        fingerprint = transaction_fingerprint(record, s3_key)
+        seen = occurrences[fingerprint]
+        occurrences[fingerprint] += 1
+        if seen:
+            fingerprint = f"{fingerprint}-{seen}"
+        record["id"] = f"{user_id}_{source_type}_{record['date']}_{fingerprint}"
+    return prepared
+
+def legacy_vector_ids(indexed_transactions, user_id, source_type):
+    """
+    Ids the original indexer gave (idx, transaction) pairs: {user}_{source}_{date}_{idx}
+    A file without a manifest entry may have been indexed under them before content-derived
+    ids; they never equal a content-derived id, so they can simply be deleted
+    """
+    ids = set()
+    for idx, txn in indexed_transactions:
+        if isinstance(txn, dict):
+            date = txn.get('transaction_date') or txn.get('date') or txn.get('posted_date') or ''
+            ids.add(f"{user_id}_{source_type}_{date}_{idx}")
+    return ids
+
+def fetch_existing_ids(index, ids, batch_size=PINECONE_FETCH_BATCH_SIZE):
+    """Return the subset of `ids` already present in the index"""
+    ids = list(ids)
+    existing = set()
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i + batch_size]
+        response = _call_with_rate_limit_retry(lambda: index.fetch(ids=batch))
+        vectors = getattr(response, 'vectors', None)
+        if vectors is None:
+            vectors = response.get('vectors', {})
+        existing.update(vectors.keys())
+    return existing
+
+def assemble_transaction_vectors(prepared, embeddings, s3_key, vertical, source_type, user_id):
+    """
+    Combine prepared records with their embeddings into Pinecone vectors
+    Raises if any record has no embedding: a file missing rows must not be recorded as indexed
+    """
+    missing = [record["idx"] for record, embedding in zip(prepared, embeddings) if embedding is None]
+    if missing:
+        raise RuntimeError(f"{len(missing)} transactions could not be embedded (first: {missing[0]})")
+    
+    vectors = []
+    
+    for record, embedding in zip(prepared, embeddings):
+        idx = record["idx"]
+        
+        try:
+            date = record["date"]
+            amount = record["amount"]
+            txn_type = record["txn_type"]
+            category = record["category"]
+            description = record["description"]
+            merchant = record["merchant"]
+            goal_contribution = record["goal_contribution"]
+            txn_text = record["text"]
             
-            # NEW: Detect transaction characteristics
-            type_metadata = detect_transaction_type(
-                txn, category, merchant, description, amount
-            )
+            # NEW: Enhanced temporal metadata (precomputed in prepare_transaction_records)
+            temporal_metadata = record["temporal"]
             
-            # Create vector ID (unchanged)
-            vector_id = f"{user_id}_{source_type}_{date}_{idx}"
+            # NEW: Transaction characteristics (classified in prepare_transaction_records)
+            type_metadata = record["type_flags"]
             
             # Create vector with ENHANCED METADATA
             vector = {
-                "id": vector_id,
+                "id": record["id"],
                 "values": embedding,
                 "metadata": {
                     # ===== EXISTING FIELDS (DON'T CHANGE) =====
@@ -359,189 +2164,1567 @@ def index_transactions(s3_key, content, bedrock_client, index, user_id):
                     "is_discretionary": type_metadata["is_discretionary"],
                     "affects_budget": type_metadata["affects_budget"],
                     "is_recurring": type_metadata["is_recurring"],
+                    "recurring_frequency": type_metadata["recurring_frequency"] or '',
                     "is_large_purchase": type_metadata["is_large_purchase"],
                     "is_unusual": type_metadata["is_unusual"],
                 }
             }
             
-            vectors.append(vector)
+            if METADATA_LAYOUT == 'compact':
+                vector["metadata"] = encode_compact_metadata(vector["metadata"])
             
-            if (idx + 1) % 10 == 0:
-                print(f"✅ Processed {idx + 1}/{len(transactions)} transactions")
+            vectors.append(vector)
                 
         except Exception as e:
             print(f"❌ Error processing transaction {idx}: {e}")
             continue
     
+    return vectors
+
+def transaction_lake_row(record, s3_key, vertical, source_type, user_id):
+    """One prepared record as a transaction lake row (columns of transaction_lake.LAKE_COLUMNS)"""
+    temporal = record["temporal"]
+    flags = record["type_flags"]
+    return {
+        "id": record["id"],
+        "user_id": user_id,
+        "source_key": s3_key,
+        "source_type": source_type,
+        "vertical": vertical,
+        "date": record["date"],
+        "timestamp": temporal["timestamp"],
+        "year": temporal["year"],
+        "month": temporal["month"],
+        "day": temporal["day"],
+        "day_of_week_num": temporal["day_of_week_num"],
+        "week_of_year": temporal["week_of_year"],
+        "quarter": temporal["quarter"],
+        "is_weekend": temporal["is_weekend"],
+        "amount": record["amount"],
+        "type": record["txn_type"],
+        "category": record["category"],
+        "description": record["description"],
+        "merchant": record["merchant"],
+        "goal_contribution": str(record["goal_contribution"]),
+        "is_income": flags["is_income"],
+        "is_subscription": flags["is_subscription"],
+        "is_bill": flags["is_bill"],
+        "is_transfer": flags["is_transfer"],
+        "is_refund": flags["is_refund"],
+        "is_discretionary": flags["is_discretionary"],
+        "affects_budget": flags["affects_budget"],
+        "is_recurring": flags["is_recurring"],
+        "recurring_frequency": flags["recurring_frequency"] or '',
+        "is_large_purchase": flags["is_large_purchase"],
+        "is_unusual": flags["is_unusual"],
+        "indexed_at": datetime.now().isoformat(),
+    }
+
+def _index_transaction_chunk(indexed_transactions, s3_key, vertical, source_type, user_id,
+                             bedrock_client, index, embedding_cache, vector_ids,
+                             occurrences, existing_ids, recurring=None, category_stats=None,
+                             lake_rows=None, dedupe=None):
+    """Diff, build and upsert vectors for one chunk of a file; returns (upserted, unchanged)"""
+    prepared = prepare_transaction_records(indexed_transactions, source_type, recurring)
+    assign_vector_ids(prepared, user_id, source_type, s3_key, occurrences)
+    
+    # Cross-source duplicates are dropped before anything is embedded
+    if dedupe is not None:
+        prepared = dedupe.drop_duplicates(user_id, s3_key, prepared)
+    
+    # Only embed/upsert ids the index does not already hold
+    ids = [record["id"] for record in prepared]
+    if existing_ids is None:
+        known = fetch_existing_ids(index, ids)
+    else:
+        known = existing_ids.intersection(ids)
+    pending = [record for record in prepared if record["id"] not in known]
+    
+    # Large/unusual flags against the user's category history. The stats are persisted with
+    # the manifest: rows of the file's manifest entry are learned, anything else (all rows of a
+    # file without an entry, even if its vectors survived) is learned now
+    if category_stats is not None:
+        recorded = known if existing_ids is not None else set()
+        category_stats.annotate(user_id, [record for record in prepared if record["id"] not in recorded], s3_key)
+        if lake_rows is not None:
+            category_stats.score(user_id, [record for record in prepared if record["id"] in recorded])
+    
+    if lake_rows is not None:
+        lake_rows.extend(
+            transaction_lake_row(record, s3_key, vertical, source_type, user_id) for record in prepared
+        )
+    
+    vectors = build_transaction_vectors(
+        pending, s3_key, vertical, source_type, user_id, bedrock_client, embedding_cache
+    )
+    
     # Upload to Pinecone (unchanged)
     if vectors:
         upsert_to_pinecone(index, vectors)
-        print(f"✅ Indexed {len(vectors)} transactions from {s3_key}")
     
-    return len(vectors)
+    if vector_ids is not None:
+        vector_ids.extend(record["id"] for record in prepared if record["id"] in known)
+        vector_ids.extend(vector["id"] for vector in vectors)
+    
+    return len(vectors), len(prepared) - len(pending)
+
+def is_rate_limit_error(error):
+    """True if a Pinecone error is a 429 / rate-limit response"""
+    status = getattr(error, 'status', None) or getattr(error, 'status_code', None)
+    if status == 429:
+        return True
+    message = str(error).lower()
+    return '429' in message or 'too many requests' in message or 'rate limit' in message
+
+def _call_with_rate_limit_retry(call, limiter=None, max_retries=UPSERT_MAX_RETRIES):
+    """Run a Pinecone write, backing off (and shrinking concurrency) only on rate limiting"""
+    attempt = 0
+    while True:
+        if limiter:
+            limiter.acquire()
+        try:
+            result = call()
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt >= max_retries:
+                raise
+            if limiter:
+                limiter.on_throttle()
+        else:
+            if limiter:
+                limiter.on_success()
+            return result
+        finally:
+            if limiter:
+                limiter.release()
+        
+        # Back off without holding a slot, then queue for one again
+        attempt += 1
+        delay = UPSERT_RETRY_BASE_DELAY * (2 ** (attempt - 1))
+        time.sleep(random.uniform(delay / 2, delay))
+
+def estimate_vector_bytes(vector):
+    """Approximate serialized size of one vector in an upsert request"""
+    return (
+        len(vector["id"]) + 32
+        + 12 * len(vector["values"])  # float as JSON text incl. separator
+        + len(json.dumps(vector.get("metadata", {}), default=str))
+    )
+
+def serialize_vectors(vectors):
+    """Copies of vectors with float32 array values expanded to lists (what Pinecone expects)"""
+    return [
+        dict(vector, values=vector["values"].tolist()) if isinstance(vector["values"], array) else vector
+        for vector in vectors
+    ]
+
+def batch_vectors_by_size(vectors, max_bytes=UPSERT_MAX_BATCH_BYTES,
+                          max_vectors=UPSERT_MAX_BATCH_VECTORS):
+    """Split vectors into upsert batches bounded by payload bytes and vector count"""
+    batches = []
+    batch = []
+    batch_bytes = 0
+    
+    for vector in vectors:
+        size = estimate_vector_bytes(vector)
+        if batch and (batch_bytes + size > max_bytes or len(batch) >= max_vectors):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(vector)
+        batch_bytes += size
+    
+    if batch:
+        batches.append(batch)
+    return batches
 
-def upsert_to_pinecone(index, vectors, batch_size=100):
-    """Upload vectors to Pinecone in batches"""
+def upsert_to_pinecone(index, vectors, max_workers=UPSERT_MAX_WORKERS, limiter=None):
+    """
+    Upload vectors to Pinecone in size-bounded batches, several in parallel
+    Only rate-limit responses trigger backoff; there are no fixed sleeps
+    A batch's values are expanded to lists only while it is being sent, so at most
+    max_workers batches exist as Python floats at any time
+    """
     print(f"📤 Uploading {len(vectors)} vectors to Pinecone...")
     
     total = len(vectors)
-    for i in range(0, total, batch_size):
-        batch = vectors[i:i + batch_size]
-        try:
-            index.upsert(vectors=batch)
-            print(f"✅ Uploaded batch {i//batch_size + 1} ({len(batch)} vectors)")
-            time.sleep(0.5)
-        except Exception as e:
-            print(f"❌ Error uploading batch: {e}")
-            raise
+    batches = batch_vectors_by_size(vectors)
+    if limiter is None:
+        limiter = AdaptiveConcurrencyLimiter(min(max_workers, len(batches)) or 1, name='Pinecone')
+    
+    def send(batch):
+        payload = serialize_vectors(batch)
+        return _call_with_rate_limit_retry(lambda: index.upsert(vectors=payload), limiter)
     
-    print(f"✅ Successfully uploaded {total} vectors!")
+    with ThreadPoolExecutor(max_workers=limiter.max_limit) as executor:
+        futures = {executor.submit(send, batch): number for number, batch in enumerate(batches, start=1)}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"❌ Error uploading batch {futures[future]}: {e}")
+                raise
+    
+    print(f"✅ Successfully uploaded {total} vectors in {len(batches)} batches!")
 
-def delete_user_vectors(index, user_id):
+def wait_for_index_stats(index, expected_count=None, timeout=INDEX_STATS_TIMEOUT,
+                         poll_interval=INDEX_STATS_POLL_INTERVAL):
+    """
+    Poll describe_index_stats instead of sleeping a fixed time
+    Returns as soon as the vector count equals `expected_count` or, without an
+    expectation, once two consecutive polls agree (writes have settled); gives up after `timeout`
+    """
+    deadline = time.time() + timeout
+    stats = index.describe_index_stats()
+    
+    while time.time() < deadline:
+        count = stats['total_vector_count']
+        if expected_count is not None and count == expected_count:
+            break
+        time.sleep(poll_interval)
+        previous_count = count
+        stats = index.describe_index_stats()
+        if expected_count is None and stats['total_vector_count'] == previous_count:
+            break
+    
+    return stats
+
+def delete_user_vectors(index, user_id, wait=False):
     """Delete all existing vectors for a user"""
     print(f"🗑️  Deleting existing vectors for user: {user_id}")
     
     try:
-        index.delete(filter={"user_id": {"$eq": user_id}})
+        _call_with_rate_limit_retry(lambda: index.delete(filter={"user_id": {"$eq": user_id}}))
         print(f"✅ Deleted existing vectors for user: {user_id}")
-        time.sleep(2)
+        if wait:
+            wait_for_index_stats(index)
     except Exception as e:
         print(f"⚠️  Warning: Could not delete existing vectors: {e}")
 
+def delete_vectors_by_id(index, ids, batch_size=PINECONE_DELETE_BATCH_SIZE):
+    """Delete specific vectors by id, in batches"""
+    ids = list(ids)
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i + batch_size]
+        _call_with_rate_limit_retry(lambda: index.delete(ids=batch))
+    return len(ids)
+
+# ==================== INDEX MANIFEST ====================
+
+def load_index_manifest(path=INDEX_MANIFEST_PATH):
+    """Load the per-object manifest from disk (empty manifest if missing)"""
+    if not os.path.exists(path):
+        return {"version": 1, "objects": {}}
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    manifest.setdefault("objects", {})
+    return manifest
+
+def save_index_manifest(manifest, path=INDEX_MANIFEST_PATH):
+    """Atomically persist the manifest (write temp file, then rename)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+def plan_incremental_index(objects, manifest, prefix=''):
+    """
+    Compare an S3 listing against the manifest
+    Returns (changed, removed): objects that are new/modified, and manifest keys no longer in S3
+    """
+    known = manifest["objects"]
+    listed_keys = set()
+    changed = []
+    
+    for obj in objects:
+        listed_keys.add(obj['key'])
+        entry = known.get(obj['key'])
+        if entry is None or entry.get('etag') != obj['etag'] or entry.get('size') != obj['size']:
+            changed.append(obj)
+    
+    removed = [key for key in known if key.startswith(prefix) and key not in listed_keys]
+    return changed, removed
+
+# ==================== INDEXING JOURNAL ====================
+
+class IndexJournal:
+    """
+    Durable per-run checkpoints for sharded indexing (SQLite, safe across processes)
+    Each file a worker finishes is journaled with its manifest entry, and each user once all
+    of their files are done, so a restarted run skips finished users and finished files.
+    """
+    
+    def __init__(self, path=INDEX_JOURNAL_PATH):
+        self.path = path
+        self.lock = threading.Lock()  # files are checkpointed from the pipeline's threads
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at TEXT NOT NULL,
+                finished_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS user_checkpoints (
+                run_id INTEGER NOT NULL,
+                user_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (run_id, user_id)
+            );
+            CREATE TABLE IF NOT EXISTS file_checkpoints (
+                run_id INTEGER NOT NULL,
+                file_key TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                entry TEXT,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (run_id, file_key)
+            );
+        """)
+        self.conn.commit()
+    
+    def start_or_resume_run(self):
+        """Return (run_id, resumed): the latest unfinished run, or a new one"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT run_id FROM runs WHERE finished_at IS NULL ORDER BY run_id DESC LIMIT 1"
+            ).fetchone()
+            if row:
+                return row[0], True
+            cursor = self.conn.execute(
+                "INSERT INTO runs (started_at) VALUES (?)", (datetime.now().isoformat(),)
+            )
+            self.conn.commit()
+            return cursor.lastrowid, False
+    
+    def finish_run(self, run_id):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE runs SET finished_at = ? WHERE run_id = ?", (datetime.now().isoformat(), run_id)
+            )
+            self.conn.commit()
+    
+    def record_file(self, run_id, user_id, file_key, entry):
+        """Checkpoint one file; entry=None means the file was de-indexed"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO file_checkpoints (run_id, file_key, user_id, entry, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (run_id, file_key, user_id, json.dumps(entry) if entry is not None else None,
+                 datetime.now().isoformat())
+            )
+            self.conn.commit()
+    
+    def record_user(self, run_id, user_id, status):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO user_checkpoints (run_id, user_id, status, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (run_id, user_id, status, datetime.now().isoformat())
+            )
+            self.conn.commit()
+    
+    def completed_users(self, run_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT user_id FROM user_checkpoints WHERE run_id = ? AND status = 'done'", (run_id,)
+            ).fetchall()
+            return {row[0] for row in rows}
+    
+    def file_entries(self, run_id):
+        """{file_key: manifest entry or None} for every file checkpointed in the run"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT file_key, entry FROM file_checkpoints WHERE run_id = ?", (run_id,)
+            ).fetchall()
+            return {key: json.loads(entry) if entry is not None else None for key, entry in rows}
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# ==================== OFFLINE BATCH EMBEDDING ====================
+
+# Large backfills skip the synchronous invoke path in three steps:
+#   1. write_batch_embedding_inputs: every embedding text not yet cached, as sharded JSONL
+#      records in Bedrock batch format {"recordId": <cache key>, "modelInput": {"inputText": ...}}
+#   2. an executor turns input shards into output shards (Bedrock batch inference job, or a
+#      local stand-in that calls invoke_model)
+#   3. ingest_batch_embedding_results: output vectors go into the EmbeddingCache
+# The normal indexing pass then joins vectors back to transactions through the
+# content-addressed cache, so it only upserts. Failed records fall back to invoke_model.
+
+def write_batch_embedding_inputs(s3_client, objects, embedding_cache, job_dir,
+                                 shard_size=BATCH_EMBEDDING_SHARD_SIZE, bucket=S3_BUCKET):
+    """Step 1: write the uncached embedding inputs of `objects` as JSONL shards; returns paths"""
+    os.makedirs(job_dir, exist_ok=True)
+    paths = []
+    seen = set()  # 12-byte key prefixes, enough to de-duplicate within one job
+    state = {"shard": None, "count": 0, "total": 0}
+    
+    def write_pending(texts_by_key):
+        present = embedding_cache.has_many(texts_by_key)
+        for key, text in texts_by_key.items():
+            if key in present:
+                continue
+            if state["shard"] is None or state["count"] >= shard_size:
+                if state["shard"] is not None:
+                    state["shard"].close()
+                paths.append(os.path.join(job_dir, f"input-{len(paths):05d}.jsonl"))
+                state["shard"] = open(paths[-1], 'w', encoding='utf-8')
+                state["count"] = 0
+            state["shard"].write(json.dumps({"recordId": key, "modelInput": embedding_model_input(text)}) + "\n")
+            state["count"] += 1
+            state["total"] += 1
+    
+    try:
+        for obj in objects:
+            _, source_type = describe_s3_key(obj['key'])
+            texts_by_key = {}
+            for txn in iter_transactions_from_s3(s3_client, bucket, obj['key']):
+                text = create_transaction_text(txn, source_type)
+                key = embedding_cache.key_for(text)
+                marker = bytes.fromhex(key[:24])
+                if marker in seen:
+                    continue
+                seen.add(marker)
+                texts_by_key[key] = text
+                if len(texts_by_key) >= 1000:
+                    write_pending(texts_by_key)
+                    texts_by_key = {}
+            write_pending(texts_by_key)
+    finally:
+        if state["shard"] is not None:
+            state["shard"].close()
+    
+    total = state["total"]
+    estimated_bytes = total * EMBEDDING_DIMENSIONS * 4
+    print(f"📝 Batch inputs: {total} texts to embed in {len(paths)} shards")
+    if not embedding_cache.s3_client and estimated_bytes > embedding_cache.max_bytes:
+        print(f"⚠️  ~{estimated_bytes / 1024 ** 3:.1f} GB of embeddings exceeds the local cache budget; "
+              f"raise EMBEDDING_CACHE_MAX_BYTES or configure EMBEDDING_CACHE_S3_BUCKET")
+    return paths
+
+class LocalBatchEmbeddingExecutor:
+    """Stand-in batch executor: embeds each input shard with the configured embedding backend"""
+    
+    def __init__(self, bedrock_client, limiter=None, chunk_size=INDEX_CHUNK_SIZE):
+        self.bedrock_client = bedrock_client
+        self.limiter = limiter or AdaptiveConcurrencyLimiter(EMBEDDING_MAX_WORKERS)
+        self.chunk_size = chunk_size
+    
+    def _write_chunk(self, out, records):
+        embeddings = get_embedding_backend(self.bedrock_client).embed_many(
+            [record["modelInput"]["inputText"] for record in records], limiter=self.limiter
+        )
+        for record, embedding in zip(records, embeddings):
+            if embedding is None:
+                record["error"] = {"errorMessage": "embedding failed"}
+            else:
+                record["modelOutput"] = {"embedding": embedding.tolist()}
+            out.write(json.dumps(record) + "\n")
+    
+    def run(self, input_paths, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        output_paths = []
+        for path in input_paths:
+            output_path = os.path.join(output_dir, os.path.basename(path) + ".out")
+            with open(path, 'r', encoding='utf-8') as f, open(output_path, 'w', encoding='utf-8') as out:
+                records = []
+                for line in f:
+                    if line.strip():
+                        records.append(json.loads(line))
+                    if len(records) >= self.chunk_size:
+                        self._write_chunk(out, records)
+                        records = []
+                if records:
+                    self._write_chunk(out, records)
+            output_paths.append(output_path)
+            print(f"✅ Embedded shard {os.path.basename(path)}")
+        return output_paths
+
+class BedrockBatchEmbeddingExecutor:
+    """Runs the shards as one Bedrock batch inference job (CreateModelInvocationJob)"""
+    
+    def __init__(self, bedrock_control_client, s3_client, bucket=BATCH_EMBEDDING_S3_BUCKET,
+                 prefix=BATCH_EMBEDDING_S3_PREFIX, role_arn=BATCH_EMBEDDING_ROLE_ARN,
+                 model_id=None, poll_interval=BATCH_EMBEDDING_POLL_INTERVAL):
+        if not bucket or not role_arn:
+            raise ValueError("BATCH_EMBEDDING_S3_BUCKET and BATCH_EMBEDDING_ROLE_ARN are required")
+        self.bedrock = bedrock_control_client
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.role_arn = role_arn
+        self.model_id = model_id or EMBEDDING_MODEL
+        self.poll_interval = poll_interval
+    
+    def run(self, input_paths, output_dir):
+        job_name = f"sagaa-embeddings-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        input_prefix = f"{self.prefix}{job_name}/input/"
+        output_prefix = f"{self.prefix}{job_name}/output/"
+        
+        for path in input_paths:
+            self.s3_client.upload_file(path, self.bucket, input_prefix + os.path.basename(path))
+        
+        job_arn = self.bedrock.create_model_invocation_job(
+            jobName=job_name,
+            roleArn=self.role_arn,
+            modelId=self.model_id,
+            inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{self.bucket}/{input_prefix}"}},
+            outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{self.bucket}/{output_prefix}"}},
+        )['jobArn']
+        print(f"🚚 Submitted batch job {job_name}")
+        
+        while True:
+            status = self.bedrock.get_model_invocation_job(jobIdentifier=job_arn)['status']
+            if status in ('Completed', 'PartiallyCompleted'):
+                break
+            if status in ('Failed', 'Stopped', 'Expired'):
+                raise RuntimeError(f"Batch embedding job {job_name} ended with status {status}")
+            print(f"⏳ Batch job {job_name}: {status}")
+            time.sleep(self.poll_interval)
+        
+        os.makedirs(output_dir, exist_ok=True)
+        output_paths = []
+        for obj in list_s3_objects(self.s3_client, self.bucket, output_prefix):
+            if obj['key'].endswith('.jsonl.out'):
+                path = os.path.join(output_dir, os.path.basename(obj['key']))
+                self.s3_client.download_file(self.bucket, obj['key'], path)
+                output_paths.append(path)
+        return output_paths
+
+def get_batch_embedding_executor(clients, name=BATCH_EMBEDDING_EXECUTOR):
+    """Executor selected by BATCH_EMBEDDING_EXECUTOR"""
+    if name == 'bedrock':
+        if EMBEDDING_BACKEND != 'bedrock':
+            raise ValueError("BATCH_EMBEDDING_EXECUTOR=bedrock needs EMBEDDING_BACKEND=bedrock")
+        return BedrockBatchEmbeddingExecutor(
+            boto3.client('bedrock', region_name=AWS_REGION), clients['s3']
+        )
+    return LocalBatchEmbeddingExecutor(clients['bedrock'])
+
+def ingest_batch_embedding_results(output_paths, embedding_cache, batch_size=1000):
+    """Step 3: load output shards into the embedding cache; returns (ingested, failed)"""
+    ingested = 0
+    failed = 0
+    for path in output_paths:
+        items = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                embedding = (record.get("modelOutput") or {}).get("embedding")
+                if not embedding or len(embedding) != EMBEDDING_DIMENSIONS:
+                    failed += 1
+                    continue
+                items[record["recordId"]] = array('f', embedding)
+                if len(items) >= batch_size:
+                    embedding_cache.put_many(items)
+                    ingested += len(items)
+                    items = {}
+        embedding_cache.put_many(items)
+        ingested += len(items)
+    
+    print(f"📥 Ingested {ingested} batch embeddings ({failed} failed, will use invoke_model)")
+    return ingested, failed
+
+def embed_changed_objects_offline(clients, embedding_cache, manifest, prefix):
+    """run_offline_embedding for the objects under `prefix` the manifest says need indexing"""
+    objects = [
+        obj for obj in list_s3_objects(clients['s3'], S3_BUCKET, prefix)
+        if is_statement_key(obj['key'])
+    ]
+    changed, _ = plan_incremental_index(objects, manifest, prefix)
+    return run_offline_embedding(clients, changed, embedding_cache)
+
+def run_offline_embedding(clients, objects, embedding_cache, executor=None, job_dir=BATCH_EMBEDDING_DIR):
+    """Steps 1-3 for `objects`; afterwards the indexing pass finds every vector in the cache"""
+    job_dir = os.path.join(job_dir, datetime.now().strftime('%Y%m%d-%H%M%S'))
+    input_paths = write_batch_embedding_inputs(
+        clients['s3'], objects, embedding_cache, os.path.join(job_dir, 'input')
+    )
+    if not input_paths:
+        return 0, 0
+    
+    executor = executor or get_batch_embedding_executor(clients)
+    output_paths = executor.run(input_paths, os.path.join(job_dir, 'output'))
+    return ingest_batch_embedding_results(output_paths, embedding_cache)
+
 # ==================== MAIN INDEXING LOGIC ====================
 
-def list_s3_files(s3_client, bucket, prefix=''):
-    """List all files in S3 bucket"""
+def list_s3_objects(s3_client, bucket, prefix=''):
+    """List all files in S3 bucket with their ETag and size"""
     print(f"📋 Listing files in s3://{bucket}/{prefix}")
     
-    files = []
+    objects = []
     paginator = s3_client.get_paginator('list_objects_v2')
     
     for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
         if 'Contents' in page:
             for obj in page['Contents']:
                 if not obj['Key'].endswith('/'):
-                    files.append(obj['Key'])
+                    objects.append({
+                        "key": obj['Key'],
+                        "etag": obj.get('ETag', '').strip('"'),
+                        "size": obj.get('Size', 0),
+                    })
     
-    print(f"✅ Found {len(files)} files")
-    return files
+    print(f"✅ Found {len(objects)} files")
+    return objects
+
+def list_s3_files(s3_client, bucket, prefix=''):
+    """List all files in S3 bucket"""
+    return [obj['key'] for obj in list_s3_objects(s3_client, bucket, prefix)]
+
+def list_s3_user_ids(s3_client, bucket):
+    """List the top-level user prefixes in the bucket"""
+    user_ids = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    
+    for page in paginator.paginate(Bucket=bucket, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            user_ids.append(common_prefix['Prefix'].rstrip('/'))
+    
+    return user_ids
 
 def read_s3_file(s3_client, bucket, key):
-    """Read file from S3"""
+    """Read file from S3 (decompressed if it is a gzip/zstd object)"""
     print(f"📖 Reading s3://{bucket}/{key}")
     
     try:
         response = s3_client.get_object(Bucket=bucket, Key=key)
-        content = response['Body'].read().decode('utf-8')
+        body = open_decompressed_body(response['Body'], key, response.get('ContentEncoding'))
+        content = body.read().decode('utf-8')
         print(f"✅ Read {len(content)} characters")
         return content
     except Exception as e:
         print(f"❌ Error reading file: {e}")
         raise
 
-def index_all_transactions(user_id=None, delete_existing=True):
+# ==================== STAGED PIPELINE ====================
+
+_STAGE_DONE = object()  # queue sentinel
+
+class IndexingPipeline:
     """
-    Main function to index all transactions at individual level
+    list -> fetch/parse -> embed -> upsert, with bounded queues between stages
+    Each stage has its own worker count; full queues block the stage upstream (back-pressure),
+    so memory stays at roughly queue_size chunks per stage while S3, Bedrock and Pinecone
+    calls overlap. Fetch and parse share a stage because parsing streams off the S3 body.
+    The fetch stage reads each file twice: a cheap first pass builds its RecurringProfile
+    (series detection needs the whole history before the first chunk is flagged).
+    
+    Vector ids are content-derived; transactions whose id already exists are not embedded
+    or upserted. existing_ids_for(file_key) may return the file's known ids (e.g. from the
+    manifest); if it returns None the index is asked via fetch, and the file's
+    legacy_vector_ids are deleted once all of its chunks are upserted.
+    
+    on_file_done(obj, vector_ids, upserted, unchanged) is called once every chunk of a file
+    is upserted; on_file_failed(obj, error) is called if any stage fails for that file.
+    category_stats (CategoryStatsStore) flags large/unusual purchases as rows are emitted.
+    With a `lake` (TransactionLake), every row of a file (unchanged ones too) is collected and
+    the file's lake partitions are rewritten before on_file_done; a failed write fails the file.
+    With `dedupe` (TransactionFingerprintStore), cross-source duplicates are dropped as rows are
+    emitted; sources to re-process (see end_source) collect in affected_sources.
     """
-    print("\n" + "="*60)
-    print("🚀 Starting Transaction-Level Indexing")
-    print("="*60)
     
-    # Initialize clients
-    print("\n📡 Initializing AWS clients...")
-    clients = get_aws_clients()
+    def __init__(self, s3_client, bedrock_client, index, embedding_cache=None,
+                 on_file_done=None, on_file_failed=None, existing_ids_for=None,
+                 fetch_workers=PIPELINE_FETCH_WORKERS, embed_workers=PIPELINE_EMBED_WORKERS,
+                 upsert_workers=PIPELINE_UPSERT_WORKERS, queue_size=PIPELINE_QUEUE_SIZE,
+                 chunk_size=INDEX_CHUNK_SIZE, bucket=S3_BUCKET, category_stats=None, lake=None,
+                 dedupe=None):
+        self.s3_client = s3_client
+        self.bedrock_client = bedrock_client
+        self.index = index
+        self.embedding_cache = embedding_cache
+        self.on_file_done = on_file_done
+        self.on_file_failed = on_file_failed
+        self.existing_ids_for = existing_ids_for
+        self.fetch_workers = fetch_workers
+        self.embed_workers = embed_workers
+        self.upsert_workers = upsert_workers
+        self.chunk_size = chunk_size
+        self.bucket = bucket
+        self.category_stats = category_stats
+        self.lake = lake
+        self.dedupe = dedupe
+        
+        self.fetch_queue = queue.Queue(maxsize=queue_size)
+        self.embed_queue = queue.Queue(maxsize=queue_size)
+        self.upsert_queue = queue.Queue(maxsize=queue_size)
+        self.limiter = AdaptiveConcurrencyLimiter(EMBEDDING_MAX_WORKERS)
+        self.upsert_limiter = AdaptiveConcurrencyLimiter(UPSERT_MAX_WORKERS * upsert_workers, name='Pinecone')
+        
+        self.lock = threading.Lock()
+        self.files = {}
+        # Per stage, summed over its workers: active work vs. waiting on a full downstream
+        # queue or a concurrency limiter slot
+        self.stage_seconds = {"fetch": 0.0, "embed": 0.0, "upsert": 0.0}
+        self.blocked_seconds = {"fetch": 0.0, "embed": 0.0, "upsert": 0.0}
+        self.total_indexed = 0
+        self.total_unchanged = 0
+        self.total_duplicates = 0
+        self.affected_sources = set()
+    
+    # ----- per-file bookkeeping -----
+    
+    def _start_file(self, obj):
+        known = self.existing_ids_for(obj['key']) if self.existing_ids_for else None
+        with self.lock:
+            self.files[obj['key']] = {
+                "obj": obj, "emitted": 0, "done": 0, "parsed": False,
+                "failed": False, "ids": [], "count": 0, "unchanged": 0,
+                "known": known, "occurrences": Counter(), "lake_rows": [],
+                "legacy_ids": set(),
+            }
+        if self.category_stats is not None:
+            self.category_stats.discard(obj['key'].split('/')[0], obj['key'])
+    
+    def _chunk_done(self, file_key, vectors=None, parsed=False, error=None):
+        """Record progress for a file and fire its callback once it is complete"""
+        with self.lock:
+            state = self.files.get(file_key)
+            if state is None:
+                return
+            if error is not None:
+                state["failed"] = True
+                del self.files[file_key]
+                notify = ("failed", state, error)
+            else:
+                if parsed:
+                    state["parsed"] = True
+                else:
+                    state["done"] += 1
+                if vectors:
+                    state["ids"].extend(vector["id"] for vector in vectors)
+                    state["count"] += len(vectors)
+                    self.total_indexed += len(vectors)
+                if not (state["parsed"] and state["done"] == state["emitted"]):
+                    return
+                del self.files[file_key]
+                notify = ("done", state, None)
+        
+        status, state, error = notify
+        file_key = state["obj"]["key"]
+        user_id = file_key.split('/')[0]
+        # Fingerprints are persisted before the file is recorded: if recording fails, the retry
+        # sees the same rows and end_source() is a no-op for them
+        if self.dedupe is not None:
+            if status == "done":
+                affected = self.dedupe.end_source(user_id, file_key)
+            else:
+                affected = self.dedupe.abort_source(user_id, file_key)
+            with self.lock:
+                self.affected_sources.update(affected)
+        
+        # A file new to the manifest may still have vectors under the original ids
+        if status == "done" and state["legacy_ids"]:
+            try:
+                delete_vectors_by_id(self.index, state["legacy_ids"])
+            except Exception as e:
+                print(f"❌ Failed to delete legacy vectors of {file_key}: {e}")
+                status, error = "failed", e
+        
+        if status == "done" and self.lake is not None:
+            try:
+                self.lake.write_object(user_id, file_key, state["lake_rows"])
+            except Exception as e:
+                print(f"❌ Failed to write {file_key} to the transaction lake: {e}")
+                status, error = "failed", e
+        
+        # A file whose completion cannot be recorded counts as failed, and its staged stats
+        # are dropped like any other failure
+        if status == "done" and self.on_file_done:
+            try:
+                self.on_file_done(state["obj"], state["ids"], state["count"], state["unchanged"])
+            except Exception as e:
+                print(f"❌ Failed to record {file_key}: {e}")
+                status, error = "failed", e
+        
+        if status == "failed" and self.on_file_failed:
+            self.on_file_failed(state["obj"], error)
+        
+        # The file's rows are learned only once its vectors are stored and recorded
+        if self.category_stats is not None:
+            if status == "done":
+                self.category_stats.commit(user_id, file_key)
+            else:
+                self.category_stats.discard(user_id, file_key)
+    
+    def _is_failed(self, file_key):
+        with self.lock:
+            return file_key not in self.files
+    
+    def _timed(self, stage, started, blocked=0.0):
+        with self.lock:
+            self.stage_seconds[stage] += time.time() - started - blocked
+            self.blocked_seconds[stage] += blocked
+    
+    def _put(self, stage_queue, item):
+        """Queue an item downstream; returns the seconds spent blocked on a full queue"""
+        started = time.time()
+        stage_queue.put(item)
+        return time.time() - started
+    
+    # ----- stages -----
+    
+    def _fetch_worker(self):
+        while True:
+            obj = self.fetch_queue.get()
+            if obj is _STAGE_DONE:
+                return
+            
+            file_key = obj['key']
+            user_id = file_key.split('/')[0]
+            vertical, source_type = describe_s3_key(file_key)
+            self._start_file(obj)
+            if self.dedupe is not None:
+                self.dedupe.begin_source(user_id, file_key)
+            
+            try:
+                started = time.time()
+                blocked = 0.0
+                recurring = build_recurring_profile(
+                    iter_transactions_from_s3(self.s3_client, self.bucket, file_key)
+                )
+                chunk = []
+                for idx, txn in enumerate(iter_transactions_from_s3(self.s3_client, self.bucket, file_key)):
+                    chunk.append((idx, txn))
+                    if len(chunk) >= self.chunk_size:
+                        blocked += self._emit(file_key, vertical, source_type, user_id, chunk, recurring)
+                        chunk = []
+                if chunk:
+                    blocked += self._emit(file_key, vertical, source_type, user_id, chunk, recurring)
+                self._timed("fetch", started, blocked)
+                self._chunk_done(file_key, parsed=True)
+            except Exception as e:
+                print(f"❌ Failed to fetch/parse {file_key}: {e}")
+                self._chunk_done(file_key, error=e)
+    
+    def _emit(self, file_key, vertical, source_type, user_id, chunk, recurring=None):
+        """Prepare and diff one chunk, queueing its new rows; returns seconds blocked on the queue"""
+        with self.lock:
+            state = self.files[file_key]
+        
+        prepared = prepare_transaction_records(chunk, source_type, recurring)
+        assign_vector_ids(prepared, user_id, source_type, file_key, state["occurrences"])
+        if state["known"] is None:
+            legacy_ids = legacy_vector_ids(chunk, user_id, source_type)
+            with self.lock:
+                state["legacy_ids"].update(legacy_ids)
+        
+        # Cross-source duplicates are dropped before anything is embedded
+        if self.dedupe is not None:
+            kept = self.dedupe.drop_duplicates(user_id, file_key, prepared)
+            with self.lock:
+                self.total_duplicates += len(prepared) - len(kept)
+            prepared = kept
+        
+        # Diff against what the index already holds; unchanged rows skip embed/upsert
+        ids = [record["id"] for record in prepared]
+        if state["known"] is None:
+            known = fetch_existing_ids(self.index, ids)
+        else:
+            known = state["known"].intersection(ids)
+        pending = [record for record in prepared if record["id"] not in known]
+        
+        # Rows outside the file's manifest entry are learned (see _index_transaction_chunk)
+        if self.category_stats is not None:
+            recorded = known if state["known"] is not None else set()
+            self.category_stats.annotate(
+                user_id, [record for record in prepared if record["id"] not in recorded], file_key
+            )
+            if self.lake is not None:
+                self.category_stats.score(user_id, [record for record in prepared if record["id"] in recorded])
+        
+        with self.lock:
+            state["ids"].extend(record["id"] for record in prepared if record["id"] in known)
+            state["unchanged"] += len(prepared) - len(pending)
+            self.total_unchanged += len(prepared) - len(pending)
+            if self.lake is not None:
+                state["lake_rows"].extend(
+                    transaction_lake_row(record, file_key, vertical, source_type, user_id)
+                    for record in prepared
+                )
+            if not pending:
+                return 0.0
+            state["emitted"] += 1
+        
+        # Blocks while the embed stage is saturated (back-pressure)
+        return self._put(self.embed_queue, (file_key, vertical, source_type, user_id, pending))
+    
+    def _embed_worker(self):
+        while True:
+            item = self.embed_queue.get()
+            if item is _STAGE_DONE:
+                return
+            
+            file_key, vertical, source_type, user_id, prepared = item
+            if self._is_failed(file_key):
+                continue
+            try:
+                started = time.time()
+                limiter = LimiterStallClock(self.limiter)
+                vectors = build_transaction_vectors(
+                    prepared, file_key, vertical, source_type, user_id,
+                    self.bedrock_client, self.embedding_cache, limiter
+                )
+                blocked = limiter.blocked_seconds + self._put(self.upsert_queue, (file_key, vectors))
+                self._timed("embed", started, blocked)
+            except Exception as e:
+                print(f"❌ Failed to embed chunk of {file_key}: {e}")
+                self._chunk_done(file_key, error=e)
+    
+    def _upsert_worker(self):
+        while True:
+            item = self.upsert_queue.get()
+            if item is _STAGE_DONE:
+                return
+            
+            file_key, vectors = item
+            if self._is_failed(file_key):
+                continue
+            try:
+                started = time.time()
+                limiter = LimiterStallClock(self.upsert_limiter)
+                if vectors:
+                    upsert_to_pinecone(self.index, vectors, limiter=limiter)
+                self._timed("upsert", started, limiter.blocked_seconds)
+                self._chunk_done(file_key, vectors=vectors)
+            except Exception as e:
+                print(f"❌ Failed to upsert chunk of {file_key}: {e}")
+                self._chunk_done(file_key, error=e)
+    
+    # ----- driver -----
+    
+    def _start(self, target, count):
+        threads = [threading.Thread(target=target, daemon=True) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+    
+    def run(self, objects):
+        """Push objects through every stage and wait for the pipeline to drain"""
+        fetchers = self._start(self._fetch_worker, self.fetch_workers)
+        embedders = self._start(self._embed_worker, self.embed_workers)
+        upserters = self._start(self._upsert_worker, self.upsert_workers)
+        
+        # List stage: feed objects in (blocks when fetchers fall behind)
+        for obj in objects:
+            self.fetch_queue.put(obj)
+        
+        # Drain stage by stage: sentinels flow downstream once upstream is finished
+        for stage_queue, workers in (
+            (self.fetch_queue, fetchers),
+            (self.embed_queue, embedders),
+            (self.upsert_queue, upserters),
+        ):
+            for _ in workers:
+                stage_queue.put(_STAGE_DONE)
+            for worker in workers:
+                worker.join()
+        
+        return self.total_indexed
+
+def connect_pinecone_index(clients, index_name=None):
+    """
+    Connect to the Pinecone index named in Secrets Manager (or the local store)
+    Following the pointer adopts the embedding settings stored with it; `index_name`
+    overrides the pointer and keeps this process's settings (used to build a shadow index)
+    """
+    if VECTOR_STORE_BACKEND == 'local':
+        from local_vector_store import LocalVectorIndex, LOCAL_VECTOR_STORE_PATH
+        print(f"🗄️  Using local vector store at {LOCAL_VECTOR_STORE_PATH}")
+        return LocalVectorIndex(LOCAL_VECTOR_STORE_PATH, EMBEDDING_DIMENSIONS)
     
     # Get Pinecone credentials
     print("🔑 Getting Pinecone credentials...")
     pinecone_creds = get_pinecone_credentials(clients['secrets'])
+    if index_name is None:
+        use_index_embedding_settings(pinecone_creds)
     
     # Initialize Pinecone
     print("🔗 Connecting to Pinecone...")
     pc = Pinecone(api_key=pinecone_creds['PINECONE_API_KEY'])
-    index = pc.Index(pinecone_creds['PINECONE_INDEX_NAME'])
-    
-    # Get index stats
-    stats = index.describe_index_stats()
-    print(f"📊 Current index stats: {stats['total_vector_count']} vectors")
+    index = pc.Index(index_name or pinecone_creds['PINECONE_INDEX_NAME'])
     
-    # Delete existing vectors for user if requested
-    if delete_existing and user_id:
-        delete_user_vectors(index, user_id)
+    dimension = index.describe_index_stats().get('dimension')
+    if dimension and dimension != EMBEDDING_DIMENSIONS:
+        raise ValueError(f"Index dimension {dimension} does not match EMBEDDING_DIMENSIONS={EMBEDDING_DIMENSIONS}")
+    return index
+
+def open_run_stores(state_dir=None):
+    """
+    (category_stats, dedupe, lake) for an indexing run
+    A shadow index build (state_dir set) keeps its own category stats and fingerprints next to
+    its manifest, so it never changes what the live writers decide, and leaves the lake, which
+    does not depend on the index, to the live writers.
+    """
+    if state_dir is None:
+        return CategoryStatsStore(), TransactionFingerprintStore(), open_transaction_lake()
+    os.makedirs(state_dir, exist_ok=True)
+    return (
+        CategoryStatsStore(os.path.join(state_dir, 'category_stats.sqlite3')),
+        TransactionFingerprintStore(os.path.join(state_dir, 'fingerprints.sqlite3')),
+        None,
+    )
+
+def open_transaction_lake(uri=TRANSACTION_LAKE_URI):
+    """The Parquet transaction lake at `uri`, or None when the lake is disabled"""
+    if not uri:
+        return None
+    from transaction_lake import TransactionLake
+    print(f"🧱 Writing transaction lake to {uri}")
+    return TransactionLake(uri)
+
+def sync_prefix(clients, index, embedding_cache, manifest, prefix, on_checkpoint=None, on_save=None,
+                category_stats=None, lake=None, dedupe=None):
+    """
+    Bring the index in line with s3://S3_BUCKET/<prefix> using the manifest
+    Only new/changed objects are re-processed and vectors of removed objects are deleted.
+    With a `lake`, removed objects are dropped from it too, and objects indexed before the
+    lake was enabled are re-read once to backfill it (their vectors count as unchanged);
+    touched users' partitions are compacted at the end.
+    With `dedupe`, cross-source duplicates are not indexed; sources whose duplicates lost the
+    transaction they duplicated (removed or changed) are re-processed once at the end.
+    on_checkpoint(file_key, entry) fires after each file is indexed (entry=None: removed);
+    on_save() fires every INDEX_MANIFEST_SAVE_EVERY files. `category_stats` is saved right
+    before either, so it always covers the files the saved manifest records. Returns a stats dict.
+    """
+    stats = {
+        "successful_files": 0,
+        "failed_files": 0,
+        "indexed": 0,
+        "unchanged": 0,
+        "removed_vectors": 0,
+        "duplicates": 0,
+        "stage_seconds": {},
+        "blocked_seconds": {},
+    }
     
     # List S3 files
-    prefix = f"{user_id}/" if user_id else ""
-    files = list_s3_files(clients['s3'], S3_BUCKET, prefix)
+    objects = list_s3_objects(clients['s3'], S3_BUCKET, prefix)
     
-    if not files:
+    if not objects and not any(key.startswith(prefix) for key in manifest["objects"]):
         print(f"⚠️  No files found in s3://{S3_BUCKET}/{prefix}")
-        return
-    
-    # Process each file
-    total_transactions = 0
-    successful_files = 0
-    failed_files = 0
+        return stats
     
-    for file_key in files:
-        # Only process JSON files in finance folder
-        if not file_key.endswith('.json'):
-            print(f"⏭️  Skipping non-JSON file: {file_key}")
+    # Only process statement files (JSON, CSV, OFX/QFX)
+    statement_objects = []
+    for obj in objects:
+        if not is_statement_key(obj['key']):
+            print(f"⏭️  Skipping non-statement file: {obj['key']}")
             continue
-        
+        statement_objects.append(obj)
+    
+    changed, removed = plan_incremental_index(statement_objects, manifest, prefix)
+    if lake is not None:
+        changed_keys = {obj['key'] for obj in changed}
+        changed += [
+            obj for obj in statement_objects
+            if obj['key'] not in changed_keys and not manifest["objects"][obj['key']].get('in_lake')
+        ]
+    print(f"🧾 Manifest: {len(statement_objects) - len(changed)} unchanged, "
+          f"{len(changed)} new/changed, {len(removed)} removed")
+    
+    # De-index objects that no longer exist in S3
+    affected_sources = set()
+    for file_key in removed:
+        entry = manifest["objects"][file_key]
         try:
-            # Extract user_id from file path
-            file_user_id = file_key.split('/')[0]
-            
-            # Read file
-            content = read_s3_file(clients['s3'], S3_BUCKET, file_key)
-            
-            # Index transactions
-            num_transactions = index_transactions(
-                file_key, 
-                content, 
-                clients['bedrock'], 
-                index,
-                file_user_id
-            )
+            stats["removed_vectors"] += delete_vectors_by_id(index, entry.get('vector_ids', []))
+            if lake is not None:
+                lake.remove_object(file_key.split('/')[0], file_key)
+            if dedupe is not None:
+                affected_sources |= dedupe.remove_source(file_key.split('/')[0], file_key)
+            del manifest["objects"][file_key]
+            if on_checkpoint:
+                on_checkpoint(file_key, None)
+        except Exception as e:
+            print(f"⚠️  Warning: Could not remove vectors for {file_key}: {e}")
+    
+    # Process each new or changed file through the staged pipeline
+    manifest_lock = threading.Lock()
+    
+    def on_file_done(obj, new_ids, upserted, unchanged):
+        file_key = obj['key']
+        with manifest_lock:
+            # Remove vectors this file produced last time but not this time
+            previous = manifest["objects"].get(file_key, {})
+            stale_ids = set(previous.get('vector_ids', [])) - set(new_ids)
+            if stale_ids:
+                stats["removed_vectors"] += delete_vectors_by_id(index, stale_ids)
             
-            total_transactions += num_transactions
-            successful_files += 1
+            entry = {
+                "etag": obj['etag'],
+                "size": obj['size'],
+                "last_indexed": datetime.now().isoformat(),
+                "vector_ids": new_ids,
+                "in_lake": lake is not None,
+            }
+            manifest["objects"][file_key] = entry
+            stats["successful_files"] += 1
             
-        except Exception as e:
-            print(f"❌ Failed to process {file_key}: {e}")
-            failed_files += 1
-            continue
+            # Category stats are saved whenever the manifest/journal is, so both cover the
+            # same files: a crash cannot leave files recorded whose rows the stats never kept
+            try:
+                if category_stats is not None:
+                    category_stats.commit(file_key.split('/')[0], file_key)
+                if on_checkpoint:
+                    if category_stats is not None:
+                        category_stats.save()
+                    on_checkpoint(file_key, entry)
+                if on_save and stats["successful_files"] % INDEX_MANIFEST_SAVE_EVERY == 0:
+                    if category_stats is not None:
+                        category_stats.save()
+                    on_save()
+            except Exception:
+                # Not recorded after all: the pipeline counts the file as failed instead
+                stats["successful_files"] -= 1
+                if previous:
+                    manifest["objects"][file_key] = previous
+                else:
+                    del manifest["objects"][file_key]
+                raise
+            print(f"✅ Indexed {upserted} new/changed transactions from {file_key} "
+                  f"({unchanged} unchanged)")
+    
+    def existing_ids_for(file_key):
+        with manifest_lock:
+            entry = manifest["objects"].get(file_key)
+            return set(entry.get('vector_ids', [])) if entry else None
+    
+    def on_file_failed(obj, error):
+        with manifest_lock:
+            print(f"❌ Failed to process {obj['key']}: {error}")
+            stats["failed_files"] += 1
     
-    # Final summary
+    def run_pipeline(objects):
+        pipeline = IndexingPipeline(
+            clients['s3'], clients['bedrock'], index,
+            embedding_cache=embedding_cache,
+            on_file_done=on_file_done,
+            on_file_failed=on_file_failed,
+            existing_ids_for=existing_ids_for,
+            category_stats=category_stats,
+            lake=lake,
+            dedupe=dedupe
+        )
+        stats["indexed"] += pipeline.run(objects)
+        stats["unchanged"] += pipeline.total_unchanged
+        stats["duplicates"] += pipeline.total_duplicates
+        for key in ("stage_seconds", "blocked_seconds"):
+            for stage, seconds in getattr(pipeline, key).items():
+                stats[key][stage] = stats[key].get(stage, 0.0) + seconds
+        return pipeline
+    
+    pipeline = run_pipeline(changed)
+    
+    # Duplicates whose original is gone get indexed by re-processing their sources
+    changed_keys = {obj['key'] for obj in changed}
+    affected_sources = (affected_sources - changed_keys) | pipeline.affected_sources
+    retry = [obj for obj in statement_objects if obj['key'] in affected_sources]
+    if retry:
+        print(f"🔁 Re-processing {len(retry)} sources whose duplicates lost their original")
+        run_pipeline(retry)
+    
+    if lake is not None:
+        for user_id in sorted({key.split('/')[0] for key in [obj['key'] for obj in changed + retry] + removed}):
+            compacted = lake.compact_user(user_id)
+            if compacted:
+                print(f"🧱 Compacted {compacted} lake partitions for {user_id}")
+    return stats
+
+def merge_indexing_stats(total, stats):
+    """Add one sync_prefix stats dict into a running total"""
+    for key, value in stats.items():
+        if key in ("stage_seconds", "blocked_seconds"):
+            for stage, seconds in value.items():
+                total[key][stage] = total[key].get(stage, 0.0) + seconds
+        else:
+            total[key] = total.get(key, 0) + value
+    return total
+
+def print_indexing_summary(index, stats):
+    """Final summary shared by single-user and sharded runs"""
     print("\n" + "="*60)
     print("📊 INDEXING SUMMARY")
     print("="*60)
-    print(f"Files processed: {successful_files + failed_files}")
-    print(f"✅ Successful: {successful_files}")
-    print(f"❌ Failed: {failed_files}")
-    print(f"💾 Total transactions indexed: {total_transactions}")
-    
-    # Final index stats
-    time.sleep(2)
-    final_stats = index.describe_index_stats()
+    print(f"Files processed: {stats['successful_files'] + stats['failed_files']}")
+    print(f"✅ Successful: {stats['successful_files']}")
+    print(f"❌ Failed: {stats['failed_files']}")
+    print(f"💾 Total transactions indexed: {stats['indexed']} "
+          f"({stats['unchanged']} unchanged, skipped)")
+    print(f"🗑️  Stale vectors removed: {stats['removed_vectors']}")
+    print(f"👯 Cross-source duplicates skipped: {stats.get('duplicates', 0)}")
+    print("⏱️  Stage busy time (summed over workers): " + ", ".join(
+        f"{stage} {seconds:.1f}s" for stage, seconds in stats["stage_seconds"].items()
+    ))
+    print("⏳ Stage blocked time (full queue / limiter): " + ", ".join(
+        f"{stage} {seconds:.1f}s" for stage, seconds in stats["blocked_seconds"].items()
+    ))
+    print(f"🧠 Embedding cache: {stats.get('cache_hits', 0)} hits, "
+          f"{stats.get('cache_misses', 0)} misses")
+    
+    # Final index stats (poll until writes settle instead of sleeping)
+    final_stats = wait_for_index_stats(index)
     print(f"📊 Final index: {final_stats['total_vector_count']} vectors")
     print("="*60)
     
     print("\n💡 IMPORTANT: Transaction-level indexing complete!")
     print("   Update your Lambda to use transaction-level filtering.")
 
+def index_all_transactions(user_id=None, delete_existing=False, manifest_path=INDEX_MANIFEST_PATH,
+                           processes=1, journal_path=INDEX_JOURNAL_PATH, offline_embeddings=False,
+                           index_name=None, state_dir=None):
+    """
+    Main function to index all transactions at individual level
+    Incremental: only objects that are new or changed since the last run (per the manifest)
+    are re-processed. delete_existing=True wipes the user first and rebuilds from scratch.
+    Without a user_id and with processes > 1, users are sharded across a process pool
+    (see index_all_users_sharded). offline_embeddings=True embeds the changed objects through
+    the batch executor first (see run_offline_embedding).
+    index_name/state_dir target a shadow index instead of the live one (see migrate_to_index).
+    Returns the run's stats.
+    """
+    if processes > 1 and VECTOR_STORE_BACKEND == 'local':
+        # The local store is single-writer: one process owns the directory
+        print("⚠️  Local vector store is single-process, ignoring --processes")
+        processes = 1
+    
+    if not user_id and processes > 1:
+        return index_all_users_sharded(processes, manifest_path, journal_path, offline_embeddings,
+                                       index_name, state_dir)
+    
+    print("\n" + "="*60)
+    print("🚀 Starting Transaction-Level Indexing")
+    print("="*60)
+    
+    # Initialize clients
+    print("\n📡 Initializing AWS clients...")
+    clients = get_aws_clients()
+    index = connect_pinecone_index(clients, index_name)
+    
+    # Open the embedding cache (S3 tier only if a cache bucket is configured)
+    embedding_cache = EmbeddingCache(s3_client=clients['s3'])
+    category_stats, dedupe, lake = open_run_stores(state_dir)
+    
+    # Get index stats
+    stats = index.describe_index_stats()
+    print(f"📊 Current index stats: {stats['total_vector_count']} vectors")
+    
+    prefix = f"{user_id}/" if user_id else ""
+    manifest = load_index_manifest(manifest_path)
+    
+    # Delete existing vectors for user if requested (full rebuild)
+    if delete_existing and user_id:
+        delete_user_vectors(index, user_id, wait=True)
+        for key in [key for key in manifest["objects"] if key.startswith(prefix)]:
+            del manifest["objects"][key]
+        category_stats.reset_user(user_id)
+        dedupe.reset_user(user_id)
+        if lake is not None:
+            lake.delete_user(user_id)
+    
+    try:
+        if offline_embeddings:
+            embed_changed_objects_offline(clients, embedding_cache, manifest, prefix)
+        
+        stats = sync_prefix(
+            clients, index, embedding_cache, manifest, prefix,
+            on_save=lambda: save_index_manifest(manifest, manifest_path),
+            category_stats=category_stats,
+            lake=lake,
+            dedupe=dedupe
+        )
+    finally:
+        save_index_manifest(manifest, manifest_path)
+        category_stats.close()
+        dedupe.close()
+        stats_cache = (embedding_cache.hits, embedding_cache.misses)
+        embedding_cache.close()
+    
+    stats["cache_hits"], stats["cache_misses"] = stats_cache
+    print_indexing_summary(index, stats)
+    return stats
+
+def _index_user_shard(user_id, manifest_entries, journal_path, run_id, index_name=None, state_dir=None):
+    """
+    Process-pool worker: index one user's prefix with its own clients
+    Every finished file is checkpointed in the journal; returns the user's manifest entries
+    """
+    clients = get_aws_clients()
+    index = connect_pinecone_index(clients, index_name)
+    embedding_cache = EmbeddingCache(s3_client=clients['s3'])
+    category_stats, dedupe, lake = open_run_stores(state_dir)
+    journal = IndexJournal(journal_path)
+    manifest = {"objects": dict(manifest_entries)}
+    
+    try:
+        stats = sync_prefix(
+            clients, index, embedding_cache, manifest, f"{user_id}/",
+            on_checkpoint=lambda file_key, entry: journal.record_file(run_id, user_id, file_key, entry),
+            category_stats=category_stats,
+            lake=lake,
+            dedupe=dedupe
+        )
+        stats["cache_hits"] = embedding_cache.hits
+        stats["cache_misses"] = embedding_cache.misses
+    finally:
+        embedding_cache.close()
+        category_stats.close()
+        dedupe.close()
+        journal.close()
+    
+    return user_id, manifest["objects"], stats
+
+def index_all_users_sharded(processes=INDEX_PROCESSES, manifest_path=INDEX_MANIFEST_PATH,
+                            journal_path=INDEX_JOURNAL_PATH, offline_embeddings=False,
+                            index_name=None, state_dir=None):
+    """
+    Index every user, sharding users across a process pool
+    Progress is journaled per file and per user; if a run is interrupted, the next call
+    resumes it: finished users are skipped and journaled files are folded into the manifest
+    (so they count as unchanged). A pass that completes closes its run even if some users
+    failed (they stay recorded as failed), so the next call starts a fresh incremental run
+    over every user instead of skipping the ones this run finished.
+    """
+    print("\n" + "="*60)
+    print(f"🚀 Starting Sharded Transaction-Level Indexing ({processes} processes)")
+    print("="*60)
+    
+    clients = get_aws_clients()
+    index = connect_pinecone_index(clients, index_name)
+    manifest = load_index_manifest(manifest_path)
+    journal = IndexJournal(journal_path)
+    
+    run_id, resumed = journal.start_or_resume_run()
+    done_users = set()
+    if resumed:
+        for file_key, entry in journal.file_entries(run_id).items():
+            if entry is None:
+                manifest["objects"].pop(file_key, None)
+            else:
+                manifest["objects"][file_key] = entry
+        save_index_manifest(manifest, manifest_path)
+        done_users = journal.completed_users(run_id)
+        print(f"♻️  Resuming run {run_id}: {len(done_users)} users already done")
+    
+    # Users in S3 plus users only the manifest knows about (their files were deleted)
+    user_ids = set(list_s3_user_ids(clients['s3'], S3_BUCKET))
+    user_ids.update(key.split('/')[0] for key in manifest["objects"])
+    pending = sorted(user_ids - done_users)
+    print(f"👥 {len(user_ids)} users, {len(pending)} to process")
+    
+    # One batch job for every shard; workers then read the vectors from the shared cache
+    if offline_embeddings and pending:
+        embedding_cache = EmbeddingCache(s3_client=clients['s3'])
+        try:
+            embed_changed_objects_offline(clients, embedding_cache, manifest, '')
+        finally:
+            embedding_cache.close()
+    
+    totals = {"stage_seconds": {}, "blocked_seconds": {}}
+    failed_users = []
+    
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {}
+            for user_id in pending:
+                prefix = f"{user_id}/"
+                entries = {
+                    key: entry for key, entry in manifest["objects"].items() if key.startswith(prefix)
+                }
+                futures[executor.submit(
+                    _index_user_shard, user_id, entries, journal_path, run_id, index_name, state_dir
+                )] = user_id
+            
+            for future in as_completed(futures):
+                user_id = futures[future]
+                try:
+                    _, entries, stats = future.result()
+                except Exception as e:
+                    print(f"❌ Failed to index user {user_id}: {e}")
+                    journal.record_user(run_id, user_id, 'failed')
+                    failed_users.append(user_id)
+                    continue
+                
+                prefix = f"{user_id}/"
+                for key in [key for key in manifest["objects"] if key.startswith(prefix)]:
+                    del manifest["objects"][key]
+                manifest["objects"].update(entries)
+                save_index_manifest(manifest, manifest_path)
+                merge_indexing_stats(totals, stats)
+                
+                # Failed files have no manifest entry, so the next run retries them
+                if stats["failed_files"]:
+                    journal.record_user(run_id, user_id, 'failed')
+                    failed_users.append(user_id)
+                    continue
+                
+                journal.record_user(run_id, user_id, 'done')
+                done_users.add(user_id)
+                print(f"👤 User {user_id} done ({len(done_users)}/{len(user_ids)})")
+    finally:
+        save_index_manifest(manifest, manifest_path)
+    
+    journal.finish_run(run_id)
+    journal.close()
+    if failed_users:
+        print(f"⚠️  {len(failed_users)} users failed (recorded in run {run_id}); the next run retries them")
+    
+    for key in ("successful_files", "failed_files", "indexed", "unchanged", "removed_vectors", "duplicates"):
+        totals.setdefault(key, 0)
+    totals["failed_users"] = len(failed_users)
+    print_indexing_summary(index, totals)
+    return totals
+
+# ==================== BLUE/GREEN MIGRATION ====================
+
+def verify_shadow_index(live_index, shadow_index, manifest, max_count_drift=MIGRATION_MAX_COUNT_DRIFT):
+    """
+    Raise RuntimeError unless the shadow index holds exactly the vectors its manifest lists
+    and its size is within `max_count_drift` of the live index
+    """
+    expected = sum(len(entry.get('vector_ids', [])) for entry in manifest["objects"].values())
+    shadow_count = wait_for_index_stats(shadow_index, expected)['total_vector_count']
+    live_count = live_index.describe_index_stats()['total_vector_count']
+    print(f"🔎 Shadow index: {shadow_count} vectors ({expected} expected), live index: {live_count}")
+    
+    if shadow_count != expected:
+        raise RuntimeError(f"Shadow index holds {shadow_count} vectors, its manifest lists {expected}")
+    if live_count and abs(shadow_count - live_count) > max_count_drift * live_count:
+        raise RuntimeError(f"Shadow index differs from the live index by {shadow_count - live_count} vectors "
+                           f"(more than {max_count_drift:.0%}); raise MIGRATION_MAX_COUNT_DRIFT if expected")
+
+def migrate_to_index(target_index_name, processes=INDEX_PROCESSES, state_dir=MIGRATION_STATE_DIR,
+                     drain_seconds=None, max_count_drift=MIGRATION_MAX_COUNT_DRIFT):
+    """
+    Blue/green re-embedding: build `target_index_name` (green) next to the live index (blue),
+    then move every reader and writer to it by switching the index pointer
+    Use after changing EMBEDDING_MODEL, EMBEDDING_DIMENSIONS or create_transaction_text; the
+    target must be an empty index created with EMBEDDING_DIMENSIONS.
+    1. Green is filled through the normal indexing path (embeddings for the new model, the
+       same content-addressed vector ids), with its own manifest, journal, category stats and
+       fingerprints in a "<blue>-to-<green>" directory under state_dir, so an interrupted build
+       resumes. Catch-up passes repeat until no object changed in S3 during the previous pass.
+       Live writers keep writing blue only.
+    2. Counts are verified (verify_shadow_index).
+    3. The pointer is switched in one write, together with green's EMBEDDING_MODEL and
+       EMBEDDING_DIMENSIONS, which every writer following the pointer adopts; blue stays named
+       as PINECONE_PREVIOUS_INDEX_NAME (settings as PREVIOUS_EMBEDDING_*) for rollback. After
+       drain_seconds every warm reader has re-read the pointer, and a last pass picks up what
+       live writers sent to blue in the meantime.
+    Blue is never modified; delete it once the new index has proven itself. The migration's
+    state directory is archived (".done-<timestamp>"), so a later migration starts from scratch.
+    """
+    if VECTOR_STORE_BACKEND == 'local':
+        raise ValueError("Blue/green migration needs the Pinecone backend")
+    drain_seconds = INDEX_POINTER_TTL + 60 if drain_seconds is None else drain_seconds
+    
+    print("\n" + "="*60)
+    print(f"🚀 Starting Blue/Green Migration to {target_index_name}")
+    print("="*60)
+    
+    clients = get_aws_clients()
+    pointer = get_pinecone_credentials(clients['secrets'])
+    live_index_name = pointer['PINECONE_INDEX_NAME']
+    if target_index_name == live_index_name:
+        raise ValueError(f"{target_index_name} is already the live index")
+    
+    # Per migration: a later one (even to a reused index name) never sees this one's manifest
+    state_dir = os.path.join(state_dir, f"{live_index_name}-to-{target_index_name}")
+    os.makedirs(state_dir, exist_ok=True)
+    manifest_path = os.path.join(state_dir, 'manifest.json')
+    journal_path = os.path.join(state_dir, 'journal.sqlite3')
+    # Blue is only counted: its dimension may differ from the new settings
+    live_index = Pinecone(api_key=pointer['PINECONE_API_KEY']).Index(live_index_name)
+    shadow_index = connect_pinecone_index(clients, target_index_name)
+    
+    # Vectors the shadow manifest does not know about could never be cleaned up
+    if not load_index_manifest(manifest_path)["objects"] and \
+            shadow_index.describe_index_stats()['total_vector_count']:
+        raise ValueError(f"Shadow index {target_index_name} is not empty")
+    
+    if pointer.get('PINECONE_SHADOW_INDEX_NAME') != target_index_name:
+        put_pinecone_credentials(clients['secrets'], dict(pointer, PINECONE_SHADOW_INDEX_NAME=target_index_name))
+    print(f"🟦 Live index: {live_index_name}")
+    print(f"🟩 Shadow index: {target_index_name}")
+    
+    def catch_up():
+        return index_all_transactions(
+            processes=processes, manifest_path=manifest_path, journal_path=journal_path,
+            index_name=target_index_name, state_dir=state_dir
+        )
+    
+    # 1. Build, then catch up with objects that changed while the previous pass ran
+    for attempt in range(1, MIGRATION_MAX_CATCH_UP_PASSES + 1):
+        print(f"\n🏗️  Shadow build pass {attempt}")
+        stats = catch_up()
+        if stats["failed_files"] or stats.get("failed_users"):
+            continue
+        if attempt > 1 and not stats["successful_files"] and not stats["removed_vectors"]:
+            break
+    else:
+        raise RuntimeError(f"Shadow index did not converge in {MIGRATION_MAX_CATCH_UP_PASSES} passes; "
+                           f"re-run to resume")
+    
+    # 2. Verify
+    verify_shadow_index(live_index, shadow_index, load_index_manifest(manifest_path), max_count_drift)
+    
+    # 3. Switch (re-read the secret: the API key may have been rotated meanwhile). Green's
+    #    embedding settings travel with the pointer, so writers embed the way green was built
+    pointer = get_pinecone_credentials(clients['secrets'])
+    switched = dict(pointer, PINECONE_INDEX_NAME=target_index_name, PINECONE_PREVIOUS_INDEX_NAME=live_index_name,
+                    **index_embedding_settings())
+    for key in ('EMBEDDING_MODEL', 'EMBEDDING_DIMENSIONS'):
+        if key in pointer:
+            switched[f'PREVIOUS_{key}'] = pointer[key]
+    switched.pop('PINECONE_SHADOW_INDEX_NAME', None)
+    put_pinecone_credentials(clients['secrets'], switched)
+    print(f"🔀 Index pointer switched: {live_index_name} -> {target_index_name}")
+    
+    print(f"⏳ Waiting {drain_seconds}s for cached pointers to expire...")
+    time.sleep(drain_seconds)
+    stats = catch_up()
+    os.replace(state_dir, f"{state_dir}.done-{datetime.now():%Y%m%d%H%M%S}")
+    
+    print(f"\n✅ Migration complete: {target_index_name} is live "
+          f"(rollback: point PINECONE_INDEX_NAME back at {live_index_name} and restore "
+          f"the PREVIOUS_EMBEDDING_* settings)")
+    return stats
+
 # ==================== CLI INTERFACE ====================
 
 if __name__ == "__main__":
     import sys
     
-    if len(sys.argv) > 1:
-        user_id = sys.argv[1]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    full_rebuild = '--full' in sys.argv
+    offline_embeddings = '--offline-embeddings' in sys.argv
+    processes = INDEX_PROCESSES
+    migrate_to = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('--processes='):
+            processes = int(arg.split('=', 1)[1])
+        elif arg.startswith('--migrate-to='):
+            migrate_to = arg.split('=', 1)[1]
+    
+    if migrate_to:
+        print(f"Migrating the index to {migrate_to} (blue/green)")
+        migrate_to_index(migrate_to, processes=processes)
+    elif args:
+        user_id = args[0]
         print(f"Indexing transactions for user: {user_id}")
-        index_all_transactions(user_id=user_id, delete_existing=True)
+        index_all_transactions(user_id=user_id, delete_existing=full_rebuild,
+                               offline_embeddings=offline_embeddings)
     else:
         print("Indexing all user transactions...")
         response = input("⚠️  This will re-index ALL users. Continue? (yes/no): ")
         if response.lower() == 'yes':
-            index_all_transactions(delete_existing=False)
+            index_all_transactions(delete_existing=False, processes=processes,
+                                   offline_embeddings=offline_embeddings)
         else:
             print("Cancelled.")
\ No newline at end of file
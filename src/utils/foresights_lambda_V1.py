@@ -6,6 +6,7 @@ Generates forward-looking predictions based on historical transaction patterns
 import json
 import boto3
 import os
+import time
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from pinecone import Pinecone
@@ -14,6 +15,8 @@ import uuid
 from decimal import Decimal
 import calendar
 
+from transaction_metadata_schema import decode_transaction_metadata
+
 # ==================== CONFIGURATION ====================
 
 REGION = os.environ.get('AWS_REGION', 'us-west-2')
@@ -21,6 +24,8 @@ SECRET_NAME = os.environ.get('PINECONE_SECRET_NAME', 'sagga/pinecone/credentials
 INSIGHTS_TABLE = os.environ.get('INSIGHTS_TABLE', 'sagaa-proactive-insights')
 
 EMBEDDING_MODEL = 'amazon.titan-embed-text-v1'
+EMBEDDING_DIMENSIONS = int(os.environ.get('EMBEDDING_DIMENSIONS', 1536))  # must match the index
+INDEX_POINTER_TTL = int(os.environ.get('INDEX_POINTER_TTL', 300))  # seconds between index pointer re-reads
 LLM_MODEL = 'anthropic.claude-3-5-sonnet-20241022-v2:0'
 
 # ==================== AWS CLIENTS ====================
@@ -30,21 +35,37 @@ secrets_client = boto3.client('secretsmanager', region_name=REGION)
 dynamodb = boto3.resource('dynamodb', region_name=REGION)
 
 _pinecone_index = None
+_pinecone_index_name = None
+_pointer_expires_at = 0.0
 
 def get_pinecone_index():
-    """Get Pinecone index (cached)"""
-    global _pinecone_index
+    """Get Pinecone index (cached; the index pointer is re-read every INDEX_POINTER_TTL seconds)"""
+    global _pinecone_index, _pinecone_index_name, _pointer_expires_at, EMBEDDING_DIMENSIONS
+    
+    if _pinecone_index is not None and time.time() < _pointer_expires_at:
+        return _pinecone_index
     
-    if _pinecone_index is not None:
+    if os.environ.get('VECTOR_STORE_BACKEND') == 'local':
+        from local_vector_store import LocalVectorIndex, LOCAL_VECTOR_STORE_PATH
+        _pinecone_index = LocalVectorIndex(LOCAL_VECTOR_STORE_PATH, EMBEDDING_DIMENSIONS)
+        _pointer_expires_at = float('inf')
+        print(f"[INFO] Using local vector store at {LOCAL_VECTOR_STORE_PATH}")
         return _pinecone_index
     
+    # The secret is the index pointer: a blue/green migration switches PINECONE_INDEX_NAME
     response = secrets_client.get_secret_value(SecretId=SECRET_NAME)
     credentials = json.loads(response['SecretString'])
+    _pointer_expires_at = time.time() + INDEX_POINTER_TTL
+    # Query vectors must match the dimension the live index was built with
+    EMBEDDING_DIMENSIONS = int(credentials.get('EMBEDDING_DIMENSIONS', EMBEDDING_DIMENSIONS))
+    if _pinecone_index is not None and credentials['PINECONE_INDEX_NAME'] == _pinecone_index_name:
+        return _pinecone_index
     
     pc = Pinecone(api_key=credentials['PINECONE_API_KEY'])
     _pinecone_index = pc.Index(credentials['PINECONE_INDEX_NAME'])
+    _pinecone_index_name = credentials['PINECONE_INDEX_NAME']
     
-    print(f"[INFO] Connected to Pinecone index")
+    print(f"[INFO] Connected to Pinecone index {_pinecone_index_name}")
     return _pinecone_index
 
 # ==================== DATA FETCHING ====================
@@ -76,13 +97,16 @@ def fetch_user_transactions(user_id, months=24, include_income=True):
             base_filter["type"] = {"$eq": "debit"}
         
         results = index.query(
-            vector=[0.0] * 1536,
+            vector=[0.0] * EMBEDDING_DIMENSIONS,
             filter=base_filter,
             top_k=10000,
             include_metadata=True
         )
 
-        transactions = [match['metadata'] for match in results.get('matches', [])]
+        transactions = [
+            decode_transaction_metadata(match['metadata'])
+            for match in results.get('matches', [])
+        ]
         
         # Separate income and expenses for analysis
         income_txns = [t for t in transactions if t.get('type', '').lower() == 'credit']
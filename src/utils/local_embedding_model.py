@@ -0,0 +1,95 @@
+"""
+Sagaa Local Embedding Model
+CPU-only stand-in for Bedrock Titan embeddings used by the indexer (EMBEDDING_BACKEND=local).
+A hashed n-gram model: no weights to download, no network round trips, deterministic output,
+and hundreds of texts per call at memory speed. Meant for dev, CI and cost-sensitive backfills;
+similarity is lexical, not semantic, so do not mix its vectors with Titan vectors in one index.
+
+Features per "Field: value" part of a transaction text (see create_transaction_text):
+  word unigrams and bigrams, character trigrams of each word (typo / abbreviation tolerance),
+  an amount magnitude bucket and the year-month of dates.
+Each feature is hashed (crc32) to a signed bucket; counts are log-scaled and the vector is
+L2-normalized, so cosine and dot-product scores behave like they do for Titan.
+"""
+
+import math
+import os
+import re
+import zlib
+from array import array
+
+# ==================== CONFIGURATION ====================
+
+LOCAL_EMBEDDING_MODEL_ID = 'sagaa-hashed-ngram-v1'
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.environ.get('LOCAL_EMBEDDING_BATCH_SIZE', 512))
+
+WORD_WEIGHT = 1.0
+BIGRAM_WEIGHT = 0.7
+TRIGRAM_WEIGHT = 0.35
+FIELD_SEPARATOR = ' | '
+
+_WORD_RE = re.compile(r"[a-z0-9]+(?:[.'][a-z0-9]+)*")
+_DATE_RE = re.compile(r"^(\d{4})-(\d{2})")
+
+# ==================== FEATURES ====================
+
+def _field_features(part):
+    """(feature, weight) pairs of one "Field: value" part"""
+    field, _, value = part.partition(': ')
+    if not value:
+        field, value = '', part
+    field = field.strip().lower()
+    words = _WORD_RE.findall(value.lower())
+
+    for word in words:
+        yield f"{field}:w:{word}", WORD_WEIGHT
+        padded = f"<{word}>"
+        for i in range(len(padded) - 2):
+            yield f"c:{padded[i:i + 3]}", TRIGRAM_WEIGHT
+    for first, second in zip(words, words[1:]):
+        yield f"{field}:b:{first} {second}", BIGRAM_WEIGHT
+
+    if field == 'amount':
+        try:
+            amount = abs(float(value.replace('$', '').replace(',', '')))
+        except ValueError:
+            return
+        yield f"amount:log:{int(math.log2(amount + 1) * 2)}", WORD_WEIGHT
+    elif field == 'date':
+        match = _DATE_RE.match(value.strip())
+        if match:
+            yield f"date:ym:{match.group(1)}-{match.group(2)}", WORD_WEIGHT
+
+# ==================== MODEL ====================
+
+class HashedNgramEmbedder:
+    """Deterministic hashed n-gram embeddings as float32 arrays of `dimensions` values"""
+
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+        self.model_id = f"{LOCAL_EMBEDDING_MODEL_ID}-{dimensions}"
+
+    def embed(self, text):
+        counts = {}
+        for part in text.split(FIELD_SEPARATOR):
+            for feature, weight in _field_features(part):
+                counts[feature] = counts.get(feature, 0.0) + weight
+
+        # Only touched buckets are visited: a text has ~100 features, far fewer than dimensions
+        buckets = {}
+        for feature, weight in counts.items():
+            h = zlib.crc32(feature.encode('utf-8'))
+            bucket = h % self.dimensions
+            weight = 1.0 + math.log(weight) if weight > 1.0 else weight
+            buckets[bucket] = buckets.get(bucket, 0.0) + (-weight if h & 0x80000000 else weight)
+
+        values = array('f', bytes(4 * self.dimensions))
+        norm = math.sqrt(sum(value * value for value in buckets.values()))
+        if norm:
+            for bucket, value in buckets.items():
+                values[bucket] = value / norm
+        return values
+
+    def embed_batch(self, texts):
+        """Embeddings aligned with `texts`"""
+        return [self.embed(text) for text in texts]
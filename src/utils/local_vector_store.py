@@ -0,0 +1,394 @@
+"""
+Sagaa Local Vector Store
+Embedded stand-in for the Pinecone Index used by the indexer and the insight Lambdas.
+Implements upsert / query / fetch / delete / describe_index_stats with the same call shapes,
+so pipelines can run and be benchmarked offline (VECTOR_STORE_BACKEND=local).
+
+Storage per namespace (one directory each):
+  vectors.f32   float32 matrix, memory-mapped, grown by doubling
+  records.jsonl append-only log of upserts/deletes (ids + metadata), replayed on open
+Metadata lives in per-field columns so filters and similarity are vectorized with numpy.
+Single-process only: do not share one store directory between processes.
+"""
+
+import json
+import os
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency, only needed for the local backend
+    np = None
+
+# ==================== CONFIGURATION ====================
+
+LOCAL_VECTOR_STORE_PATH = os.environ.get('LOCAL_VECTOR_STORE_PATH', '.sagaa_vector_store')
+LOCAL_VECTOR_DIMENSION = int(os.environ.get('EMBEDDING_DIMENSIONS', 1536))
+INDEX_INFO_FILE = 'index.json'  # dimension the store was created with
+INITIAL_CAPACITY = 1024
+DEFAULT_NAMESPACE = ''
+
+# ==================== FILTERS ====================
+
+def _numeric_column(column):
+    """Object column -> float64 array (NaN where the value is not a number)"""
+    values = np.full(len(column), np.nan)
+    for row, value in enumerate(column):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[row] = value
+    return values
+
+def _condition_mask(store, field, condition):
+    """Row mask for one field condition, e.g. {"$gte": 1700000000} or a bare value"""
+    if not isinstance(condition, dict):
+        condition = {"$eq": condition}
+
+    column = store.column(field)
+    mask = np.ones(store.size, dtype=bool)
+
+    for op, operand in condition.items():
+        if op == '$eq':
+            mask &= column == operand
+        elif op == '$ne':
+            mask &= column != operand
+        elif op == '$in':
+            mask &= np.isin(column, list(operand))
+        elif op == '$nin':
+            mask &= ~np.isin(column, list(operand))
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            numbers = store.numeric_column(field)
+            with np.errstate(invalid='ignore'):
+                if op == '$gt':
+                    mask &= numbers > operand
+                elif op == '$gte':
+                    mask &= numbers >= operand
+                elif op == '$lt':
+                    mask &= numbers < operand
+                else:
+                    mask &= numbers <= operand
+        else:
+            raise ValueError(f"Unsupported filter operator: {op}")
+
+    return mask
+
+def filter_mask(store, metadata_filter):
+    """Vectorized evaluation of a Pinecone-style metadata filter over a store"""
+    mask = store.alive[:store.size].copy()
+    if not metadata_filter:
+        return mask
+
+    for key, value in metadata_filter.items():
+        if key == '$and':
+            for clause in value:
+                mask &= filter_mask(store, clause)
+        elif key == '$or':
+            any_mask = np.zeros(store.size, dtype=bool)
+            for clause in value:
+                any_mask |= filter_mask(store, clause)
+            mask &= any_mask
+        else:
+            mask &= _condition_mask(store, key, value)
+
+    return mask
+
+# ==================== STORAGE ====================
+
+class _NamespaceStore:
+    """Vectors + metadata columns for one namespace"""
+
+    def __init__(self, directory, dimension):
+        self.directory = directory
+        self.dimension = dimension
+        os.makedirs(directory, exist_ok=True)
+
+        self.vector_path = os.path.join(directory, 'vectors.f32')
+        self.log_path = os.path.join(directory, 'records.jsonl')
+
+        self.size = 0  # rows ever allocated (deleted rows are only marked dead)
+        self.capacity = 0
+        self.ids = []
+        self.rows = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.columns = {}
+        self.numeric_cache = {}
+        self.vectors = None
+
+        existing_rows = 0
+        if os.path.exists(self.vector_path):
+            existing_rows = os.path.getsize(self.vector_path) // (4 * dimension)
+        self._ensure_capacity(max(existing_rows, INITIAL_CAPACITY))
+        self._replay_log()
+        self.log = open(self.log_path, 'a', encoding='utf-8')
+
+    # ----- capacity -----
+
+    def _ensure_capacity(self, needed):
+        if needed <= self.capacity:
+            return
+        capacity = max(INITIAL_CAPACITY, self.capacity)
+        while capacity < needed:
+            capacity *= 2
+
+        if self.vectors is not None:
+            self.vectors.flush()
+            del self.vectors
+        with open(self.vector_path, 'ab') as f:
+            f.truncate(capacity * self.dimension * 4)
+        self.vectors = np.memmap(self.vector_path, dtype=np.float32, mode='r+',
+                                 shape=(capacity, self.dimension))
+
+        grow = capacity - self.capacity
+        self.alive = np.concatenate([self.alive, np.zeros(grow, dtype=bool)])
+        self.norms = np.concatenate([self.norms, np.zeros(grow, dtype=np.float32)])
+        for field, column in self.columns.items():
+            self.columns[field] = np.concatenate([column, np.full(grow, None, dtype=object)])
+        self.capacity = capacity
+
+    # ----- columns -----
+
+    def column(self, field):
+        column = self.columns.get(field)
+        if column is None:
+            return np.full(self.size, None, dtype=object)
+        return column[:self.size]
+
+    def numeric_column(self, field):
+        cached = self.numeric_cache.get(field)
+        if cached is None or len(cached) != self.size:
+            cached = _numeric_column(self.column(field))
+            self.numeric_cache[field] = cached
+        return cached
+
+    def metadata(self, row):
+        return {field: column[row] for field, column in self.columns.items()
+                if column[row] is not None}
+
+    # ----- writes -----
+
+    def _apply_upsert(self, vector_id, metadata, values=None, row=None):
+        if row is None:
+            row = self.rows.get(vector_id)
+        if row is None:
+            row = self.size
+            self._ensure_capacity(row + 1)
+            self.size += 1
+            self.ids.append(vector_id)
+            self.rows[vector_id] = row
+
+        if values is not None:
+            self.vectors[row] = values
+            self.norms[row] = float(np.linalg.norm(self.vectors[row]))
+        self.alive[row] = True
+
+        for column in self.columns.values():
+            column[row] = None
+        for field, value in (metadata or {}).items():
+            if field not in self.columns:
+                self.columns[field] = np.full(self.capacity, None, dtype=object)
+            self.columns[field][row] = value
+        self.numeric_cache.clear()
+        return row
+
+    def _apply_delete(self, ids):
+        for vector_id in ids:
+            row = self.rows.pop(vector_id, None)
+            if row is not None:
+                self.alive[row] = False
+
+    def _replay_log(self):
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry['op'] == 'upsert':
+                    self._ensure_capacity(entry['row'] + 1)
+                    self.size = max(self.size, entry['row'] + 1)
+                    while len(self.ids) < self.size:
+                        self.ids.append(None)
+                    self.ids[entry['row']] = entry['id']
+                    self.rows[entry['id']] = entry['row']
+                    self._apply_upsert(entry['id'], entry['metadata'], row=entry['row'])
+                    self.norms[entry['row']] = float(np.linalg.norm(self.vectors[entry['row']]))
+                elif entry['op'] == 'delete':
+                    self._apply_delete(entry['ids'])
+
+    def upsert(self, vector_id, values, metadata):
+        row = self._apply_upsert(vector_id, metadata, values=values)
+        self.log.write(json.dumps({"op": "upsert", "id": vector_id, "row": row,
+                                   "metadata": metadata or {}}) + "\n")
+
+    def delete(self, ids):
+        ids = [vector_id for vector_id in ids if vector_id in self.rows]
+        self._apply_delete(ids)
+        if ids:
+            self.log.write(json.dumps({"op": "delete", "ids": ids}) + "\n")
+
+    def flush(self):
+        self.log.flush()
+        self.vectors.flush()
+
+    def close(self):
+        self.flush()
+        self.log.close()
+
+    @property
+    def count(self):
+        return len(self.rows)
+
+# ==================== INDEX ====================
+
+class LocalVectorIndex:
+    """
+    Drop-in for pinecone.Index backed by local memory-mapped float32 arrays
+    Similarity is cosine, computed as one matrix-vector product over the filtered rows
+    """
+
+    def __init__(self, path=LOCAL_VECTOR_STORE_PATH, dimension=LOCAL_VECTOR_DIMENSION):
+        if np is None:
+            raise ImportError("numpy is required for the local vector store backend")
+        self.path = path
+        self.dimension = dimension
+        self.lock = threading.RLock()
+        self.namespaces = {}
+        os.makedirs(path, exist_ok=True)
+
+        # Like a Pinecone index, a store has one dimension for its lifetime
+        info_path = os.path.join(path, INDEX_INFO_FILE)
+        if os.path.exists(info_path):
+            with open(info_path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)["dimension"]
+            if stored != dimension:
+                raise ValueError(f"Local vector store {path} has dimension {stored}, not {dimension}")
+        else:
+            with open(info_path, 'w', encoding='utf-8') as f:
+                json.dump({"dimension": dimension}, f)
+
+        # Re-open namespaces that already exist on disk
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)) and name.startswith('ns_'):
+                self._store(name[3:])
+
+    def _store(self, namespace):
+        namespace = namespace or DEFAULT_NAMESPACE
+        store = self.namespaces.get(namespace)
+        if store is None:
+            store = _NamespaceStore(os.path.join(self.path, f"ns_{namespace}"), self.dimension)
+            self.namespaces[namespace] = store
+        return store
+
+    @staticmethod
+    def _unpack(vector):
+        if isinstance(vector, dict):
+            return vector['id'], vector['values'], vector.get('metadata')
+        if len(vector) == 2:
+            return vector[0], vector[1], None
+        return vector[0], vector[1], vector[2]
+
+    def upsert(self, vectors, namespace=DEFAULT_NAMESPACE, **kwargs):
+        with self.lock:
+            store = self._store(namespace)
+            for vector in vectors:
+                vector_id, values, metadata = self._unpack(vector)
+                if len(values) != self.dimension:
+                    raise ValueError(
+                        f"Vector dimension {len(values)} does not match the index dimension {self.dimension}"
+                    )
+                store.upsert(vector_id, values, metadata)
+            store.log.flush()
+            return {"upserted_count": len(vectors)}
+
+    def fetch(self, ids, namespace=DEFAULT_NAMESPACE, **kwargs):
+        with self.lock:
+            store = self._store(namespace)
+            vectors = {}
+            for vector_id in ids:
+                row = store.rows.get(vector_id)
+                if row is not None:
+                    vectors[vector_id] = {
+                        "id": vector_id,
+                        "values": store.vectors[row].tolist(),
+                        "metadata": store.metadata(row),
+                    }
+            return {"vectors": vectors, "namespace": namespace}
+
+    def delete(self, ids=None, delete_all=False, filter=None, namespace=DEFAULT_NAMESPACE, **kwargs):
+        with self.lock:
+            store = self._store(namespace)
+            if delete_all:
+                ids = list(store.rows)
+            elif filter is not None:
+                rows = np.flatnonzero(filter_mask(store, filter))
+                ids = [store.ids[row] for row in rows]
+            store.delete(ids or [])
+            store.log.flush()
+            return {}
+
+    def query(self, vector=None, id=None, top_k=10, filter=None, include_values=False,
+              include_metadata=False, namespace=DEFAULT_NAMESPACE, **kwargs):
+        with self.lock:
+            store = self._store(namespace)
+            if vector is None and id is not None:
+                vector = store.vectors[store.rows[id]]
+
+            rows = np.flatnonzero(filter_mask(store, filter))
+            if len(rows) == 0:
+                return {"matches": [], "namespace": namespace}
+
+            query = np.asarray(vector, dtype=np.float32)
+            if len(query) != self.dimension:
+                raise ValueError(
+                    f"Query dimension {len(query)} does not match the index dimension {self.dimension}"
+                )
+            query_norm = float(np.linalg.norm(query))
+            if query_norm == 0.0:
+                # Metadata-only queries use a zero vector: every row scores 0
+                scores = np.zeros(len(rows), dtype=np.float32)
+            else:
+                denominators = store.norms[rows] * query_norm
+                denominators[denominators == 0] = 1.0
+                scores = (store.vectors[rows] @ query) / denominators
+
+            k = min(top_k, len(rows))
+            if k < len(rows):
+                best = np.argpartition(-scores, k - 1)[:k]
+            else:
+                best = np.arange(len(rows))
+            best = best[np.argsort(-scores[best], kind='stable')]
+
+            matches = []
+            for position in best:
+                row = rows[position]
+                match = {"id": store.ids[row], "score": float(scores[position])}
+                if include_metadata:
+                    match["metadata"] = store.metadata(row)
+                if include_values:
+                    match["values"] = store.vectors[row].tolist()
+                matches.append(match)
+
+            return {"matches": matches, "namespace": namespace}
+
+    def describe_index_stats(self, **kwargs):
+        with self.lock:
+            namespaces = {
+                name: {"vector_count": store.count} for name, store in self.namespaces.items()
+            }
+            return {
+                "dimension": self.dimension,
+                "namespaces": namespaces,
+                "total_vector_count": sum(ns["vector_count"] for ns in namespaces.values()),
+            }
+
+    def flush(self):
+        with self.lock:
+            for store in self.namespaces.values():
+                store.flush()
+
+    def close(self):
+        with self.lock:
+            for store in self.namespaces.values():
+                store.close()
+            self.namespaces = {}
@@ -0,0 +1,454 @@
+"""
+Sagaa Statement Parsers
+Streaming readers for bank exports that are not JSON: CSV (with per-bank column profiles)
+and OFX/QFX (SGML 1.x and XML 2.x). Each reads a file-like byte stream (e.g. an S3
+StreamingBody) chunk by chunk and yields transactions one at a time, in the same shape the
+JSON statements use (transaction_date, amount, description, category, type, ...), so they
+plug into the indexer wherever iter_transactions_from_json_stream does.
+"""
+
+import codecs
+import csv
+import html
+import json
+import os
+import re
+from datetime import datetime
+
+# ==================== CONFIGURATION ====================
+
+STATEMENT_READ_CHUNK_SIZE = 256 * 1024  # bytes per read
+
+# Bank CSV column profiles (JSON file overrides/extends the built-in table)
+STATEMENT_PROFILES_PATH = os.environ.get('STATEMENT_PROFILES_PATH', '')
+
+# headers: lowercased header row that identifies the bank (all must be present)
+# columns: positional names for exports without a header row
+# amount, or debit + credit: where the amount lives; amount_sign -1 for exports that list
+#   charges as positive numbers (spending is negative everywhere in Sagaa)
+CSV_BANK_PROFILES = {
+    "chase_card": {
+        "headers": ["transaction date", "post date", "description", "category", "type", "amount"],
+        "date": "transaction date",
+        "date_formats": ["%m/%d/%Y"],
+        "amount": "amount",
+        "description": "description",
+        "category": "category",
+        "type": "type",
+        "memo": "memo",
+    },
+    "chase_checking": {
+        "headers": ["details", "posting date", "description", "amount", "type", "balance"],
+        "date": "posting date",
+        "date_formats": ["%m/%d/%Y"],
+        "amount": "amount",
+        "description": "description",
+        "type": "type",
+        "check_number": "check or slip #",
+    },
+    "bank_of_america": {
+        "headers": ["date", "description", "amount", "running bal."],
+        "date": "date",
+        "date_formats": ["%m/%d/%Y"],
+        "amount": "amount",
+        "description": "description",
+    },
+    "capital_one": {
+        "headers": ["transaction date", "posted date", "card no.", "description", "category", "debit", "credit"],
+        "date": "transaction date",
+        "date_formats": ["%Y-%m-%d", "%m/%d/%Y"],
+        "debit": "debit",
+        "credit": "credit",
+        "description": "description",
+        "category": "category",
+    },
+    "citi": {
+        "headers": ["status", "date", "description", "debit", "credit"],
+        "date": "date",
+        "date_formats": ["%m/%d/%Y"],
+        "debit": "debit",
+        "credit": "credit",
+        "description": "description",
+    },
+    "discover": {
+        "headers": ["trans. date", "post date", "description", "amount", "category"],
+        "date": "trans. date",
+        "date_formats": ["%m/%d/%Y"],
+        "amount": "amount",
+        "amount_sign": -1,
+        "description": "description",
+        "category": "category",
+    },
+    "amex": {
+        "headers": ["date", "description", "card member", "account #", "amount"],
+        "date": "date",
+        "date_formats": ["%m/%d/%Y", "%m/%d/%y"],
+        "amount": "amount",
+        "amount_sign": -1,
+        "description": "description",
+        "category": "category",
+        "transaction_id": "reference",
+    },
+    "wells_fargo": {
+        "columns": ["date", "amount", "flag", "check number", "description"],
+        "date": "date",
+        "date_formats": ["%m/%d/%Y"],
+        "amount": "amount",
+        "description": "description",
+        "check_number": "check number",
+    },
+}
+
+# Fallback for unknown banks: first header present from each list wins
+GENERIC_CSV_COLUMNS = {
+    "date": ["transaction date", "trans. date", "date", "posted date", "posting date", "post date"],
+    "amount": ["amount", "transaction amount", "amount (usd)"],
+    "debit": ["debit", "withdrawal", "withdrawals", "debit amount"],
+    "credit": ["credit", "deposit", "deposits", "credit amount"],
+    "description": ["description", "payee", "name", "details", "merchant", "memo"],
+    "merchant": ["merchant", "merchant name", "payee"],
+    "category": ["category", "merchant category"],
+    "type": ["type", "transaction type"],
+    "transaction_id": ["transaction id", "reference", "reference number", "id"],
+    "memo": ["memo", "notes"],
+}
+GENERIC_DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%d/%m/%Y", "%Y/%m/%d", "%d-%b-%Y", "%b %d, %Y"]
+
+# OFX <TRNTYPE> values that move money into the account
+OFX_CREDIT_TYPES = {'CREDIT', 'DEP', 'INT', 'DIV', 'DIRECTDEP'}
+
+def load_csv_bank_profiles(path=STATEMENT_PROFILES_PATH):
+    """Profile table from a JSON file if one is configured (merged over the built-ins)"""
+    profiles = dict(CSV_BANK_PROFILES)
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            profiles.update(json.load(f))
+        print(f"🏦 Loaded {len(profiles)} bank CSV profiles from {path}")
+    return profiles
+
+_csv_bank_profiles = None
+
+def get_csv_bank_profiles():
+    global _csv_bank_profiles
+
+    if _csv_bank_profiles is None:
+        _csv_bank_profiles = load_csv_bank_profiles()
+    return _csv_bank_profiles
+
+# ==================== SHARED HELPERS ====================
+
+def iter_text_chunks(body, chunk_size=STATEMENT_READ_CHUNK_SIZE, encoding='utf-8'):
+    """Decode a byte stream incrementally (a leading BOM is dropped)"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    first = True
+    while True:
+        chunk = body.read(chunk_size)
+        text = decoder.decode(chunk or b'', final=not chunk)
+        if first and text:
+            text = text.lstrip('﻿')
+            first = False
+        if text:
+            yield text
+        if not chunk:
+            return
+
+def iter_text_lines(body, chunk_size=STATEMENT_READ_CHUNK_SIZE):
+    """Lines of a byte stream with their line endings, holding at most one chunk + one line"""
+    pending = ''
+    for text in iter_text_chunks(body, chunk_size):
+        lines = (pending + text).splitlines(keepends=True)
+        pending = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+        yield from lines
+    if pending:
+        yield pending
+
+def parse_statement_amount(value):
+    """'$1,234.56', '(12.00)', '-5', '12.00 CR' -> float, or None if blank/unparseable"""
+    text = str(value or '').strip().replace('$', '').replace(',', '').replace(' ', '')
+    if not text:
+        return None
+    sign = 1.0
+    if text.startswith('(') and text.endswith(')'):
+        sign, text = -1.0, text[1:-1]
+    upper = text.upper()
+    if upper.endswith('CR'):
+        text = text[:-2]
+    elif upper.endswith('DR'):
+        sign, text = -sign, text[:-2]
+    try:
+        return sign * float(text)
+    except ValueError:
+        return None
+
+def normalize_statement_date(value, formats=GENERIC_DATE_FORMATS):
+    """Bank date text -> 'YYYY-MM-DD' (the format the date dimension is keyed by)"""
+    text = str(value or '').strip()
+    for date_format in formats:
+        try:
+            return datetime.strptime(text, date_format).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return text
+
+# ==================== CSV ====================
+
+def _is_date(value):
+    text = str(value or '').strip()
+    for date_format in GENERIC_DATE_FORMATS:
+        try:
+            datetime.strptime(text, date_format)
+            return True
+        except ValueError:
+            continue
+    return False
+
+def _profile_named_in(file_key, profiles):
+    """Profile whose name appears as whole words in the file name (amex_card.csv -> amex_card)"""
+    words = re.findall(r'[a-z0-9]+', file_key.rsplit('/', 1)[-1].lower())
+    named = []
+    for name in profiles:
+        name_words = re.findall(r'[a-z0-9]+', name.lower())
+        size = len(name_words)
+        if size and any(words[i:i + size] == name_words for i in range(len(words) - size + 1)):
+            named.append((size, name))
+    if not named:
+        return None
+    return max(named)[1]
+
+def detect_csv_profile(first_row, file_key='', profiles=None):
+    """
+    Pick the bank profile for a CSV export
+    The profile whose identifying headers all appear in the first row wins (most specific
+    first); otherwise a profile named by whole words of the file name (e.g.
+    user/finance/amex_card.csv, but not citizens.csv for "citi"); headerless exports without
+    one match a positional profile with the same column count.
+    Returns (name, profile, has_header); unknown layouts get a generic profile from the header.
+    """
+    profiles = profiles or get_csv_bank_profiles()
+    headers = [cell.strip().lower() for cell in first_row]
+    has_header = not any(_is_date(cell) for cell in first_row)
+    named = _profile_named_in(file_key, profiles)
+
+    if has_header:
+        matches = [
+            (len(profile["headers"]), name, profile) for name, profile in profiles.items()
+            if "headers" in profile and set(profile["headers"]) <= set(headers)
+        ]
+        if matches:
+            _, name, profile = max(matches, key=lambda match: match[0])
+            return name, profile, True
+
+    if named is not None:
+        profile = profiles[named]
+        return named, profile, has_header and "headers" in profile
+
+    if has_header:
+        generic = {"date_formats": GENERIC_DATE_FORMATS}
+        for field, candidates in GENERIC_CSV_COLUMNS.items():
+            for candidate in candidates:
+                if candidate in headers:
+                    generic[field] = candidate
+                    break
+        if "date" not in generic or not ("amount" in generic or "debit" in generic or "credit" in generic):
+            raise ValueError(f"Unrecognized CSV layout in {file_key}: {first_row}")
+        return "generic", generic, True
+
+    for name, profile in profiles.items():
+        if len(profile.get("columns", [])) == len(first_row):
+            return name, profile, False
+    raise ValueError(f"Unrecognized headerless CSV layout in {file_key} ({len(first_row)} columns)")
+
+def csv_row_to_transaction(row, profile, profile_name):
+    """One CSV row (dict keyed by lowercased column name) -> transaction dict, or None to skip"""
+    def cell(field):
+        column = profile.get(field)
+        return (row.get(column) or '').strip() if column else ''
+
+    if "amount" in profile:
+        amount = parse_statement_amount(cell("amount"))
+        if amount is not None:
+            amount *= profile.get("amount_sign", 1)
+    else:
+        debit = parse_statement_amount(cell("debit"))
+        credit = parse_statement_amount(cell("credit"))
+        if debit is None and credit is None:
+            amount = None
+        else:
+            amount = abs(credit or 0.0) - abs(debit or 0.0)
+
+    date = cell("date")
+    if amount is None or not date:
+        return None  # blank/summary line
+
+    transaction = {
+        "transaction_date": normalize_statement_date(date, profile.get("date_formats", GENERIC_DATE_FORMATS)),
+        "amount": amount,
+        "description": cell("description"),
+        "merchant": cell("merchant"),
+        "category": cell("category"),
+        "type": 'credit' if amount > 0 else 'debit',
+        "source_format": "csv",
+        "bank_profile": profile_name,
+    }
+    # Banks use their own words ("Sale", "ACH_DEBIT", "Payment"); the sign decides type
+    if cell("type"):
+        transaction["bank_type"] = cell("type").lower()
+    for field in ("transaction_id", "memo", "check_number"):
+        value = cell(field)
+        if value:
+            transaction[field] = value
+    return transaction
+
+def iter_transactions_from_csv_stream(body, file_key, chunk_size=STATEMENT_READ_CHUNK_SIZE):
+    """
+    Stream transactions out of a bank CSV export
+    Memory is bounded by one read chunk plus one row; quoted fields may span lines.
+    """
+    reader = csv.reader(iter_text_lines(body, chunk_size))
+    count = 0
+
+    first_row = next((row for row in reader if any(cell.strip() for cell in row)), None)
+    if first_row is None:
+        print(f"📊 Streamed 0 transactions from {file_key}")
+        return
+
+    profile_name, profile, has_header = detect_csv_profile(first_row, file_key)
+    columns = [cell.strip().lower() for cell in first_row] if has_header else profile.get("columns")
+    print(f"🏦 {file_key}: CSV profile '{profile_name}'")
+
+    if not has_header and "columns" not in profile:
+        raise ValueError(f"CSV profile '{profile_name}' needs a header row ({file_key})")
+    rows = reader if has_header else _prepend(first_row, reader)
+    for values in rows:
+        transaction = csv_row_to_transaction(dict(zip(columns, values)), profile, profile_name)
+        if transaction is None:
+            continue
+        count += 1
+        yield transaction
+
+    print(f"📊 Streamed {count} transactions from {file_key}")
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
+
+# ==================== OFX / QFX ====================
+
+_OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9._]+)>([^<]*)')
+_OFX_CHARSET = re.compile(rb'CHARSET:\s*(\d+)|encoding="([A-Za-z0-9_.-]+)"')
+
+class _Rewound:
+    """A byte stream with its already-read first chunk put back in front"""
+
+    def __init__(self, head, body):
+        self.head = head
+        self.body = body
+
+    def read(self, size=-1):
+        if self.head:
+            head, self.head = self.head, b''
+            return head
+        return self.body.read(size)
+
+def sniff_ofx_encoding(head):
+    """Text encoding declared by an OFX header (1.x CHARSET or 2.x XML declaration)"""
+    match = _OFX_CHARSET.search(head)
+    if match and match.group(1):
+        return f"cp{match.group(1).decode('ascii')}"
+    if match and match.group(2):
+        return match.group(2).decode('ascii')
+    return 'utf-8'
+
+def parse_ofx_datetime(value):
+    """OFX date-time ('20240131', '20240131120000.000[-5:EST]') -> 'YYYY-MM-DD'"""
+    digits = (value or '').strip()[:8]
+    try:
+        return datetime.strptime(digits, '%Y%m%d').strftime('%Y-%m-%d')
+    except ValueError:
+        return (value or '').strip()
+
+def iter_ofx_elements(body, chunk_size=STATEMENT_READ_CHUNK_SIZE):
+    """
+    (closing, tag, text) for every tag of an OFX document, streamed
+    Works for SGML OFX 1.x (leaf tags are not closed) and XML OFX 2.x alike.
+    """
+    head = b''
+    while len(head) < 1024:  # the OFX header / XML declaration
+        more = body.read(chunk_size)
+        if not more:
+            break
+        head += more
+    try:
+        encoding = codecs.lookup(sniff_ofx_encoding(head)).name
+    except LookupError:
+        encoding = 'utf-8'
+
+    buffer = ''
+    for text in iter_text_chunks(_Rewound(head, body), chunk_size, encoding):
+        buffer += text
+        # Only consume up to the last '<': the tag after it may be cut off mid-chunk
+        cut = buffer.rfind('<')
+        if cut <= 0:
+            continue
+        for match in _OFX_TAG.finditer(buffer, 0, cut):
+            yield match.group(1) == '/', match.group(2).upper(), html.unescape(match.group(3).strip())
+        buffer = buffer[cut:]
+    for match in _OFX_TAG.finditer(buffer):
+        yield match.group(1) == '/', match.group(2).upper(), html.unescape(match.group(3).strip())
+
+def ofx_transaction(fields, account_type):
+    """<STMTTRN> fields -> transaction dict, or None if it has no amount"""
+    amount = parse_statement_amount(fields.get('TRNAMT'))
+    if amount is None:
+        return None
+
+    trn_type = fields.get('TRNTYPE', '').upper()
+    name = fields.get('NAME') or fields.get('PAYEE') or ''
+    memo = fields.get('MEMO', '')
+    transaction = {
+        "transaction_date": parse_ofx_datetime(fields.get('DTPOSTED') or fields.get('DTUSER')),
+        "amount": amount,
+        "description": name or memo,
+        "merchant": name,
+        "category": fields.get('SIC', ''),
+        "type": 'credit' if amount > 0 or trn_type in OFX_CREDIT_TYPES else 'debit',
+        "source_format": "ofx",
+        "ofx_type": trn_type.lower(),
+        "account_type": account_type,
+    }
+    if fields.get('FITID'):
+        transaction["transaction_id"] = fields['FITID']
+    if memo and memo != transaction["description"]:
+        transaction["memo"] = memo
+    if fields.get('CHECKNUM'):
+        transaction["check_number"] = fields['CHECKNUM']
+    return transaction
+
+def iter_transactions_from_ofx_stream(body, file_key, chunk_size=STATEMENT_READ_CHUNK_SIZE):
+    """
+    Stream <STMTTRN> records out of an OFX/QFX download (bank and credit card statements)
+    Only the transaction being read is held in memory.
+    """
+    count = 0
+    fields = None
+    account_type = 'bank_account'
+
+    for closing, tag, text in iter_ofx_elements(body, chunk_size):
+        if tag == 'CCSTMTRS' and not closing:
+            account_type = 'credit_card'
+        elif tag == 'STMTRS' and not closing:
+            account_type = 'bank_account'
+        elif tag == 'STMTTRN':
+            if not closing:
+                fields = {}
+                continue
+            if fields is not None:
+                transaction = ofx_transaction(fields, account_type)
+                fields = None
+                if transaction is not None:
+                    count += 1
+                    yield transaction
+        elif fields is not None and not closing and text:
+            fields[tag] = text
+
+    print(f"📊 Streamed {count} transactions from {file_key}")
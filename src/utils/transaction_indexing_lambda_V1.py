@@ -0,0 +1,333 @@
+"""
+Sagaa Incremental Transaction Indexer (S3 events)
+Keeps the transaction index in sync with the datalake as statements are uploaded or deleted.
+Triggered by S3 ObjectCreated/ObjectRemoved notifications, either directly or through an SQS
+queue (recommended: the queue's batch window coalesces bursts of uploads for the same user).
+
+Each affected object is reconciled against its current state in S3, so duplicate, late or
+out-of-order events are harmless: an object that exists is (re-)indexed if its ETag changed,
+an object that is gone has its vectors deleted. Per-object state (ETag + vector ids) lives in
+DynamoDB because the Lambda has no durable local disk.
+"""
+
+import json
+import os
+import time
+import zlib
+from datetime import datetime
+from urllib.parse import unquote_plus
+
+import boto3
+from botocore.exceptions import ClientError
+
+import claude_Transaction_Level_Indexing_v3 as indexer
+
+# ==================== CONFIGURATION ====================
+
+REGION = os.environ.get('AWS_REGION', 'us-west-2')
+MANIFEST_TABLE = os.environ.get('INDEX_MANIFEST_TABLE', 'sagaa-index-manifest')
+EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', '/tmp/sagaa_embedding_cache.sqlite3')
+# /tmp is the function's ephemeral storage (512 MB unless configured): keep the local cache tier
+# well below it, a full disk fails every SQLite write. 0 disables the local tier (S3 tier only)
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get('EMBEDDING_CACHE_MAX_BYTES', 192 * 1024 ** 2))
+
+# Large/unusual flags need history that survives cold starts: point this at an EFS mount
+CATEGORY_STATS_PATH = os.environ.get('CATEGORY_STATS_PATH', '')
+
+# Cross-source duplicate detection also needs durable state (EFS); disabled when unset
+DEDUPE_PATH = os.environ.get('DEDUPE_PATH', '')
+
+# The Parquet transaction lake is enabled by TRANSACTION_LAKE_URI (s3://bucket/prefix), see the indexer
+
+MANIFEST_PART_BYTES = 350 * 1024  # DynamoDB items are capped at 400 KB
+
+# ==================== AWS CLIENTS ====================
+
+dynamodb = boto3.resource('dynamodb', region_name=REGION)
+
+_clients = None
+_index = None
+_index_expires_at = 0.0
+
+def get_clients_and_index():
+    """
+    AWS clients + vector index (cached across warm invocations)
+    The index pointer is re-read every INDEX_POINTER_TTL seconds so a blue/green switch
+    (see indexer.migrate_to_index) reaches warm containers too
+    """
+    global _clients, _index, _index_expires_at
+
+    if _clients is None:
+        _clients = indexer.get_aws_clients()
+    if _index is None or time.time() >= _index_expires_at:
+        _index = indexer.connect_pinecone_index(_clients)
+        _index_expires_at = (
+            float('inf') if indexer.VECTOR_STORE_BACKEND == 'local' else time.time() + indexer.INDEX_POINTER_TTL
+        )
+        print(f"[INFO] Connected to vector index")
+    return _clients, _index
+
+# ==================== MANIFEST ====================
+
+class DynamoIndexManifest:
+    """
+    Per-object index state: {etag, size, last_indexed, vector_ids}
+    Vector ids are stored zlib-compressed; objects with very many rows spill the ids into
+    continuation items ("<key>#1", "<key>#2", ...).
+    """
+
+    def __init__(self, table_name=MANIFEST_TABLE):
+        self.table = dynamodb.Table(table_name)
+
+    def get(self, s3_key):
+        item = self.table.get_item(Key={'s3_key': s3_key}).get('Item')
+        if not item:
+            return None
+
+        blob = bytes(getattr(item['vector_ids'], 'value', item['vector_ids']))
+        for part in range(1, int(item.get('parts', 1))):
+            extra = self.table.get_item(Key={'s3_key': f"{s3_key}#{part}"})['Item']['vector_ids']
+            blob += bytes(getattr(extra, 'value', extra))
+
+        ids = zlib.decompress(blob).decode('utf-8')
+        return {
+            "etag": item['etag'],
+            "size": int(item.get('size', 0)),
+            "last_indexed": item.get('last_indexed', ''),
+            "vector_ids": ids.split('\n') if ids else [],
+        }
+
+    def put(self, s3_key, entry):
+        previous = self.table.get_item(Key={'s3_key': s3_key}).get('Item')
+        blob = zlib.compress('\n'.join(entry['vector_ids']).encode('utf-8'))
+        parts = [blob[i:i + MANIFEST_PART_BYTES] for i in range(0, len(blob), MANIFEST_PART_BYTES)] or [b'']
+
+        with self.table.batch_writer() as batch:
+            for part in range(1, len(parts)):
+                batch.put_item(Item={'s3_key': f"{s3_key}#{part}", 'vector_ids': parts[part]})
+            batch.put_item(Item={
+                's3_key': s3_key,
+                'etag': entry['etag'],
+                'size': entry['size'],
+                'last_indexed': entry['last_indexed'],
+                'parts': len(parts),
+                'vector_ids': parts[0],
+            })
+            if previous:
+                for part in range(len(parts), int(previous.get('parts', 1))):
+                    batch.delete_item(Key={'s3_key': f"{s3_key}#{part}"})
+
+    def delete(self, s3_key):
+        item = self.table.get_item(Key={'s3_key': s3_key}).get('Item')
+        if not item:
+            return
+        with self.table.batch_writer() as batch:
+            for part in range(1, int(item.get('parts', 1))):
+                batch.delete_item(Key={'s3_key': f"{s3_key}#{part}"})
+            batch.delete_item(Key={'s3_key': s3_key})
+
+# ==================== EVENTS ====================
+
+def iter_s3_records(event):
+    """S3 notification records from a direct S3 event or from SQS-wrapped S3 events"""
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            body = json.loads(record.get('body') or '{}')
+            # SNS fan-out wraps the S3 event once more
+            if 'Message' in body and 'Records' not in body:
+                body = json.loads(body['Message'])
+            for s3_record in body.get('Records', []):
+                yield record.get('messageId'), s3_record
+        elif record.get('eventSource') == 'aws:s3':
+            yield None, record
+
+def collect_object_changes(event):
+    """
+    Coalesce an event batch into {bucket: {key: message_ids}}
+    Only which objects changed matters: each one is reconciled against S3, so N events for
+    the same key cost one sync.
+    """
+    changes = {}
+    for message_id, record in iter_s3_records(event):
+        if 's3' not in record:
+            continue  # e.g. s3:TestEvent
+        bucket = record['s3']['bucket']['name']
+        key = unquote_plus(record['s3']['object']['key'])
+        if '/' not in key or not indexer.is_statement_key(key):
+            continue
+        message_ids = changes.setdefault(bucket, {}).setdefault(key, set())
+        if message_id:
+            message_ids.add(message_id)
+    return changes
+
+# ==================== SYNC ====================
+
+def head_object(s3_client, bucket, key):
+    """head_object, or None if the object does not exist"""
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+def sync_object(clients, index, manifest, bucket, key, embedding_cache=None, category_stats=None,
+                lake=None, dedupe=None, affected_sources=None, force=False):
+    """
+    Bring one object's vectors in line with S3
+    Returns (status, vectors): 'indexed' + the object's vector count, 'removed' + vectors
+    deleted, or 'unchanged' + 0
+    `force` re-indexes an unchanged object (its duplicates' canonical rows went away)
+    """
+    head = head_object(clients['s3'], bucket, key)
+    entry = manifest.get(key)
+    previous_ids = set(entry['vector_ids']) if entry else set()
+
+    if head is None:
+        removed = indexer.delete_vectors_by_id(index, previous_ids) if previous_ids else 0
+        if lake is not None:
+            lake.remove_object(key.split('/')[0], key)
+        if dedupe is not None:
+            affected = dedupe.remove_source(key.split('/')[0], key)
+            if affected_sources is not None:
+                affected_sources.update(affected)
+        manifest.delete(key)
+        print(f"[INFO] De-indexed {key}: {removed} vectors removed")
+        return 'removed', removed
+
+    etag = head.get('ETag', '').strip('"')
+    if entry and entry['etag'] == etag and not force:
+        print(f"[SKIP] {key} unchanged (ETag {etag})")
+        return 'unchanged', 0
+
+    user_id = key.split('/')[0]
+    vector_ids = []
+    lake_rows = [] if lake is not None else None
+    try:
+        recurring = indexer.build_recurring_profile(
+            indexer.iter_transactions_from_s3(clients['s3'], bucket, key)
+        )
+        indexer.index_transactions(
+            key, indexer.iter_transactions_from_s3(clients['s3'], bucket, key),
+            clients['bedrock'], index, user_id,
+            embedding_cache=embedding_cache,
+            vector_ids=vector_ids,
+            existing_ids=previous_ids if entry else None,
+            recurring=recurring,
+            category_stats=category_stats,
+            lake_rows=lake_rows,
+            dedupe=dedupe,
+            affected_sources=affected_sources
+        )
+
+        # Rows that disappeared from the new version of the object
+        stale_ids = previous_ids - set(vector_ids)
+        if stale_ids:
+            indexer.delete_vectors_by_id(index, stale_ids)
+        if lake is not None:
+            lake.write_object(user_id, key, lake_rows)
+
+        manifest.put(key, {
+            "etag": etag,
+            "size": head.get('ContentLength', 0),
+            "last_indexed": datetime.now().isoformat(),
+            "vector_ids": vector_ids,
+        })
+    except Exception:
+        # The object will be retried: its rows must not be learned twice
+        if category_stats is not None:
+            category_stats.discard(user_id, key)
+        raise
+
+    # Saved with the manifest entry: a later crash cannot lose rows the manifest calls indexed
+    if category_stats is not None:
+        category_stats.commit(user_id, key)
+        category_stats.save()
+    return 'indexed', len(vector_ids)
+
+# ==================== HANDLER ====================
+
+def lambda_handler(event, context):
+    """
+    Entry point for S3 ObjectCreated/ObjectRemoved notifications (direct or via SQS)
+    With SQS, messages whose objects failed are reported as batchItemFailures so only
+    they are retried (enable ReportBatchItemFailures on the event source mapping).
+    """
+    print(f"[INFO] Transaction indexer Lambda started")
+
+    changes = collect_object_changes(event)
+    if not changes:
+        print(f"[SKIP] No indexable objects in event")
+        return {'statusCode': 200, 'body': json.dumps({'processed_objects': 0}), 'batchItemFailures': []}
+
+    clients, index = get_clients_and_index()
+    manifest = DynamoIndexManifest()
+    embedding_cache = indexer.EmbeddingCache(
+        path=EMBEDDING_CACHE_PATH if EMBEDDING_CACHE_MAX_BYTES else ':memory:',
+        max_bytes=EMBEDDING_CACHE_MAX_BYTES,
+        s3_client=clients['s3']
+    )
+    category_stats = indexer.CategoryStatsStore(CATEGORY_STATS_PATH) if CATEGORY_STATS_PATH else None
+    dedupe = indexer.TransactionFingerprintStore(DEDUPE_PATH) if DEDUPE_PATH else None
+    lake = indexer.open_transaction_lake()
+
+    results = []
+    failed_messages = set()
+
+    try:
+        for bucket, objects in changes.items():
+            # One pass per user: a burst of uploads shares the caches and the stats
+            by_user = {}
+            for key, message_ids in objects.items():
+                by_user.setdefault(key.split('/')[0], {})[key] = message_ids
+
+            for user_id, user_objects in sorted(by_user.items()):
+                print(f"[INFO] Syncing {len(user_objects)} objects for user {user_id}")
+                affected_sources = set()
+                pending = sorted(user_objects.items())
+                force = False
+                while pending:
+                    for key, message_ids in pending:
+                        try:
+                            status, count = sync_object(
+                                clients, index, manifest, bucket, key, embedding_cache, category_stats,
+                                lake, dedupe, affected_sources, force
+                            )
+                            results.append({'s3_key': key, 'status': status, 'vectors': count})
+                        except Exception as e:
+                            print(f"[ERROR] Failed to sync {key}: {e}")
+                            import traceback
+                            traceback.print_exc()
+                            failed_messages.update(message_ids)
+                            results.append({'s3_key': key, 'status': 'error', 'error': str(e)})
+
+                    # Objects whose duplicates lost their canonical rows: re-index them once
+                    pending = [] if force else [
+                        (key, user_objects.get(key, set())) for key in sorted(affected_sources)
+                    ]
+                    if pending:
+                        print(f"[INFO] Re-indexing {len(pending)} objects with orphaned duplicates")
+                    force = True
+
+                if category_stats is not None:
+                    category_stats.save()
+                if lake is not None:
+                    lake.compact_user(user_id)
+    finally:
+        embedding_cache.close()
+        if category_stats is not None:
+            category_stats.close()
+        if dedupe is not None:
+            dedupe.close()
+
+    print(f"[INFO] Results: {json.dumps(results)}")
+    
+    # Direct S3 invocations have no messages to report: fail so Lambda retries the event
+    if any(result['status'] == 'error' for result in results) and not failed_messages:
+        raise RuntimeError("One or more objects failed to sync")
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'processed_objects': len(results), 'results': results}),
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in sorted(failed_messages)],
+    }
@@ -0,0 +1,231 @@
+"""
+Sagaa Transaction Lake
+Columnar copy of every indexed transaction, written by the indexer next to the vector index.
+Parquet files are partitioned Hive-style by user, year and month so aggregations scan a few
+compact columns instead of paging vector metadata out of Pinecone.
+
+Layout under the lake root (local path or s3://bucket/prefix):
+  user_id=<u>/year=<y>/month=<m>/base.parquet           compacted rows
+  user_id=<u>/year=<y>/month=<m>/delta-<tag>.parquet    latest rows of one source object
+Writes are idempotent: re-writing a source object replaces its delta files (the tag is a hash
+of the object key), and a delta supersedes that object's rows in base.parquet. An empty delta
+is a tombstone. compact_partition() folds deltas into base.parquet.
+One writer per user at a time (the indexer shards by user).
+"""
+
+import hashlib
+import os
+import posixpath
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.fs as pafs
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency, only needed when the lake is enabled
+    pa = None
+
+# ==================== CONFIGURATION ====================
+
+TRANSACTION_LAKE_URI = os.environ.get('TRANSACTION_LAKE_URI', '')
+LAKE_COMPACT_MIN_FILES = int(os.environ.get('LAKE_COMPACT_MIN_FILES', 8))  # deltas per partition
+LAKE_COMPRESSION = 'zstd'
+
+BASE_FILE = 'base.parquet'
+DELTA_PREFIX = 'delta-'
+
+# Column name -> pyarrow type name (order is the file schema)
+LAKE_COLUMNS = [
+    ("id", "string"),
+    ("user_id", "string"),
+    ("source_key", "string"),
+    ("source_tag", "string"),
+    ("source_type", "string"),
+    ("vertical", "string"),
+    ("date", "string"),
+    ("timestamp", "int64"),
+    ("year", "int32"),
+    ("month", "int32"),
+    ("day", "int32"),
+    ("day_of_week_num", "int32"),
+    ("week_of_year", "int32"),
+    ("quarter", "string"),
+    ("is_weekend", "bool_"),
+    ("amount", "float64"),
+    ("type", "string"),
+    ("category", "string"),
+    ("description", "string"),
+    ("merchant", "string"),
+    ("goal_contribution", "string"),
+    ("is_income", "bool_"),
+    ("is_subscription", "bool_"),
+    ("is_bill", "bool_"),
+    ("is_transfer", "bool_"),
+    ("is_refund", "bool_"),
+    ("is_discretionary", "bool_"),
+    ("affects_budget", "bool_"),
+    ("is_recurring", "bool_"),
+    ("recurring_frequency", "string"),
+    ("is_large_purchase", "bool_"),
+    ("is_unusual", "bool_"),
+    ("indexed_at", "string"),
+]
+
+def lake_schema():
+    return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in LAKE_COLUMNS])
+
+def _delta_names(names):
+    return [name for name in names if name.startswith(DELTA_PREFIX) and name.endswith('.parquet')]
+
+def source_tag(s3_key):
+    """Short stable tag for a source object (names its delta files)"""
+    return hashlib.sha1(s3_key.encode('utf-8')).hexdigest()[:16]
+
+# ==================== LAKE ====================
+
+class TransactionLake:
+    """Partitioned Parquet store of normalized transactions"""
+
+    def __init__(self, uri=TRANSACTION_LAKE_URI, compact_min_files=LAKE_COMPACT_MIN_FILES):
+        if pa is None:
+            raise ImportError("pyarrow is required for the transaction lake")
+        if '://' in uri:
+            self.fs, self.root = pafs.FileSystem.from_uri(uri)
+        else:
+            self.fs, self.root = pafs.LocalFileSystem(), os.path.abspath(uri)
+        self.compact_min_files = compact_min_files
+        self.schema = lake_schema()
+
+    # ----- paths -----
+
+    def _user_dir(self, user_id):
+        return posixpath.join(self.root, f"user_id={user_id}")
+
+    def _partition_dir(self, user_id, year, month):
+        return posixpath.join(self._user_dir(user_id), f"year={year}", f"month={month}")
+
+    def _list(self, directory, recursive=False):
+        selector = pafs.FileSelector(directory, recursive=recursive, allow_not_found=True)
+        return [info for info in self.fs.get_file_info(selector) if info.type == pafs.FileType.File]
+
+    def partitions(self, user_id):
+        """{(year, month): [file names]} for every partition of a user"""
+        partitions = {}
+        for info in self._list(self._user_dir(user_id), recursive=True):
+            parts = info.path.split('/')
+            year, month = int(parts[-3].split('=')[1]), int(parts[-2].split('=')[1])
+            partitions.setdefault((year, month), []).append(parts[-1])
+        return partitions
+
+    def _write(self, table, path):
+        """Write via a temporary name so readers never see a partial file"""
+        self.fs.create_dir(posixpath.dirname(path), recursive=True)
+        temp_path = f"{path}.tmp"
+        pq.write_table(table, temp_path, filesystem=self.fs, compression=LAKE_COMPRESSION)
+        self.fs.move(temp_path, path)
+
+    def _base_has_source(self, user_id, year, month, tag):
+        path = posixpath.join(self._partition_dir(user_id, year, month), BASE_FILE)
+        sources = pq.read_table(path, columns=["source_tag"], filesystem=self.fs).column("source_tag")
+        return pc.any(pc.equal(sources, tag)).as_py() or False
+
+    # ----- writes -----
+
+    def write_object(self, user_id, s3_key, rows):
+        """
+        Replace every row of one source object with `rows` (dicts keyed by LAKE_COLUMNS)
+        Returns the number of partitions written
+        """
+        tag = source_tag(s3_key)
+        delta_name = f"{DELTA_PREFIX}{tag}.parquet"
+
+        by_partition = {}
+        for row in rows:
+            row = dict(row, source_key=s3_key, source_tag=tag)
+            by_partition.setdefault((row["year"], row["month"]), []).append(row)
+
+        for (year, month), partition_rows in by_partition.items():
+            table = pa.Table.from_pylist(partition_rows, schema=self.schema)
+            self._write(table, posixpath.join(self._partition_dir(user_id, year, month), delta_name))
+
+        # Partitions the object no longer has rows in: drop its delta, tombstone its base rows
+        for (year, month), names in self.partitions(user_id).items():
+            if (year, month) in by_partition:
+                continue
+            directory = self._partition_dir(user_id, year, month)
+            if BASE_FILE in names and self._base_has_source(user_id, year, month, tag):
+                self._write(self.schema.empty_table(), posixpath.join(directory, delta_name))
+            elif delta_name in names:
+                self.fs.delete_file(posixpath.join(directory, delta_name))
+
+        return len(by_partition)
+
+    def remove_object(self, user_id, s3_key):
+        """Remove every row of a deleted source object"""
+        return self.write_object(user_id, s3_key, [])
+
+    def delete_user(self, user_id):
+        self.fs.delete_dir_contents(self._user_dir(user_id), missing_dir_ok=True)
+
+    # ----- reads -----
+
+    def read_partition(self, user_id, year, month, columns=None):
+        """Current rows of one partition (base rows superseded by deltas are dropped)"""
+        directory = self._partition_dir(user_id, year, month)
+        names = [info.path.split('/')[-1] for info in self._list(directory)]
+        deltas = sorted(_delta_names(names))
+        read_columns = None if columns is None else list(dict.fromkeys(list(columns) + ["source_tag"]))
+
+        tables = [
+            pq.read_table(posixpath.join(directory, name), columns=read_columns, filesystem=self.fs)
+            for name in deltas
+        ]
+        if BASE_FILE in names:
+            base = pq.read_table(posixpath.join(directory, BASE_FILE), columns=read_columns, filesystem=self.fs)
+            superseded = pa.array([name[len(DELTA_PREFIX):-len('.parquet')] for name in deltas], pa.string())
+            tables.insert(0, base.filter(pc.invert(pc.is_in(base.column("source_tag"), value_set=superseded))))
+
+        schema = self.schema if read_columns is None else pa.schema([self.schema.field(c) for c in read_columns])
+        table = pa.concat_tables([t.select(schema.names) for t in tables]) if tables else schema.empty_table()
+        return table if columns is None else table.select(list(columns))
+
+    def read_user(self, user_id, years=None, columns=None):
+        """Current rows of a user, optionally limited to some years"""
+        tables = [
+            self.read_partition(user_id, year, month, columns)
+            for year, month in sorted(self.partitions(user_id))
+            if years is None or year in years
+        ]
+        if not tables:
+            schema = self.schema if columns is None else pa.schema([self.schema.field(c) for c in columns])
+            return schema.empty_table()
+        return pa.concat_tables(tables)
+
+    # ----- compaction -----
+
+    def compact_partition(self, user_id, year, month):
+        """Fold all deltas of a partition into base.parquet"""
+        directory = self._partition_dir(user_id, year, month)
+        names = [info.path.split('/')[-1] for info in self._list(directory)]
+        deltas = [posixpath.join(directory, name) for name in _delta_names(names)]
+        if not deltas:
+            return False
+
+        table = self.read_partition(user_id, year, month)
+        if table.num_rows:
+            self._write(table, posixpath.join(directory, BASE_FILE))
+        else:
+            self.fs.delete_dir_contents(directory, missing_dir_ok=True)
+        for path in deltas:
+            if self.fs.get_file_info(path).type == pafs.FileType.File:
+                self.fs.delete_file(path)
+        return True
+
+    def compact_user(self, user_id, min_files=None):
+        """Compact the user's partitions holding at least `min_files` deltas; returns the count"""
+        min_files = self.compact_min_files if min_files is None else min_files
+        compacted = 0
+        for (year, month), names in self.partitions(user_id).items():
+            if len(_delta_names(names)) >= min_files:
+                compacted += self.compact_partition(user_id, year, month)
+        return compacted
@@ -0,0 +1,151 @@
+"""
+Sagaa Transaction Metadata Schema
+Compact Pinecone metadata layout for transaction vectors, shared by the indexer and the
+insight Lambdas. Boolean flags are packed into one integer and fields that can be derived
+from others (temporal breakdown of the date, text, s3_key, indexed_at) are dropped.
+decode_transaction_metadata() rebuilds the full dict, so readers work with either layout;
+the rebuilt text is an approximation of the embedded one (see _rebuild_text).
+"""
+
+from datetime import datetime
+from functools import lru_cache
+
+# ==================== CONFIGURATION ====================
+
+COMPACT_METADATA_VERSION = 1
+SCHEMA_FIELD = 'metadata_schema'
+
+# Bit order is part of the layout version: only ever append
+FLAG_BITS = [
+    'is_income',
+    'is_subscription',
+    'is_bill',
+    'is_transfer',
+    'is_refund',
+    'is_discretionary',
+    'affects_budget',
+    'is_recurring',
+    'is_large_purchase',
+    'is_unusual',
+]
+
+# Kept as plain fields (in addition to the bitfield) because Lambdas filter on them
+COMPACT_FILTER_FLAGS = ['affects_budget', 'is_large_purchase', 'is_unusual']
+
+# Scalar fields stored as-is in the compact layout
+COMPACT_FIELDS = [
+    'user_id', 'date', 'timestamp', 'year', 'month', 'amount', 'type', 'category',
+    'description', 'merchant', 'source_type', 'vertical', 'goal_contribution',
+    'recurring_frequency',
+]
+
+# ==================== ENCODE ====================
+
+def pack_flags(metadata):
+    """Pack the boolean is_* flags into one integer"""
+    flags = 0
+    for bit, name in enumerate(FLAG_BITS):
+        if metadata.get(name):
+            flags |= 1 << bit
+    return flags
+
+def unpack_flags(flags):
+    """Inverse of pack_flags"""
+    return {name: bool(flags & (1 << bit)) for bit, name in enumerate(FLAG_BITS)}
+
+def encode_compact_metadata(metadata):
+    """Full indexer metadata dict -> compact layout"""
+    compact = {SCHEMA_FIELD: COMPACT_METADATA_VERSION}
+
+    for field in COMPACT_FIELDS:
+        value = metadata.get(field)
+        # Pinecone rejects nulls; empty strings are restored on decode
+        if value is not None and value != '':
+            compact[field] = value
+
+    compact['flags'] = pack_flags(metadata)
+    for name in COMPACT_FILTER_FLAGS:
+        compact[name] = bool(metadata.get(name))
+
+    return compact
+
+# ==================== DECODE ====================
+
+@lru_cache(maxsize=8192)
+def _temporal_fields(date_str):
+    """Temporal breakdown of a YYYY-MM-DD date (same rules as the indexer)"""
+    try:
+        date_obj = datetime.strptime(date_str, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return {
+            "day": 0,
+            "day_of_week": "unknown",
+            "day_of_week_num": -1,
+            "week_of_month": 0,
+            "week_of_year": 0,
+            "quarter": "unknown",
+            "is_weekend": False,
+            "is_month_start": False,
+            "is_month_end": False,
+        }
+
+    return {
+        "day": date_obj.day,
+        "day_of_week": date_obj.strftime('%A'),
+        "day_of_week_num": date_obj.weekday(),
+        "week_of_month": (date_obj.day - 1) // 7 + 1,
+        "week_of_year": date_obj.isocalendar()[1],
+        "quarter": f"Q{(date_obj.month - 1) // 3 + 1}",
+        "is_weekend": date_obj.weekday() >= 5,
+        "is_month_start": date_obj.day <= 7,
+        "is_month_end": date_obj.day > 23,
+    }
+
+def _rebuild_text(metadata):
+    """
+    Approximation of the embedded text, in the indexer's format (create_transaction_text)
+    Not the exact string that was embedded: only normalized date, amount, type and category
+    values are stored (type/category lowercased), and description/merchant are truncated to
+    200/100 characters. Good for display and prompts; never compare or re-embed it. The full
+    layout keeps the exact text.
+    """
+    text_parts = [
+        f"Date: {metadata.get('date') or 'unknown date'}",
+        f"Amount: ${abs(float(metadata.get('amount', 0))):.2f}",
+        f"Type: {metadata.get('type', 'unknown')}",
+        f"Category: {metadata.get('category', 'uncategorized')}",
+    ]
+    if metadata.get('merchant'):
+        text_parts.append(f"Merchant: {metadata['merchant']}")
+    if metadata.get('description'):
+        text_parts.append(f"Description: {metadata['description']}")
+    text_parts.append(f"Source: {metadata.get('source_type', '')}")
+    return " | ".join(text_parts)
+
+def decode_transaction_metadata(metadata):
+    """
+    Rebuild the full metadata dict from either layout
+    Full-layout metadata (no schema marker) is returned unchanged
+    """
+    if not metadata or SCHEMA_FIELD not in metadata:
+        return metadata
+
+    full = {field: '' for field in ('date', 'type', 'category', 'description', 'merchant',
+                                    'source_type', 'vertical', 'goal_contribution',
+                                    'recurring_frequency')}
+    full.update({key: value for key, value in metadata.items()
+                 if key not in (SCHEMA_FIELD, 'flags')})
+    full.setdefault('timestamp', 0)
+    full.setdefault('year', 0)
+    full.setdefault('month', 0)
+    full.setdefault('amount', 0.0)
+
+    full.update(_temporal_fields(full['date']))
+    full.update(unpack_flags(int(metadata.get('flags', 0))))
+
+    # Dropped fields
+    full['text'] = _rebuild_text(full)
+    full.setdefault('s3_key', '')
+    full.setdefault('indexed_at', '')
+
+    return full